@@ -0,0 +1,105 @@
+import sys
+import random
+import argparse
+from typing import Iterator
+
+
+# Generates a synthetic Hackasm program of about the given number of lines.
+# The program is a DATA section of strings and buffers followed by many
+# small routines mixing plain instructions with .ld16, .add16 and .pushstr,
+# all tied together by labels and .set symbols. It assembles and links at any
+# size: routines only reach each other through byte-selected addresses and
+# short forward relative jumps, and _swap and _main stay near the start of
+# the image where absolute jumps and stores can reach them. Images this large
+# do not fit the VM, so the program is meant to be assembled, not run
+def generate(lines: int = 100_000, seed: int = 0) -> Iterator[str]:
+    rng = random.Random(seed)
+    symbols = max(16, lines // 200)
+    strings = max(8, lines // 100)
+    buffers = max(4, lines // 2000)
+
+    yield "# Synthetic benchmark program"
+    for symbol in range(symbols):
+        yield f".set CONST_{symbol} {rng.randrange(256)}"
+    yield ".section data"
+    yield "  .label _swap"
+    yield "  .alloc 2"
+    yield ".section text"
+    yield "  .label _main"
+    yield "    .zero"
+    yield "    ret"
+
+    yield ".section data"
+    for string in range(strings):
+        words = " ".join(rng.choice(WORDS) for _ in range(rng.randrange(2, 12)))
+        yield f"  .label str_{string}"
+        yield f'  .ascii "{words}"'
+    for buffer in range(buffers):
+        yield f"  .label buffer_{buffer}"
+        yield f"  .alloc {rng.choice((64, 256, 1024, 4096))}"
+
+    yield ".section text"
+    emitted = 8 + 2 * symbols + 2 * strings + 2 * buffers
+    routine = 0
+    while emitted < lines:
+        body = list(routine_body(rng, routine, symbols, strings, buffers))
+        yield f"  .label routine_{routine}"
+        yield from body
+        yield "    ret"
+        emitted += len(body) + 2
+        routine += 1
+
+
+WORDS = ("alpha", "beta", "gamma", "delta", "register", "stack", "pointer", "value", "byte", "loop", "Hello",
+         "world", "VM-O-MATIC", "0123456789", "!?", "data", "text")
+
+
+def routine_body(rng: random.Random, routine: int, symbols: int, strings: int, buffers: int):
+    for statement in range(rng.randrange(6, 40)):
+        kind = rng.random()
+        if kind < 0.45:
+            yield f"    {rng.choice(PLAIN)}"
+        elif kind < 0.55:
+            yield f"    ldx CONST_{rng.randrange(symbols)}"
+        elif kind < 0.65:
+            target = rng.choice((f"str_{rng.randrange(strings)}", f"buffer_{rng.randrange(buffers)}",
+                                 f"routine_{rng.randrange(routine + 1)}"))
+            yield f"    .ld16 {target}"
+        elif kind < 0.72:
+            yield "    .pushregs"
+            yield f"    .add16 {rng.randrange(1, 256)}"
+            yield "    .popregs"
+        elif kind < 0.78:
+            yield f"    .pushstr str_{rng.randrange(strings)}"
+            yield "    .rmregs"
+        elif kind < 0.85:
+            yield f"    ldy routine_{rng.randrange(routine + 1)}|0"
+            yield f"    ldx routine_{rng.randrange(routine + 1)}|1"
+        elif kind < 0.92:
+            # Skips one instruction with a forward relative jump
+            yield f"    cmpx {rng.randrange(256)}"
+            yield "    jrg 5"
+            yield "    decx 1"
+            yield f"  .label routine_{routine}_skip_{statement}"
+        else:
+            yield f"    .fetchregs   # {rng.choice(WORDS)}"
+
+
+PLAIN = ("ldx 1", "ldy 2", "addx 3", "decx 1", "pushx", "popx", "pushy", "popy", "addxy", "rorx", "rolx", "xorx",
+         "nop", "cmpx 0", "cmpy 255", "ldx 0x10", "ldy 0b101")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic Hackasm program for benchmarking")
+    parser.add_argument("-n", dest="lines", type=int, default=100_000, help="approximate number of lines")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", dest="output", default=None, help="output file (default: stdout)")
+    options = parser.parse_args()
+    output = open(options.output, "w") if options.output != None else sys.stdout
+    with output:
+        for line in generate(options.lines, options.seed):
+            output.write(line + "\n")
+
+
+if __name__ == "__main__":
+    main()
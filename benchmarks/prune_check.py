@@ -0,0 +1,114 @@
+import io
+import os
+import sys
+import random
+import argparse
+
+# Check the working tree rather than whichever version is installed
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import hackasm
+from hackasm.optimizer import optimize
+from hackasm.prune import prune
+from hackasm.vm import Vm, VmError
+
+
+DEFAULT_PROGRAMS = 500
+# Generated programs may loop forever; runs are compared up to this many steps
+MAX_STEPS = 3000
+
+# Programs that went wrong before, checked on every run
+REGRESSIONS = [
+    # An unused routine before _main larger than its start address
+    "\n".join([".section data", ".label _swap", ".alloc 2", ".section text", ".label unused"]
+              + [f"ldx {value}" for value in range(1, 9)] + ["ret", ".label _main", "ldx 65", "out", "ret"]),
+    # A label difference spanning a buffer nothing else refers to
+    "\n".join([".section data", ".label _swap", ".alloc 2", ".label start", ".alloc 3", ".label unused",
+               ".alloc 1", ".label end", ".set SIZE end-start", ".section text", ".label _main",
+               "ldx 64", "addx SIZE", "out", "ret"]),
+    # A literal address reading the program's own OUT opcode
+    "\n".join([".section data", ".label _swap", ".alloc 2", ".section text", ".label _main", ".pushregs",
+               ".popregs", "ldrx 14", "out", "ret"]),
+]
+
+
+# A small program of data blocks and routines jumping between each other,
+# some of them unreferenced
+def generate(rng: random.Random):
+    routines = rng.randrange(2, 7)
+    lines = [".section data", ".label _swap", ".alloc 2", ".label counter", ".alloc 1"]
+    buffers = rng.randrange(0, 4)
+    for buffer in range(buffers):
+        lines.append(f".label d{buffer}")
+        lines.append(rng.choice([".alloc 3", '.ascii "xy"', '.ascii "y"', ".word 9", ".alloc 1"]))
+    lines.append(".label d_end")
+    lines.append(".set DL d_end-d0" if buffers else ".set DL 1")
+    lines.append(".section text")
+    order = list(range(routines))
+    rng.shuffle(order)
+    for routine in order:
+        lines.append(f".label r{routine}" if routine else ".label _main")
+        for _ in range(rng.randrange(1, 5)):
+            lines.append(rng.choice(["ldx 65", "addx 1", "out", "ldrx counter", "addx DL", ".pushregs", ".popregs",
+                                     f"cmpx {rng.randrange(60, 70)}", f"jl r{rng.randrange(1, routines)}",
+                                     "ldrx d0" if buffers else "nop"]))
+        lines.append(rng.choice([f".jump r{rng.randrange(1, routines)}", f".fastjump r{rng.randrange(1, routines)}",
+                                 "ret", "out"]))
+    return "\n".join(lines)
+
+
+# Output, and how the run ended: "halt", "steps" or the VM error
+def run(source: str, opt_level: str, pruned: bool):
+    compiler = hackasm.compile(source, opt_level)
+    if opt_level != "0":
+        optimize(compiler)
+    if pruned:
+        prune([compiler])
+    output = io.BytesIO()
+    vm = Vm(bytes(hackasm.link(compiler)), compiler.instructions, io.BytesIO(b""), output)
+    try:
+        ending = "halt" if vm.run(MAX_STEPS) else "steps"
+    except VmError as e:
+        ending = str(e)
+    return output.getvalue(), ending
+
+
+# Whether source runs the same at opt_level, pruned or not, as it does
+# unoptimized. A run cut short by the step limit only has to agree up to
+# where the shorter one got
+def same(source: str, opt_level: str, pruned: bool):
+    try:
+        expected = run(source, "0", False)
+    except hackasm.AsmError:
+        return True
+    output, ending = run(source, opt_level, pruned)
+    if expected[1] == "steps" and ending == "steps":
+        length = min(len(expected[0]), len(output))
+        return expected[0][:length] == output[:length]
+    return (output, ending) == expected
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that programs run the same on the VM with -O, -O2, -Os "
+                                                 "and --prune as without them")
+    parser.add_argument("-n", dest="programs", type=int, default=DEFAULT_PROGRAMS,
+                        help=f"number of generated programs (default: {DEFAULT_PROGRAMS})")
+    parser.add_argument("--seed", type=int, default=0)
+    options = parser.parse_args()
+
+    rng = random.Random(options.seed)
+    sources = REGRESSIONS + [generate(rng) for _ in range(options.programs)]
+    failures = 0
+    for index, source in enumerate(sources):
+        for opt_level in ("0", "1", "2", "s"):
+            for pruned in (False, True):
+                if (opt_level, pruned) != ("0", False) and not same(source, opt_level, pruned):
+                    failures += 1
+                    flags = f"-O{opt_level}" + (" --prune" if pruned else "")
+                    print(f"Program {index} runs differently with {flags}:\n{source}\n")
+    print(f"Checked {len(sources)} program(s): {failures} difference(s)")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    exit(main())
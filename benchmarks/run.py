@@ -0,0 +1,120 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+
+# Benchmark the working tree rather than whichever version is installed
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import hackasm
+from hackasm.optimizer import optimize
+from generate import generate
+
+
+# Metrics compared against the baseline; all of them are better when lower
+METRICS = ("compile_s", "optimize_s", "link_s", "hex_s", "peak_memory_bytes")
+DEFAULT_THRESHOLD = 0.25
+
+
+def run(source: str, opt_level: str, repeat: int):
+    timings = {"compile_s": [], "link_s": [], "hex_s": []}
+    if opt_level != "0":
+        timings["optimize_s"] = []
+    size = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        compiler = hackasm.compile(source, opt_level)
+        timings["compile_s"].append(time.perf_counter() - start)
+
+        if opt_level != "0":
+            start = time.perf_counter()
+            optimize(compiler)
+            timings["optimize_s"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        image = hackasm.link(compiler)
+        timings["link_s"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        hackasm.linked_code_to_hex_string(image)
+        timings["hex_s"].append(time.perf_counter() - start)
+        size = len(image)
+        del compiler, image
+
+    # tracemalloc slows allocation down, so memory is measured in a run of its own
+    tracemalloc.start()
+    compiler = hackasm.compile(source, opt_level)
+    if opt_level != "0":
+        optimize(compiler)
+    hackasm.linked_code_to_hex_string(hackasm.link(compiler))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    results = {name: min(values) for name, values in timings.items()}
+    results["peak_memory_bytes"] = peak
+    results["image_bytes"] = size
+    return results
+
+
+# Returns the metrics that got worse than the baseline by more than threshold
+def compare(results: dict, baseline: dict, threshold: float):
+    regressions = []
+    print(f"{'metric':<20}{'baseline':>14}{'current':>14}{'change':>10}")
+    for metric in METRICS:
+        if metric not in results or metric not in baseline or baseline[metric] <= 0:
+            continue
+        change = results[metric] / baseline[metric] - 1
+        flag = "  REGRESSION" if change > threshold else ""
+        print(f"{metric:<20}{baseline[metric]:>14.4g}{results[metric]:>14.4g}{change:>+10.1%}{flag}")
+        if change > threshold:
+            regressions.append(metric)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time compile(), link() and linked_code_to_hex_string() on a "
+                                                 "synthetic program")
+    parser.add_argument("-n", dest="lines", type=int, default=100_000, help="approximate number of lines")
+    parser.add_argument("--seed", type=int, default=0)
+    # -Os picks the .pushstr loop, which stores into the code and so only
+    # links in programs smaller than the generated ones
+    parser.add_argument("-O", dest="opt_level", default="0", choices=["0", "1", "2"])
+    parser.add_argument("--repeat", type=int, default=3, help="runs to take the fastest of (default: 3)")
+    parser.add_argument("--baseline", default=None, help="baseline JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help=f"fail if a metric is this much worse than the baseline (default: {DEFAULT_THRESHOLD})")
+    parser.add_argument("--save", default=None, help="write the results to this JSON file")
+    options = parser.parse_args()
+
+    source = "\n".join(generate(options.lines, options.seed))
+    results = {"lines": source.count("\n") + 1, "seed": options.seed, "opt_level": options.opt_level,
+               "python": platform.python_version()}
+    results.update(run(source, options.opt_level, options.repeat))
+    phases = ", ".join(f"{metric[:-2]} {results[metric] * 1000:.1f} ms"
+                       for metric in METRICS if metric.endswith("_s") and metric in results)
+    print(f"{results['lines']} lines -> {results['image_bytes']} byte(s): {phases}, "
+          f"peak memory {results['peak_memory_bytes'] / 2 ** 20:.1f} MiB")
+
+    if options.save != None:
+        with open(options.save, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if options.baseline != None:
+        with open(options.baseline, "r") as file:
+            baseline = json.load(file)
+        if (baseline.get("lines"), baseline.get("seed"), baseline.get("opt_level")) != \
+                (results["lines"], results["seed"], results["opt_level"]):
+            print("Baseline was recorded with a different program or optimization level")
+            return 2
+        regressions = compare(results, baseline, options.threshold)
+        if regressions:
+            print(f"{len(regressions)} metric(s) regressed by more than {options.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,17 @@
+from .assembler import (
+    VM_INSTRUCTIONS,
+    AsmError,
+    Compiler,
+    Linker,
+    VmCode,
+    VmInstructionInfo,
+    VmInstructionNode,
+    assemble,
+    compile,
+    compile_file,
+    encode,
+    link,
+    link_objects,
+    linked_code_to_hex_string,
+    save,
+)
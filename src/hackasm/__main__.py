@@ -1,572 +1,548 @@
-import sys
-import math
-
-
-def to_linked_repr(value: str, must_be_hex=False):
-    if isinstance(value, int):
-        return False, value, (str(value) if not must_be_hex else hex(value).replace("0x", "").upper())
-
-    if value.startswith("0x"):
-        return True, int(value, 16), value.replace("0x", "").upper()
-
-    if value.startswith("0b"):
-        return True, int(value, 2), hex(int(value, 2)).replace("0x", "").upper()
-
-    if value.isdecimal():
-        return True, int(value), hex(int(value)).replace("0x", "").upper()
-
-    return False, value, value
-
-
-class VmInstructionInfo:
-    def __init__(self, opcode: str, hasarg=True, argsize=1, maxarg=None) -> None:
-        self.opcode = opcode
-        self.hasarg = hasarg
-        self.argsize = argsize
-        self.maxarg = maxarg
-        if self.maxarg == None:
-            self.maxarg = int(math.pow(2, 8 * self.argsize))
-
-
-VM_INSTRUCTIONS = {
-    "CLD": VmInstructionInfo(opcode="40", hasarg=False, argsize=0),
-    "LDX": VmInstructionInfo(opcode="50", hasarg=True, argsize=1),
-    "LDY": VmInstructionInfo(opcode="51", hasarg=True, argsize=1),
-    "STRX": VmInstructionInfo(opcode="52", hasarg=True, argsize=2, maxarg=4096),
-    "STRY": VmInstructionInfo(opcode="53", hasarg=True, argsize=2, maxarg=4096),
-    "LDRX": VmInstructionInfo(opcode="54", hasarg=True, argsize=2, maxarg=4096),
-    "LDRY": VmInstructionInfo(opcode="55", hasarg=True, argsize=2, maxarg=4096),
-    "OUT": VmInstructionInfo(opcode="60", hasarg=False, argsize=0, maxarg=4096),
-    "IN": VmInstructionInfo(opcode="61", hasarg=False, argsize=0),
-    "CMPX": VmInstructionInfo(opcode="70", hasarg=True, argsize=1),
-    "CMPY": VmInstructionInfo(opcode="71", hasarg=True, argsize=1),
-    "JE": VmInstructionInfo(opcode="72", hasarg=True, argsize=2),
-    "JRE": VmInstructionInfo(opcode="73", hasarg=True, argsize=2, maxarg=4096),
-    "JL": VmInstructionInfo(opcode="74", hasarg=True, argsize=2, maxarg=4096),
-    "JRL": VmInstructionInfo(opcode="75", hasarg=True, argsize=2, maxarg=4096),
-    "JLE": VmInstructionInfo(opcode="76", hasarg=True, argsize=2, maxarg=4096),
-    "JRLE": VmInstructionInfo(opcode="77", hasarg=True, argsize=2, maxarg=4096),
-    "JG": VmInstructionInfo(opcode="78", hasarg=True, argsize=2, maxarg=4096),
-    "JRG": VmInstructionInfo(opcode="79", hasarg=True, argsize=2, maxarg=4096),
-    "JGE": VmInstructionInfo(opcode="7A", hasarg=True, argsize=2, maxarg=4096),
-    "JRGE": VmInstructionInfo(opcode="7B", hasarg=True, argsize=2, maxarg=4096),
-    "ADDX": VmInstructionInfo(opcode="A0", hasarg=True, argsize=1),
-    "ADDXY": VmInstructionInfo(opcode="A1", hasarg=False, argsize=0),
-    "DECX": VmInstructionInfo(opcode="A2", hasarg=True, argsize=1),
-    "DECXY": VmInstructionInfo(opcode="A3", hasarg=False, argsize=0),
-    "RORX": VmInstructionInfo(opcode="A4", hasarg=False, argsize=0),
-    "ROLX": VmInstructionInfo(opcode="A5", hasarg=False, argsize=0),
-    "XORX": VmInstructionInfo(opcode="A6", hasarg=False, argsize=0),
-    "PUSHX": VmInstructionInfo(opcode="B0", hasarg=False, argsize=0),
-    "POPX": VmInstructionInfo(opcode="B1", hasarg=False, argsize=0),
-    "PUSHY": VmInstructionInfo(opcode="B2", hasarg=False, argsize=0),
-    "POPY": VmInstructionInfo(opcode="B3", hasarg=False, argsize=0),
-    "RMEMX": VmInstructionInfo(opcode="C0", hasarg=False, argsize=0),
-    "WMEMX": VmInstructionInfo(opcode="C1", hasarg=False, argsize=0),
-    "RMEMY": VmInstructionInfo(opcode="C2", hasarg=False, argsize=0),
-    "WMEMY": VmInstructionInfo(opcode="C3", hasarg=False, argsize=0),
-    "NOP": VmInstructionInfo(opcode="90", hasarg=False, argsize=0),
-    "RET": VmInstructionInfo(opcode="91", hasarg=False, argsize=0)
-}
-
-
-class VmInstructionNode:
-    def __init__(self, instruction: VmInstructionInfo, argument: str|None, offset: int, lineno: int) -> None:
-        self.instruction =instruction
-        self.argument = argument
-        self.offset = offset
-        self.lineno = lineno
-
-
-class VmValueInfo(VmInstructionInfo):
-    def __init__(self, value: str) -> None:
-        super().__init__("", False, len(value), 0)
-        self.value = value
-
-
-class AsmComponent:
-    def __init__(self, name: str, code: str) -> None:
-        self.name = name
-        self.code = code
-        self.lines = self.code.split("\n")
-
-    def throw_error(self, line: int, segment: int|None, error: str):
-        print(f"{self.name} ERROR: {error}")
-        lines = self.code.split('\n')
-        if line < 0 or line > len(lines) - 1:
-            exit(-4)
-        target_line: str = lines[line]
-        segments = target_line.split(' ')
-        target_segment: str = segments[segment] if segment != None else target_line
-        
-        segment_offset = 0
-        if segment != None:
-            for i in range(segment):
-                segment_offset += len(segments[i]) + 1
-
-        print(f"{line + 1}\t{target_line}")
-        print(' ' * len(str(line)) + '\t' + ' ' * segment_offset + '~' * len(target_segment))
-        exit(-3)
-
-
-class Compiler(AsmComponent):
-    def __init__(self, code: str) -> None:
-        self.symbols = {}
-        self.labels = {}
-        self.strings = {}
-        self.result = []
-        self.code_written = False
-        self.byte_offset = 0
-        self.padding_offset = 0
-        self.concrete_offset = 0
-        self.override_offset = 0
-        self.section = None
-        super().__init__("COMPILER", code)
-
-        cld = VmInstructionNode(VM_INSTRUCTIONS["CMPX"], "0", self.byte_offset, 0)
-        self.result.append(cld)
-        self.byte_offset += 2
-        inst = VmInstructionNode(VM_INSTRUCTIONS["JE"], "_main", self.byte_offset, 0)
-        self.result.append(inst)
-        self.byte_offset += inst.instruction.argsize + 1
-
-    def add_symbol(self, key: str, value: str):
-        self.symbols.__setitem__(key, value)
-
-    def get_symbol(self, key: str):
-        return self.symbols[key]
-
-    def add_label(self, label: str, address: int):
-        self.labels.__setitem__(label, address)
-
-    def get_label(self, label: str):
-        return self.labels[label]
-
-    def compile_line(self, index: int, segments: list[str]):
-        line = self.lines[index]
-        if len(line.replace(" ", "").replace("\t", "")) == 0:
-            return
-        opcode = segments[0]
-        starting_sym = opcode[0]
-        
-        match (starting_sym):
-            case '.':
-                self.process_macro(index, opcode, segments[1:])
-
-            case '#':
-                return
-
-            case _:
-                self.process_instruction(index, opcode, segments[1:])
-
-    def process_macro(self, index: int, macro: str, segments: list[str]):
-        match (macro.replace('.', '').upper()):
-            case 'SET':
-                if len(segments) != 2:
-                    self.throw_error(index, None, "Expected 2 arguments for macro SET")
-                if segments[0] in self.labels or segments[0] in self.symbols:
-                    self.throw_error(index, 1, "Symbol already exists")
-                self.add_symbol(*segments)
-
-            case 'LABEL':
-                if len(segments) != 1:
-                    self.throw_error(index, None, "Expected 1 argument for macro LABEL")
-                if segments[0] in self.symbols or segments[0] in self.labels:
-                    self.throw_error(index, 1, "Symbol already exists")
-                self.add_label(segments[0], self.byte_offset)
-                if segments[0] == "_main" and len(self.result) == 1:
-                    self.result = []
-                    self.byte_offset = 0
-
-            case 'ASCII':
-                if self.section != "DATA":
-                    self.throw_error(index, None, "ASCII String outside of DATA section")
-                if len(segments) == 0:
-                    self.throw_error(index, None, "Expected ASCII sequence")
-                ascii_sequence = ' '.join(segments)
-                ascii_string = ""
-                if ascii_sequence[0] != '"':
-                    self.throw_error(index, 1, "Expected quotes")
-                ascii_index = 1
-                while ascii_index < len(ascii_sequence) and ascii_sequence[ascii_index] != '"':
-                    ascii_string += ascii_sequence[ascii_index]
-                    ascii_index += 1
-                if len(ascii_string) < len(ascii_sequence) - 2:
-                    self.throw_error(index, None, "Invalid syntax")
-                hex_string = ""
-                for i, c in enumerate(ascii_string):
-                    char = hex(ord(c)).replace("0x", "").upper()
-                    while len(char) % 2 != 0:
-                        char = "0" + char
-                    hex_string += str(char)
-                hex_string += "00"
-                self.result.append(VmInstructionNode(VmValueInfo(hex_string), hex_string, self.byte_offset, index))
-                self.strings.__setitem__(self.byte_offset, hex_string)
-                self.byte_offset += len(ascii_string) + 1
-
-            case 'SECTION':
-                if len(segments) != 1:
-                    self.throw_error(index, None, "Expected section")
-
-                if self.section == 'OVERRIDE':
-                    self.override_offset = self.byte_offset
-                    self.byte_offset = self.concrete_offset
-                
-                match (segments[0].upper()):
-                    case 'DATA':
-                        if self.section == "TEXT":
-                            self.result.append(VmInstructionNode(VM_INSTRUCTIONS["RET"], "", self.byte_offset, index))
-                            self.byte_offset += 1
-                        self.section = "DATA"
-
-                    case 'TEXT':
-                        self.section = "TEXT"
-
-                    case 'OVERRIDE':
-                        self.section = 'OVERRIDE'
-                        self.concrete_offset = self.byte_offset
-                        self.byte_offset = self.override_offset
-
-                    case 'META':
-                        if self.section != None:
-                            self.throw_error(index, None, "META section expected to be the first in source file")
-                        self.section = "META"
-
-                    case _:
-                        self.throw_error(index, 1, "Unknown section")
-
-            case 'ALLOC':
-                if self.section != "DATA":
-                    self.throw_error(index, None, "Cannot allocate buffer outside of DATA section")
-                if len(segments) != 1:
-                    self.throw_error(index, None, "Expected buffer size")
-                if segments[0] in self.symbols:
-                    segments[0] = self.get_symbol(segments[0])
-                if not segments[0].isdecimal():
-                    self.throw_error(index, 1, "Expected buffer size or macro symbol")
-                segments[0] = int(segments[0])
-                val = VmValueInfo("00" * segments[0])
-                self.result.append(VmInstructionNode(val, val.value, self.byte_offset, index))
-                self.byte_offset += segments[0]
-
-            case 'PAD':
-                if len(segments) != 1:
-                    self.throw_error(index, None, "Expected pad size")
-                if segments[0] in self.symbols:
-                    segments[0] = self.get_symbol(segments[0])
-                try:
-                    segments[0] = int(segments[0])
-                except:
-                    self.throw_error(index, 1, "Expected buffer size or macro symbol")
-                self.byte_offset += segments[0]
-                if self.section != "OVERRIDE":
-                    self.padding_offset += segments[0]
-
-            case 'WORD':
-                if self.section != "DATA":
-                    self.throw_error(index, None, "Unexpected byte allocation outside of DATA section")
-                val = VmValueInfo(segments[0])
-                val.hasarg = True
-                val.maxarg = math.pow(2, 64)
-                val.argsize = 0
-                self.result.append(VmInstructionNode(val, val.value, self.byte_offset, index))
-                self.byte_offset += 1
-
-            case 'PUSHSTR':
-                if len(segments) != 1:
-                    self.throw_error(index, None, "Expected address or label")
-
-                if segments[0] in self.labels:
-                    segments[0] = self.get_label(segments[0])
-                
-                changed, int_val, str_val = to_linked_repr(segments[0])
-                if not changed and not isinstance(segments[0], int):
-                    self.throw_error(index, 1, "Invalid syntax")
-
-                address = int_val
-                if address not in self.strings:
-                    self.throw_error(index, 1, f"No string at location {hex(address).upper()}")
-                string = self.strings[address]
-                
-                base_ldx = VmInstructionNode(VM_INSTRUCTIONS["LDX"], "0", self.byte_offset, index)
-                self.byte_offset += base_ldx.instruction.argsize + 1
-                base_pushx = VmInstructionNode(VM_INSTRUCTIONS["PUSHX"], "", self.byte_offset, index)
-                self.byte_offset += 1
-                self.result.append(base_ldx)
-                self.result.append(base_pushx)
-
-                for byte in (string[i:i+2] for i in range(0, len(string), 2)):
-                    ldx = VmInstructionNode(VM_INSTRUCTIONS["LDX"], str(int(byte, 16)), self.byte_offset, index)
-                    self.byte_offset += ldx.instruction.argsize + 1
-                    pushx = VmInstructionNode(VM_INSTRUCTIONS["PUSHX"], "", self.byte_offset, index)
-                    self.byte_offset += 1
-                    self.result.append(ldx)
-                    self.result.append(pushx)
-
-            case 'STRREGS':
-                if len(segments) != 1:
-                    self.throw_error(index, None, "Expected address or label")
-                self.result.append(VmInstructionNode(VM_INSTRUCTIONS["STRX"], segments[0], self.byte_offset, index))
-                self.byte_offset += 3
-                self.result.append(VmInstructionNode(VM_INSTRUCTIONS["STRY"], f"{segments[0]}+1", self.byte_offset, index))
-                self.byte_offset += 3
-
-            case 'LDREGS':
-                if len(segments) != 1:
-                    self.throw_error(index, None, "Expected address or label")
-                self.result.append(VmInstructionNode(VM_INSTRUCTIONS["LDRX"], segments[0], self.byte_offset, index))
-                self.byte_offset += 3
-                self.result.append(VmInstructionNode(VM_INSTRUCTIONS["LDRY"], f"{segments[0]}+1", self.byte_offset, index))
-                self.byte_offset += 3
-
-            case 'LD16':
-                if len(segments) != 1:
-                    self.throw_error(index, None, "Expected value or symbol")
-                if '+' in segments[0]:
-                    self.throw_error(index, 1, "LD16 macro does not support address offsets")
-                self.result.append(VmInstructionNode(VM_INSTRUCTIONS["LDX"], f"{segments[0]}|1", self.byte_offset, index))
-                self.byte_offset += 2
-                self.result.append(VmInstructionNode(VM_INSTRUCTIONS["LDY"], f"{segments[0]}|0", self.byte_offset, index))
-                self.byte_offset += 2
-
-            case 'PUSHREGS':
-                if len(segments) != 0:
-                    self.throw_error(index, None, "No argument expected")
-                self.result.append(VmInstructionNode(VM_INSTRUCTIONS["PUSHY"], "", self.byte_offset, index))
-                self.byte_offset += 1 
-                self.result.append(VmInstructionNode(VM_INSTRUCTIONS["PUSHX"], "", self.byte_offset, index))
-                self.byte_offset += 1
-
-            case 'ADD16':
-                if len(segments) != 1:
-                    self.throw_error(index, None, "Expected operand")
-                self.process_instruction(index, "POPX", [])
-                self.process_instruction(index, "ADDX", [segments[0]])
-                self.process_instruction(index, "CMPX", [segments[0]])
-                # skip first overflow step if not necessary
-                self.process_instruction(index, "JRGE", ["18"])
-                # first overflow step
-                self.process_instruction(index, "POPY", []) # get Y
-                self.process_instruction(index, "PUSHX", []) # save X
-                self.process_instruction(index, "PUSHY", []) # swap registers
-                self.process_instruction(index, "POPX", []) # continuation of swap registers
-                self.process_instruction(index, "ADDX", ["1"]) # add 1 to X
-                # set Y = X
-                self.process_instruction(index, "PUSHX", [])
-                self.process_instruction(index, "POPY", [])
-                self.process_instruction(index, "POPX", [])
-                # Skip overflow step if not necessary
-                self.process_instruction(index, "JRL", ["5"])
-                # overflow step
-                self.process_instruction(index, "LDX", ["0"])
-                # restore registers
-                self.process_instruction(index, "PUSHY", [])
-                self.process_instruction(index, "PUSHX", [])
-
-            case 'JUMP':
-                if len(segments) != 1:
-                    self.throw_error(index, None, "Expected address or label")
-                self.process_instruction(index, "PUSHX", [])
-                self.process_instruction(index, "LDX", ["0"])
-                self.process_instruction(index, "CMPX", ["0"])
-                self.process_instruction(index, "POPX", [])
-                self.process_instruction(index, "JE", [segments[0]])
-
-            case 'ZERO':
-                if len(segments) != 0:
-                    self.throw_error(index, None, "Expected no arguments")
-                self.process_instruction(index, "LDX", ["0"])
-                self.process_instruction(index, "LDY", ["0"])
-
-            case 'POPREGS':
-                if len(segments) != 0:
-                    self.throw_error(index, None, "Expected no arguments")
-                self.process_instruction(index, "POPX", [])
-                self.process_instruction(index, "POPY", [])
-
-            case 'RMREGS':
-                if len(segments) != 0:
-                    self.throw_error(index, None, "Expected no arguments")
-                self.process_macro(index, "STRREGS", ["_swap"])
-                self.process_macro(index, "POPREGS", [])
-                self.process_macro(index, "LDREGS", ["_swap"])
-
-            case 'FETCHREGS':
-                self.process_macro(index, "POPREGS", [])
-                self.process_macro(index, "PUSHREGS", [])
-
-            case 'FASTJUMP':
-                if len(segments) != 1:
-                    self.throw_error(index, None, "Expected address or label")
-                self.process_instruction(index, "CMPX", ["0"])
-                self.process_instruction(index, "JGE", [segments[0]])
-
-            case 'PUSH16':
-                if len(segments) != 1:
-                    self.throw_error(index, None, "Expected a 16-bit value")
-                self.process_instruction(index, "LDX", [f"{segments[0]}|0"])
-                self.process_instruction(index, "PUSHX", [])
-                self.process_instruction(index, "LDX", [f"{segments[0]}|1"])
-                self.process_instruction(index, "PUSHX", [])
-            
-            case 'STR16':
-                if len(segments) != 2:
-                    self.throw_error(index, None, "Expected value and destination")
-                self.process_instruction(index, "LDX", [f"{segments[0]}|1"])
-                self.process_instruction(index, "STRX", [segments[1]])
-                self.process_instruction(index, "LDX", [f"{segments[0]}|0"])
-                self.process_instruction(index, "STRX", [f"{segments[1]}+1"])
-
-            case 'INST':
-                if self.section != "META":
-                    self.throw_error(index, None, "Unexpected VM instruction declaration outside META section")
-                if len(segments) != 4:
-                    self.throw_error(index, None, "Expected mnemonic, opcode and number of arguments and max argument")
-                mnemonic = segments[0].upper()
-                opcode = segments[1].upper()
-                if not segments[2].isdecimal():
-                    self.throw_error(index, 2, "Expected decimal number")
-                argsize = int(segments[2])
-                maxarg = None
-                if segments[3] != "?":
-                    if not segments[3].isdecimal():
-                        self.throw_error(index, 3, "Invalid syntax")
-                    maxarg = int(segments[3])
-                info = VmInstructionInfo(opcode, argsize != 0, argsize, maxarg)
-                VM_INSTRUCTIONS.__setitem__(mnemonic, info)
-                    
-            case _:
-                self.throw_error(index, None, f"Unknown macro '{macro}'")
-
-    def process_instruction(self, index: int, opcode: str, segments: list[str]):
-        if self.section != "TEXT":
-            self.throw_error(index, None, "Unexpected code outside of TEXT section")
-        line: str = self.lines[index]
-        if opcode.upper() not in VM_INSTRUCTIONS:
-            self.throw_error(index, 0, "Unrecognized Instruction")
-        instruction_info: VmInstructionInfo = VM_INSTRUCTIONS[opcode.upper()]
-        if instruction_info.hasarg and len(segments) == 0:
-            self.throw_error(index, None, "Expected instruction operand")
-        elif not instruction_info.hasarg and len(segments) != 0:
-            self.throw_error(index, None, "Unexpected instruction operand(s)")
-        if len(segments) > 1:
-            self.throw_error(index, 2, "VM Architecture only supports single-operand instructions")
-        inst_node = VmInstructionNode(instruction_info, segments[0] if len(segments) != 0 else "", self.byte_offset, index)
-        self.result.append(inst_node)
-        self.byte_offset += 1 + instruction_info.argsize
-        self.code_written = True
-
-
-class Linker(AsmComponent):
-    def __init__(self, code: str) -> None:
-        super().__init__("LINKER", code)
-
-
-def compile(code: str):
-    print('Compiling...')
-    res = Compiler(code)
-
-    code_lines: list[str] = code.split('\n')
-    for index, line in enumerate(code_lines):
-        line_segments: list[str] = line.split('#')[0].split(' ')
-        line_segments = [i for i in line_segments if i != '']
-        if len(line_segments) == 0:
-            continue  
-        res.compile_line(index, line_segments)
-    if res.section == 'OVERRIDE':
-        res.byte_offset = res.concrete_offset
-    return res
-
-
-def link(compiler: Compiler):
-    print('Linking...')
-    linker = Linker(compiler.code)
-    if "_main" not in compiler.labels:
-        linker.throw_error(-1, None, "_main label not found")
-    if "_swap" not in compiler.labels:
-        linker.throw_error(-1, None, "_swap label not found")
-    res = []
-    for node in compiler.result:
-        node: VmInstructionNode
-        inst_info = node.instruction
-        max_size: int = inst_info.maxarg
-        if not inst_info.hasarg:
-            res.append(node)
-            continue
-
-        global changed, int_val, str_val
-        values = node.argument.split("+")
-        final_int = 0
-
-        while len(values) >= 1:
-            changed, int_val, str_val = to_linked_repr(values[0].split("|")[0])
-            if not changed:
-                if values[0].split("|")[0] in compiler.symbols:
-                    changed, int_val, str_val = to_linked_repr(compiler.get_symbol(values[0].split("|")[0]))
-                elif values[0].split("|")[0] in compiler.labels:
-                    changed = True
-                    int_val = compiler.get_label(values[0].split("|")[0])
-                    str_val = hex(int_val).replace("0x", "").upper()
-                else:
-                    linker.throw_error(node.lineno, 1, "Undefined symbol")
-
-            if "|" in values[0]:
-                v = values[0].split("|")
-                if len(v) != 2:
-                    linker.throw_error(node.lineno, None, "Invalid byte-indexing syntax")
-                if not v[1].isdecimal():
-                     linker.throw_error(node.lineno, None, "Byte-index expected after |")
-                int_val = int_val.to_bytes(length=2, byteorder='big', signed=False)[int(v[1])]
-
-            if int_val >= max_size:
-                linker.throw_error(node.lineno, 1, f"Value exceeds maximum of {max_size}")
-
-            final_int += int_val
-            values.pop(0)
-        
-        final_int = final_int if final_int != 0 else int_val
-        changed, int_val, str_val = to_linked_repr(final_int, True)
-        while len(str_val) < 2 * inst_info.argsize:
-            str_val = "0" + str_val
-        while len(str_val) % 2 != 0:
-            str_val = "0" + str_val
-        linked_node = VmInstructionNode(node.instruction, str_val, node.offset, node.lineno)
-        res.append(linked_node)
-    
-    print(f'Linked bytecode size: {compiler.byte_offset - compiler.padding_offset} byte(s)')
-    print("Linked labels:")
-    for label, address in compiler.labels.items():
-        print(f"  - {label}: {hex(address)}")
-    print("Linked symbols:")
-    for sym, value in compiler.symbols.items():
-        print(f"  - {sym}: {value}")
-    return res
-
-
-def linked_code_to_hex_string(linked_code_seq: list[VmInstructionNode]):
-    res = ""
-    for node in linked_code_seq:
-        res += node.instruction.opcode + node.argument
-    return res
-
-
-def save(linked_code_repr: str):
-    with open("vm_asm_out.txt", "w") as outfile:
-        outfile.write(linked_code_repr)
-
-
-def main(filepath: str):
-    try:
-        with open(filepath, "r") as file:
-            save(linked_code_to_hex_string(link(compile(file.read()))))
-            return 0
-    except Exception as e:
-        raise e
-
-
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("ERROR: Expected 1 argument")
-        exit(-1)
-
-    exit(main(sys.argv[1]))
+import os
+import sys
+import time
+import signal
+import argparse
+import contextlib
+
+from .analyze import analyze, format_analysis
+from .assembler import VM_INSTRUCTIONS, AsmError, Compiler, Linker, compile_file, link, linked_code_to_hex_string, save
+from .batch import BuildResult, build
+from .cache import BuildCache
+from .disasm import Disassembler, load_image, load_symbol_map, save_symbol_map
+from .layout import LayoutReport, format_memory_map, memory_map, plan_layout
+from .lsp import serve
+from .objfile import ObjectFormatError, load_object, save_object
+from .optimizer import optimize
+from .prune import PruneReport, prune
+from .stats import Profiler, format_stats
+from .vm import Vm, VmError
+from .vmprofile import DEFAULT_TOP, ExecutionProfile, format_profile
+from .watch import DEFAULT_INTERVAL, Daemon, Watcher, request
+
+
+def print_link_summary(compiler: Compiler|Linker, pruned: PruneReport|None = None):
+    saved = f", {pruned.removed_bytes} byte(s) saved by pruning" if pruned != None and pruned.skipped == None else ""
+    print(f'Linked bytecode size: {compiler.byte_offset - compiler.padding_offset} byte(s){saved}')
+    print("Linked labels:")
+    labels = compiler.labels() if isinstance(compiler, Linker) else compiler.labels
+    for label, address in labels.items():
+        if isinstance(compiler, Compiler) and label in compiler.local_labels:
+            continue
+        print(f"  - {label}: {hex(address)}")
+    print("Linked symbols:")
+    symbols = {} if isinstance(compiler, Linker) else compiler.symbols
+    for sym, value in symbols.items():
+        print(f"  - {sym}: {value}")
+
+
+def print_optimization_summary(report):
+    if report.skipped != None:
+        print(f"Optimization skipped: {report.skipped}")
+        return
+    print(f"Optimized away {report.removed_instructions} instruction(s), {report.removed_bytes} byte(s)")
+
+
+def print_prune_summary(report: PruneReport):
+    if report.skipped != None:
+        print(f"Pruning skipped: {report.skipped}")
+        return
+    print(f"Pruned {report.removed_blocks} unreferenced block(s), merged {report.merged_strings} string(s)")
+
+
+def print_layout_summary(report: LayoutReport):
+    if report.skipped != None:
+        print(f"Layout skipped: {report.skipped}")
+        return
+    print(f"Moved {report.moved_chunks} chunk(s), removed {report.removed_jumps} jump(s), shortened "
+          f"{report.fast_jumps} to .fastjump, moved {report.trimmed_bytes} zeroed byte(s) past the image: "
+          f"{report.saved_bytes} byte(s) saved")
+
+
+def print_macro_summary(compiler: Compiler):
+    chosen = [(macro, variant, stats) for (macro, variant), stats in compiler.macro_stats.items() if variant != ""]
+    if not chosen:
+        return
+    print("Macro expansions:")
+    for macro, variant, stats in chosen:
+        print(f"  - .{macro} ({variant}): {stats.uses} use(s), {stats.bytes} byte(s), ~{stats.cycles} cycle(s)")
+
+
+def print_cache_summary(cache: BuildCache|None):
+    if cache == None:
+        return
+    print(f"Build cache: {cache.hits} hit(s), {cache.misses} miss(es), {cache.evictions} eviction(s)")
+
+
+def print_build_result(result: BuildResult, rebuilt: bool = True):
+    if result.error != None:
+        print(f"  - {result.source}: failed")
+        print("    " + result.error.replace("\n", "\n    "))
+        return
+    if not rebuilt:
+        print(f"  - {result.source} -> {result.output}: up to date")
+        return
+    cached = " (cached)" if result.cache_hit else ""
+    print(f"  - {result.source} -> {result.output}: {result.size} byte(s), "
+          f"compile {result.compile_time * 1000:.1f} ms{cached}, link {result.link_time * 1000:.1f} ms")
+
+
+def compile_unit(filepath: str, opt_level: str, entry: bool, cache: BuildCache|None, profiler: Profiler|None = None):
+    if cache == None:
+        return compile_file(filepath, opt_level, entry, None, profiler)
+    return cache.compile_file(filepath, opt_level, entry, None, profiler)
+
+
+def optional_phase(profiler: Profiler|None, phase: str):
+    return profiler.phase(phase) if profiler != None else contextlib.nullcontext()
+
+
+def write_stats(stats: dict, stats_format: str, stats_file: str|None):
+    text = format_stats(stats, stats_format)
+    if stats_file == None:
+        print(text)
+        return
+    with open(stats_file, "w") as file:
+        file.write(text + "\n")
+
+
+def add_stats_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--stats", action="store_true",
+                        help="report time per phase, node counts, macro expansion ratios, symbol table sizes and "
+                             "peak memory")
+    parser.add_argument("--stats-format", default=None, choices=["text", "json"],
+                        help="format of the --stats report, implying --stats (default: text)")
+    parser.add_argument("--stats-file", default=None, help="write the --stats report to this file instead of stdout")
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--profile", action="store_true",
+                        help="count the instructions executed and report the hottest source lines, labels and "
+                             "macros to stderr")
+    parser.add_argument("--profile-format", default=None, choices=["text", "json"],
+                        help="format of the --profile report, implying --profile (default: text)")
+    parser.add_argument("--profile-file", default=None, help="write the --profile report to this file instead")
+    parser.add_argument("--sample", type=int, default=None, metavar="N",
+                        help="profile by sampling about every N steps instead of counting every instruction")
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP,
+                        help=f"number of source lines in the --profile report (default: {DEFAULT_TOP})")
+    parser.add_argument("--collapsed", default=None, metavar="FILE",
+                        help="write the profile as collapsed stacks for flamegraph tools to FILE")
+
+
+def write_profile(profile: ExecutionProfile, options: argparse.Namespace):
+    if options.collapsed != None:
+        with open(options.collapsed, "w") as file:
+            file.writelines(line + "\n" for line in profile.collapsed())
+    if options.profile_format == None:
+        return
+    text = format_profile(profile.report(options.top), options.profile_format)
+    if options.profile_file == None:
+        print(text, file=sys.stderr)
+        return
+    with open(options.profile_file, "w") as file:
+        file.write(text + "\n")
+
+
+def add_cache_argument(parser: argparse.ArgumentParser):
+    parser.add_argument("--no-cache", dest="cache", action="store_false",
+                        help="always recompile instead of reusing results from .hackasm_cache/")
+
+
+def add_prune_argument(parser: argparse.ArgumentParser):
+    parser.add_argument("--prune", action="store_true",
+                        help="drop data and routines no label reference reaches and merge duplicate strings "
+                             "before linking")
+
+
+def add_layout_argument(parser: argparse.ArgumentParser):
+    parser.add_argument("--layout", action="store_true",
+                        help="rearrange routines and data to drop jumps, fill the gaps .pad leaves in the last "
+                             "unit and shrink the image before linking, and print the memory map")
+
+
+def add_map_argument(parser: argparse.ArgumentParser):
+    parser.add_argument("--map", dest="map_file", default=None,
+                        help="also write the address of every label to this file, for hackasm disasm --symbols")
+
+
+def add_opt_level_argument(parser: argparse.ArgumentParser, default: str|None = "0"):
+    parser.set_defaults(opt_level=default)
+    parser.add_argument("-O", dest="opt_level", action="store_const", const="1", help="run the peephole optimizer")
+    parser.add_argument("-O2", dest="opt_level", action="store_const", const="2",
+                        help="also pick the fastest macro expansions")
+    parser.add_argument("-Os", dest="opt_level", action="store_const", const="s",
+                        help="also pick the smallest macro expansions")
+
+
+def main(filepath: str, opt_level: str = "0", object_only: bool = False, output: str|None = None,
+         use_cache: bool = True, use_prune: bool = False, stats_format: str|None = None, stats_file: str|None = None,
+         map_file: str|None = None, use_layout: bool = False):
+    cache = BuildCache() if use_cache else None
+    profiler = Profiler() if stats_format != None else None
+    try:
+        print('Compiling...')
+        compiler = compile_unit(filepath, opt_level, not object_only, cache, profiler)
+        if profiler != None:
+            profiler.compiled(compiler)
+        if opt_level != "0":
+            print('Optimizing...')
+            with optional_phase(profiler, "optimize"):
+                report = optimize(compiler)
+            print_optimization_summary(report)
+        if compiler.expansion_mode != "default":
+            print_macro_summary(compiler)
+        if object_only:
+            output = output or os.path.splitext(filepath)[0] + ".hobj"
+            save_object(compiler, output)
+            print(f"Object written to {output}")
+            print_cache_summary(cache)
+            return 0
+        print('Linking...')
+        pruned = None
+        if use_prune:
+            with optional_phase(profiler, "prune"):
+                pruned = prune([compiler])
+            print_prune_summary(pruned)
+        if use_layout:
+            with optional_phase(profiler, "layout"):
+                planned = plan_layout([compiler])
+            print_layout_summary(planned)
+        linked_code = link(compiler, profiler)
+        print_link_summary(compiler, pruned)
+        if use_layout:
+            print(format_memory_map(memory_map([compiler]), len(linked_code)))
+        print_cache_summary(cache)
+        with optional_phase(profiler, "hex"):
+            hex_string = linked_code_to_hex_string(linked_code)
+        with optional_phase(profiler, "write"):
+            save(hex_string, output or "vm_asm_out.txt")
+        if map_file != None:
+            save_symbol_map({label: address for label, address in compiler.labels.items()
+                             if label not in compiler.local_labels}, map_file)
+        if profiler != None:
+            write_stats(profiler.report(compiler, len(linked_code)), stats_format, stats_file)
+        return 0
+    except AsmError as e:
+        print(e)
+        return e.exit_code
+    except OSError as e:
+        print(f"ERROR: {e}")
+        return -2
+
+
+def link_main(args: list[str]):
+    parser = argparse.ArgumentParser(prog="hackasm link", description="Link object files produced with -c into a program")
+    parser.add_argument("objects", nargs="+")
+    parser.add_argument("-o", dest="output", default="vm_asm_out.txt", help="output file (default: vm_asm_out.txt)")
+    add_prune_argument(parser)
+    add_layout_argument(parser)
+    add_map_argument(parser)
+    options = parser.parse_args(args)
+
+    try:
+        objects = [load_object(path) for path in options.objects]
+    except (OSError, ObjectFormatError) as e:
+        print(f"ERROR: {e}")
+        return -2
+
+    try:
+        print('Linking...')
+        units = [Compiler()] + objects
+        pruned = None
+        if options.prune:
+            pruned = prune(units)
+            print_prune_summary(pruned)
+        if options.layout:
+            print_layout_summary(plan_layout(units))
+        linker = Linker(units)
+        linked_code = linker.link()
+        print_link_summary(linker, pruned)
+        if options.layout:
+            print(format_memory_map(memory_map(units, linker.bases), len(linked_code)))
+        save(linked_code_to_hex_string(linked_code), options.output)
+        if options.map_file != None:
+            save_symbol_map(linker.labels(), options.map_file)
+        return 0
+    except AsmError as e:
+        print(e)
+        return e.exit_code
+    except OSError as e:
+        print(f"ERROR: {e}")
+        return -2
+
+
+def run_main(args: list[str]):
+    parser = argparse.ArgumentParser(prog="hackasm run", description="Assemble a program and run it on the built-in VM-O-MATIC emulator")
+    parser.add_argument("file")
+    parser.add_argument("--hex", action="store_true", help="the input is a linked hex image such as vm_asm_out.txt")
+    parser.add_argument("--steps", type=int, default=None, help="stop after executing this many instructions")
+    add_opt_level_argument(parser)
+    add_prune_argument(parser)
+    add_layout_argument(parser)
+    add_cache_argument(parser)
+    add_profile_arguments(parser)
+    options = parser.parse_args(args)
+    if (options.profile or options.profile_file != None) and options.profile_format == None:
+        options.profile_format = "text"
+    profiling = options.profile_format != None or options.collapsed != None
+    if profiling and options.hex:
+        parser.error("profiling needs the source of the program, not a hex image")
+    if options.sample != None and options.sample < 1:
+        parser.error("--sample must be at least 1")
+
+    try:
+        if options.hex:
+            with open(options.file, "r") as file:
+                image = bytes.fromhex(file.read().strip())
+        else:
+            # Cached objects only keep the source lines of rows with operands,
+            # and the profile shows all of them
+            cache = BuildCache() if options.cache and not profiling else None
+            compiler = compile_unit(options.file, options.opt_level, True, cache)
+            if options.opt_level != "0":
+                optimize(compiler)
+            if options.prune:
+                prune([compiler])
+            if options.layout:
+                plan_layout([compiler])
+            image = link(compiler)
+    except AsmError as e:
+        print(e, file=sys.stderr)
+        return e.exit_code
+
+    profile = None
+    error = None
+    try:
+        vm = Vm(image) if options.hex else Vm(image, compiler.instructions)
+        if profiling:
+            profile = ExecutionProfile(compiler)
+        halted = vm.run(options.steps) if profile == None else profile.run(vm, options.steps, options.sample)
+    except VmError as e:
+        error = e
+    sys.stdout.flush()
+    if error != None:
+        print(f"VM ERROR: {error}", file=sys.stderr)
+    # What ran before an error or the step limit is still worth seeing
+    if profile != None:
+        try:
+            write_profile(profile, options)
+        except OSError as e:
+            print(f"ERROR: {e}", file=sys.stderr)
+            return -2
+    if error != None:
+        return -5
+    if not halted:
+        print(f"Step limit reached after {vm.steps} instruction(s)", file=sys.stderr)
+        return 1
+    return 0
+
+
+def analyze_main(args: list[str]):
+    parser = argparse.ArgumentParser(prog="hackasm analyze",
+                                     description="Report the cycles of every basic block and the worst case from "
+                                                 "every label without running the program")
+    parser.add_argument("file")
+    parser.add_argument("--format", default="text", choices=["text", "json"], help="report format (default: text)")
+    parser.add_argument("-o", dest="output", default=None, help="output file (default: stdout)")
+    add_opt_level_argument(parser)
+    add_prune_argument(parser)
+    add_layout_argument(parser)
+    options = parser.parse_args(args)
+
+    try:
+        # The report shows the source of every block, which cached objects
+        # do not keep
+        compiler = compile_unit(options.file, options.opt_level, True, None)
+        if options.opt_level != "0":
+            optimize(compiler)
+        if options.prune:
+            prune([compiler])
+        if options.layout:
+            plan_layout([compiler])
+        image = link(compiler)
+        text = format_analysis(analyze(compiler, image), options.format)
+        with open(options.output, "w") if options.output != None else contextlib.nullcontext(sys.stdout) as file:
+            file.write(text + "\n")
+    except AsmError as e:
+        print(e, file=sys.stderr)
+        return e.exit_code
+    except OSError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        return -2
+    return 0
+
+
+def disasm_main(args: list[str]):
+    parser = argparse.ArgumentParser(prog="hackasm disasm", description="Disassemble a linked image")
+    parser.add_argument("file", help="linked hex image such as vm_asm_out.txt")
+    parser.add_argument("--binary", action="store_true", help="the input is a raw binary dump rather than hex")
+    parser.add_argument("--symbols", default=None, help="symbol map written by --map, to show label names")
+    parser.add_argument("--inst", default=None, metavar="SOURCE",
+                        help="also decode the instructions declared with .inst in this source file")
+    parser.add_argument("-j", dest="jobs", type=int, default=1,
+                        help="number of worker processes for large images (default: 1, 0 for one per CPU)")
+    parser.add_argument("-o", dest="output", default=None, help="output file (default: stdout)")
+    options = parser.parse_args(args)
+    if options.jobs < 0:
+        parser.error("-j must not be negative")
+
+    try:
+        instructions = compile_file(options.inst, "0", False).instructions if options.inst != None else VM_INSTRUCTIONS
+        labels = load_symbol_map(options.symbols) if options.symbols != None else None
+        image = load_image(options.file, options.binary)
+        listing = Disassembler(instructions, labels).disassemble(image, options.jobs or None)
+        with open(options.output, "w") if options.output != None else contextlib.nullcontext(sys.stdout) as file:
+            file.write(listing)
+    except AsmError as e:
+        print(e, file=sys.stderr)
+        return e.exit_code
+    except (OSError, ValueError) as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        return -2
+    return 0
+
+
+def build_main(args: list[str]):
+    parser = argparse.ArgumentParser(prog="hackasm build",
+                                     description="Assemble several programs in parallel, one output per file")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("-o", dest="output", default=".",
+                        help="output directory, <name>.asm is written to <name>.txt (default: .)")
+    parser.add_argument("-j", dest="jobs", type=int, default=None,
+                        help="number of worker processes (default: one per CPU)")
+    add_opt_level_argument(parser)
+    add_cache_argument(parser)
+    options = parser.parse_args(args)
+    if options.jobs != None and options.jobs < 1:
+        parser.error("-j must be at least 1")
+
+    print(f"Building {len(options.files)} file(s)...")
+    start = time.perf_counter()
+    try:
+        results = build(options.files, options.output, options.opt_level, options.jobs, options.cache)
+    except (OSError, ValueError) as e:
+        print(f"ERROR: {e}")
+        return -2
+    elapsed = time.perf_counter() - start
+
+    exit_code = 0
+    for result in results:
+        print_build_result(result)
+        exit_code = exit_code or result.exit_code
+    built = sum(1 for result in results if result.error == None)
+    compile_time = sum(result.compile_time for result in results)
+    link_time = sum(result.link_time for result in results)
+    print(f"Built {built} of {len(results)} file(s) in {elapsed * 1000:.1f} ms "
+          f"(compile {compile_time * 1000:.1f} ms, link {link_time * 1000:.1f} ms across jobs)")
+    return exit_code
+
+
+def watch_main(args: list[str]):
+    parser = argparse.ArgumentParser(prog="hackasm watch",
+                                     description="Keep programs assembled as they change, and serve build requests")
+    parser.add_argument("files", nargs="*")
+    parser.add_argument("-o", dest="output", default=".",
+                        help="output directory, <name>.asm is written to <name>.txt (default: .)")
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL,
+                        help=f"seconds between checks for changed files (default: {DEFAULT_INTERVAL})")
+    parser.add_argument("--socket", default=None,
+                        help="also accept build requests (see hackasm request) on this Unix socket")
+    add_opt_level_argument(parser)
+    add_cache_argument(parser)
+    options = parser.parse_args(args)
+    if not options.files and options.socket == None:
+        parser.error("nothing to do: give files to watch, --socket, or both")
+
+    def on_build(result: BuildResult):
+        print_build_result(result)
+        sys.stdout.flush()
+
+    watcher = Watcher(options.opt_level, options.cache)
+    daemon = Daemon(watcher, options.socket, options.output, options.interval, on_build)
+    try:
+        watcher.watch(options.files, options.output)
+        listening = f", listening on {options.socket}" if options.socket != None else ""
+        print(f"Watching {len(options.files)} file(s){listening} (Ctrl+C to stop)...", flush=True)
+        # Stopping the daemon removes its socket
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        daemon.serve_forever()
+    except (OSError, ValueError) as e:
+        print(f"ERROR: {e}")
+        return -2
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def request_main(args: list[str]):
+    parser = argparse.ArgumentParser(prog="hackasm request",
+                                     description="Ask a running hackasm watch --socket daemon to assemble a file")
+    parser.add_argument("file")
+    parser.add_argument("--socket", required=True)
+    parser.add_argument("-o", dest="output", default=None,
+                        help="output file (default: <name>.txt in the daemon's output directory)")
+    # Without any of them, the daemon's optimization level is used
+    add_opt_level_argument(parser, None)
+    options = parser.parse_args(args)
+    try:
+        response = request(options.socket, options.file, options.output, options.opt_level)
+    except (OSError, ValueError) as e:
+        print(f"ERROR: {e}")
+        return -2
+    if response.get("source") == None:
+        print(response["error"])
+        return response["exit_code"]
+    result = BuildResult(response["source"], response["output"])
+    result.size = response["size"]
+    result.compile_time = response["compile_ms"] / 1000
+    result.link_time = response["link_ms"] / 1000
+    result.cache_hit = response["cache_hit"]
+    result.error = response["error"]
+    result.exit_code = response["exit_code"]
+    print_build_result(result, not response["up_to_date"])
+    return result.exit_code
+
+
+def lsp_main(args: list[str]):
+    parser = argparse.ArgumentParser(prog="hackasm lsp",
+                                     description="Run a language server on stdin/stdout, for use from an editor")
+    add_opt_level_argument(parser)
+    options = parser.parse_args(args)
+    return serve(sys.stdin.buffer, sys.stdout.buffer, options.opt_level)
+
+
+COMMANDS = {
+    "run": run_main,
+    "link": link_main,
+    "analyze": analyze_main,
+    "disasm": disasm_main,
+    "build": build_main,
+    "watch": watch_main,
+    "request": request_main,
+    "lsp": lsp_main,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] in COMMANDS:
+        exit(COMMANDS[sys.argv[1]](sys.argv[2:]))
+
+    parser = argparse.ArgumentParser(prog="hackasm", description="Assembler for VM-O-MATIC",
+                                     epilog=f"commands: {', '.join(COMMANDS)} (see hackasm <command> --help)")
+    parser.add_argument("file")
+    add_opt_level_argument(parser)
+    parser.add_argument("-c", dest="object_only", action="store_true",
+                        help="compile to an object file for hackasm link instead of linking")
+    parser.add_argument("-o", dest="output", default=None,
+                        help="output file (default: vm_asm_out.txt, or <input>.hobj with -c)")
+    add_prune_argument(parser)
+    add_layout_argument(parser)
+    add_cache_argument(parser)
+    add_stats_arguments(parser)
+    add_map_argument(parser)
+    options = parser.parse_args()
+    if (options.stats or options.stats_file != None) and options.stats_format == None:
+        options.stats_format = "text"
+    exit(main(options.file, options.opt_level, options.object_only, options.output, options.cache, options.prune,
+              options.stats_format, options.stats_file, options.map_file, options.layout))
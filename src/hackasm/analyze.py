@@ -0,0 +1,444 @@
+import json
+from bisect import bisect_right
+
+from .assembler import Compiler
+from .optimizer import ABSOLUTE_JUMPS, JUMP_CONDITIONS, KNOWN, RELATIVE_JUMPS, WRITES_X, WRITES_Y
+from .vm import MEMORY_SIZE
+from .vmprofile import ENTRY_FRAME
+
+
+# Flags a compare can leave behind, as (equal, less, greater)
+EQUAL = (True, False, False)
+LESS = (False, True, False)
+GREATER = (False, False, True)
+CLEARED = (False, False, False)
+# Ways a path can leave the code: RET and running off the end of the image
+# stop the VM, anything else jumps or falls into bytes that are not code
+EXIT_RET = "ret"
+EXIT_HALT = "halt"
+EXIT_UNKNOWN = "unknown"
+NO_PATH = float("-inf")
+
+
+# Flags after comparing a register with value, all of the possible ones if
+# the register is not known. Registers hold a byte
+def compare_flags(register: int|None, value: int):
+    if register != None:
+        return {(register == value, register < value, register > value)}
+    flags = set()
+    if value <= 0xFF:
+        flags.add(EQUAL)
+    if value > 0:
+        flags.add(LESS)
+    if value < 0xFF:
+        flags.add(GREATER)
+    return flags
+
+
+class BasicBlock:
+    __slots__ = ("index", "start", "end", "rows", "cycles", "successors", "exits")
+
+    def __init__(self, index: int, start: int) -> None:
+        self.index = index
+        self.start = start
+        self.end = start
+        self.rows: list[int] = []
+        self.cycles = 0
+        # Indices of the blocks control can go to next
+        self.successors: list[int] = []
+        self.exits: set[str] = set()
+
+
+# Worst-case cycles from every block reachable from roots. Back edges are
+# found by a depth-first search from the roots in order; each one closes a
+# loop on the block it jumps back to (its header), which needs a .bound on
+# one of its labels. A bound of n lets the header run n times per entry
+# into the loop, every run but the last costing the worst path around the
+# loop, inner loops included. Paths end at RET, at the end of the image or
+# at code that cannot be followed
+class WorstCase:
+    def __init__(self, analysis: "TimingAnalysis", roots: list[int]) -> None:
+        blocks = analysis.blocks
+        state = [0] * len(blocks)
+        self.order: list[int] = []
+        # header -> blocks jumping back to it
+        self.sources: dict[int, list[int]] = {}
+        back_edges = set()
+        for root in roots:
+            if state[root] != 0:
+                continue
+            state[root] = 1
+            stack = [(root, iter(blocks[root].successors))]
+            while stack:
+                node, successors = stack[-1]
+                for successor in successors:
+                    if state[successor] == 0:
+                        state[successor] = 1
+                        stack.append((successor, iter(blocks[successor].successors)))
+                        break
+                    if state[successor] == 1:
+                        self.sources.setdefault(successor, []).append(node)
+                        back_edges.add((node, successor))
+                else:
+                    state[node] = 2
+                    self.order.append(node)
+                    stack.pop()
+
+        # Without the back edges the graph is acyclic, and the search
+        # finished every block after the blocks it leads to
+        self.forward = {node: [successor for successor in blocks[node].successors
+                               if (node, successor) not in back_edges] for node in self.order}
+        predecessors: dict[int, list[int]] = {node: [] for node in self.order}
+        for node, successors in self.forward.items():
+            for successor in successors:
+                predecessors[successor].append(node)
+        position = {node: index for index, node in enumerate(self.order)}
+
+        self.bounds: dict[int, int|None] = {}
+        self.iterations: dict[int, int] = {}
+        self.bodies: dict[int, set[int]] = {}
+        self.weight: dict[int, float] = {}
+        self.longest: dict[int, float] = {}
+        self.choice: dict[int, int|None] = {}
+        # A header without a bound and a block with an unknown exit reachable
+        # from each block, if any
+        self.unbounded: dict[int, int|None] = {}
+        self.unknown: dict[int, int|None] = {}
+        for node in self.order:
+            block = blocks[node]
+            weight = block.cycles
+            unbounded = None
+            if node in self.sources:
+                body = self.body(node, predecessors, position)
+                self.bodies[node] = body
+                iteration = self.iteration(node, body, position, blocks)
+                self.iterations[node] = iteration
+                bound = self.bounds[node] = analysis.bound(block.start)
+                if bound == None:
+                    unbounded = node
+                else:
+                    weight += (bound - 1) * iteration
+            self.weight[node] = weight
+
+            best = 0 if block.exits else NO_PATH
+            choice = None
+            unknown = node if EXIT_UNKNOWN in block.exits else None
+            for successor in self.forward[node]:
+                if self.longest[successor] > best:
+                    best, choice = self.longest[successor], successor
+                unbounded = unbounded if unbounded != None else self.unbounded[successor]
+                unknown = unknown if unknown != None else self.unknown[successor]
+            self.longest[node] = weight + best if best != NO_PATH else NO_PATH
+            self.choice[node] = choice
+            self.unbounded[node] = unbounded
+            self.unknown[node] = unknown
+
+    # Blocks of the loop closed by the back edges to header: those that reach
+    # one of the edges without going through the header, of those the search
+    # finished before it (others can only jump into the middle of the loop)
+    def body(self, header: int, predecessors: dict[int, list[int]], position: dict[int, int]):
+        body = {header}
+        pending = [source for source in self.sources[header] if source != header]
+        body.update(pending)
+        while pending:
+            for predecessor in predecessors[pending.pop()]:
+                if predecessor not in body and position[predecessor] < position[header]:
+                    body.add(predecessor)
+                    pending.append(predecessor)
+        return body
+
+    # Worst cycles from the header around the loop and back, counting inner
+    # loops in full
+    def iteration(self, header: int, body: set[int], position: dict[int, int], blocks: list[BasicBlock]):
+        sources = set(self.sources[header])
+        cycles: dict[int, float] = {}
+        for node in sorted(body, key=position.__getitem__):
+            best = 0 if node in sources else NO_PATH
+            for successor in self.forward[node]:
+                if successor in cycles and cycles[successor] > best:
+                    best = cycles[successor]
+            weight = blocks[node].cycles if node == header else self.weight[node]
+            cycles[node] = weight + best if best != NO_PATH else NO_PATH
+        return int(cycles[header])
+
+    # Blocks of the worst path from node, loops standing for all their runs
+    def path(self, node: int):
+        path = []
+        while node != None:
+            path.append(node)
+            node = self.choice[node]
+        return path
+
+
+# Static timing of a linked program: splits the code into basic blocks at
+# labels, jump targets and after jumps, takes the successors of each block
+# from the jumps as linked and works out the worst-case cycles from every
+# label. Jumps the flags set in their block decide (such as .jump and
+# .fastjump) only go one way. The compiler must be the one the image was
+# linked from, after optimizing, pruning and layout
+class TimingAnalysis:
+    def __init__(self, compiler: Compiler, image: bytes) -> None:
+        self.compiler = compiler
+        self.image = image
+        code = compiler.result
+        names = {info: mnemonic for mnemonic, info in compiler.instructions.items()}
+        self.mnemonics = [names.get(info) for info in code.instructions]
+
+        # address -> row of the instruction starting there
+        self.rows: dict[int, int] = {}
+        for row in range(len(code)):
+            info = code.instructions[code.inst[row]]
+            address = code.offset[row]
+            if info.opcode_byte == None or address + 1 + info.argsize > len(image) \
+                    or image[address] != info.opcode_byte:
+                continue
+            self.rows.setdefault(address, row)
+        self.entry_rows = set()
+        if len(code) >= 2 and code.lineno[0] == 0 and code.lineno[1] == 0 and \
+                code.operands[code.operand[1]] == "_main":
+            self.entry_rows = {0, 1}
+
+        # Labels as the starts of address ranges, the way the profiler names
+        # them, and every label at each address for looking up bounds
+        self.labels_at: dict[int, list[str]] = {}
+        starts: dict[int, str] = {}
+        for label, address in compiler.labels.items():
+            self.labels_at.setdefault(address, []).append(label)
+            if label not in compiler.local_labels:
+                starts[address] = label
+        self.label_starts = sorted(starts)
+        self.label_names = [starts[address] for address in self.label_starts]
+
+        self.blocks: list[BasicBlock] = []
+        # start address -> block index
+        self.starts: dict[int, int] = {}
+        self.split()
+        self.connect()
+
+    def mnemonic(self, row: int):
+        return self.mnemonics[self.compiler.result.inst[row]]
+
+    # The operand of the instruction at row as linked, relative jumps turned
+    # into their targets
+    def operand(self, row: int):
+        code = self.compiler.result
+        address = code.offset[row]
+        info = code.instructions[code.inst[row]]
+        value = int.from_bytes(self.image[address + 1:address + 1 + info.argsize], byteorder="big")
+        if self.mnemonic(row) in RELATIVE_JUMPS:
+            if value >= 0x8000:
+                value -= 0x10000
+            value = (address + value) % MEMORY_SIZE
+        return value
+
+    def is_jump(self, row: int):
+        mnemonic = self.mnemonic(row)
+        return mnemonic in ABSOLUTE_JUMPS or mnemonic in RELATIVE_JUMPS
+
+    def split(self):
+        code = self.compiler.result
+        leaders = set(self.labels_at)
+        for address, row in self.rows.items():
+            if self.is_jump(row):
+                leaders.add(self.operand(row))
+            if self.is_jump(row) or self.mnemonic(row) == "RET":
+                leaders.add(address + 1 + code.instructions[code.inst[row]].argsize)
+
+        block = None
+        for address in sorted(self.rows):
+            row = self.rows[address]
+            if block == None or address in leaders or address != block.end:
+                block = BasicBlock(len(self.blocks), address)
+                self.blocks.append(block)
+                self.starts[address] = block.index
+            info = code.instructions[code.inst[row]]
+            block.rows.append(row)
+            block.end = address + 1 + info.argsize
+            block.cycles += info.cycles
+            if self.is_jump(row) or self.mnemonic(row) == "RET":
+                block = None
+
+    def connect(self):
+        for block in self.blocks:
+            last = block.rows[-1]
+            if self.mnemonic(last) == "RET":
+                block.exits.add(EXIT_RET)
+                continue
+            taken = self.taken(block) if self.is_jump(last) else {False}
+            if True in taken:
+                self.add_edge(block, self.operand(last))
+            if False in taken:
+                self.add_edge(block, block.end)
+
+    def add_edge(self, block: BasicBlock, address: int):
+        if address in self.starts:
+            if self.starts[address] not in block.successors:
+                block.successors.append(self.starts[address])
+        elif address >= len(self.image):
+            block.exits.add(EXIT_HALT)
+        else:
+            block.exits.add(EXIT_UNKNOWN)
+
+    # Whether the jump ending block can be taken (True), not taken (False)
+    # or both, from what the instructions before it leave in X, Y and the
+    # flags. Nothing is known at the start of a block
+    def taken(self, block: BasicBlock):
+        if block.rows[-1] in self.entry_rows:
+            return {True}
+        x = y = flags = None
+        for row in block.rows[:-1]:
+            mnemonic = self.mnemonic(row)
+            value = self.operand(row) if self.compiler.result.instructions[
+                self.compiler.result.inst[row]].hasarg else None
+            if mnemonic in ("CMPX", "CMPY"):
+                flags = compare_flags(x if mnemonic == "CMPX" else y, value)
+                continue
+            if mnemonic == "CLD":
+                flags = {CLEARED}
+                continue
+            if mnemonic not in KNOWN:
+                x = y = flags = None
+                continue
+            if mnemonic in WRITES_X:
+                if mnemonic == "LDX":
+                    x = value
+                elif mnemonic in ("ADDX", "DECX") and x != None:
+                    x = (x + value if mnemonic == "ADDX" else x - value) & 0xFF
+                else:
+                    x = None
+            if mnemonic in WRITES_Y:
+                y = value if mnemonic == "LDY" else None
+        if flags == None:
+            return {True, False}
+        condition = JUMP_CONDITIONS[self.mnemonic(block.rows[-1])]
+        return {condition(*possible) for possible in flags}
+
+    # The smallest .bound given for a label at address, None if there is none
+    def bound(self, address: int):
+        bounds = [self.compiler.loop_bounds[label] for label in self.labels_at.get(address, [])
+                  if label in self.compiler.loop_bounds]
+        return min(bounds) if bounds else None
+
+    def label(self, address: int):
+        index = bisect_right(self.label_starts, address) - 1
+        return self.label_names[index] if index >= 0 else ENTRY_FRAME
+
+    def line(self, block: BasicBlock):
+        return self.compiler.result.lineno[block.rows[0]]
+
+    def location(self, block: BasicBlock):
+        if block.rows[0] in self.entry_rows:
+            return ENTRY_FRAME
+        return self.compiler.source_location(self.line(block))
+
+    def source(self, block: BasicBlock):
+        if block.rows[0] in self.entry_rows:
+            return ""
+        return self.compiler.lines[self.line(block)].strip()
+
+    def describe(self, block: BasicBlock):
+        return f"{self.location(block)} ({self.label(block.start)})"
+
+    def report(self):
+        blocks = self.blocks
+        roots = [self.starts[0]] if 0 in self.starts else []
+        roots += [self.starts[address] for address in sorted(self.labels_at) if address in self.starts]
+        roots += range(len(blocks))
+        solution = WorstCase(self, roots)
+        # Labels inside a loop body are entered past its header, so their
+        # paths are searched again starting from them
+        inner = set()
+        for header, body in solution.bodies.items():
+            inner.update(body - {header})
+
+        labels = {}
+        for label, address in self.compiler.labels.items():
+            if label in self.compiler.local_labels or address not in self.starts:
+                continue
+            node = self.starts[address]
+            worst = solution if node not in inner else WorstCase(self, [node])
+            labels[label] = self.worst_case(worst, node)
+
+        loops = []
+        headers = set()
+        for header in sorted(solution.sources):
+            block = blocks[header]
+            headers.update(self.labels_at.get(block.start, []))
+            loops.append({
+                "address": block.start,
+                "location": self.location(block),
+                "label": self.label(block.start),
+                "bound": solution.bounds[header],
+                "iteration_cycles": solution.iterations[header],
+            })
+
+        return {
+            "blocks": [{
+                "start": block.start,
+                "end": block.end,
+                "cycles": block.cycles,
+                "location": self.location(block),
+                "line": self.line(block),
+                "source": self.source(block),
+                "label": self.label(block.start),
+                "successors": [blocks[successor].start for successor in block.successors],
+                "exits": sorted(block.exits),
+            } for block in blocks],
+            "loops": loops,
+            "labels": labels,
+            # Bounds on labels that head no loop, likely on the wrong label
+            "unused_bounds": sorted(label for label in self.compiler.loop_bounds if label not in headers),
+        }
+
+    def worst_case(self, worst: WorstCase, node: int):
+        blocks = self.blocks
+        entry = {"address": blocks[node].start, "location": self.location(blocks[node]), "cycles": None}
+        if worst.unbounded[node] != None:
+            entry["error"] = f"loop at {self.describe(blocks[worst.unbounded[node]])} has no .bound"
+        elif worst.unknown[node] != None:
+            entry["error"] = f"cannot follow control flow after {self.describe(blocks[worst.unknown[node]])}"
+        elif worst.longest[node] == NO_PATH:
+            entry["error"] = "never halts"
+        else:
+            entry["cycles"] = int(worst.longest[node])
+            entry["path"] = [{
+                "address": blocks[step].start,
+                "location": self.location(blocks[step]),
+                "cycles": int(worst.weight[step]),
+                "runs": worst.bounds.get(step) or 1,
+            } for step in worst.path(node)]
+        return entry
+
+
+def analyze(compiler: Compiler, image: bytes):
+    return TimingAnalysis(compiler, image).report()
+
+
+def format_analysis(analysis: dict, format: str = "text"):
+    if format == "json":
+        return json.dumps(analysis, indent=2)
+
+    lines = [f"Static timing: {len(analysis['blocks'])} basic block(s), {len(analysis['loops'])} loop(s)"]
+    lines.append("  Worst case per label:")
+    for label, entry in analysis["labels"].items():
+        if entry["cycles"] == None:
+            lines.append(f"    {'-':>10}  {label} ({entry['location']}): {entry['error']}")
+            continue
+        lines.append(f"    {entry['cycles']:>10}  {label} ({entry['location']})")
+        path = " -> ".join(step["location"] + (f" (loop x{step['runs']})" if step["runs"] != 1 else "")
+                           for step in entry["path"])
+        lines.append(f"                path: {path}")
+    if analysis["loops"]:
+        lines.append("  Loops:")
+        for loop in analysis["loops"]:
+            bound = f"bound {loop['bound']}" if loop["bound"] != None else "no .bound"
+            lines.append(f"    {loop['address']:#06x}  {loop['location']} ({loop['label']}): {bound}, "
+                         f"{loop['iteration_cycles']} cycle(s) per run")
+    lines.append("  Basic blocks:")
+    for block in analysis["blocks"]:
+        successors = [f"{address:#06x}" for address in block["successors"]] + block["exits"]
+        lines.append(f"    {block['start']:#06x}-{block['end'] - 1:#06x} {block['cycles']:>6}  "
+                     f"{block['location']}\t{block['source']}  -> {', '.join(successors)}")
+    if analysis["unused_bounds"]:
+        lines.append(f"  .bound on label(s) heading no loop: {', '.join(analysis['unused_bounds'])}")
+    return "\n".join(lines)
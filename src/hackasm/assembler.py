@@ -0,0 +1,1664 @@
+import os
+import re
+import math
+import mmap
+from array import array
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Iterable
+
+
+def to_linked_repr(value: str, must_be_hex=False):
+    if isinstance(value, int):
+        return False, value, (str(value) if not must_be_hex else hex(value).replace("0x", "").upper())
+
+    if value.startswith("0x"):
+        return True, int(value, 16), value.replace("0x", "").upper()
+
+    if value.startswith("0b"):
+        return True, int(value, 2), hex(int(value, 2)).replace("0x", "").upper()
+
+    if value.isdecimal():
+        return True, int(value), hex(int(value)).replace("0x", "").upper()
+
+    return False, value, value
+
+
+ASSEMBLER_VERSION = "0.2.0"
+
+
+def parse_int_literal(value: str):
+    try:
+        if value.startswith("0x"):
+            return int(value, 16)
+        if value.startswith("0b"):
+            return int(value, 2)
+    except ValueError:
+        return None
+    if value.isdecimal():
+        return int(value)
+    return None
+
+
+class ExpressionError(Exception):
+    pass
+
+
+# Binary operators of operand expressions, loosest binding first. |0 and |1
+# are not operators but byte selectors (high and low byte of what they follow),
+# binding tighter than anything else, so a|1 is the low byte of a and a bitwise
+# or with 0 or 1 is written a|(1)
+BINARY_OPERATORS = (("|",), ("&",), ("<<", ">>"), ("+", "-"), ("*", "/"))
+BYTE_SELECTORS = {"0": "hi", "1": "lo"}
+EXPRESSION_FUNCTIONS = ("lo", "hi")
+# Operators, then runs of anything else as numbers or names
+EXPRESSION_TOKEN = re.compile(r"<<|>>|[-+*/&|()<>]|[^-+*/&|()<>]+")
+EXPRESSION_OPERATORS = {"<<", ">>", "-", "+", "*", "/", "&", "|", "(", ")", "<", ">"}
+
+
+def divide(left: int, right: int):
+    if right == 0:
+        raise ExpressionError("Division by zero")
+    return left // right
+
+
+def shift(left: int, right: int, operator: str):
+    if not 0 <= right <= 64:
+        raise ExpressionError(f"Shift by {right} out of range")
+    return left << right if operator == "<<" else left >> right
+
+
+OPERATIONS = {
+    "+": lambda left, right: left + right,
+    "-": lambda left, right: left - right,
+    "*": lambda left, right: left * right,
+    "/": divide,
+    "<<": lambda left, right: shift(left, right, "<<"),
+    ">>": lambda left, right: shift(left, right, ">>"),
+    "&": lambda left, right: left & right,
+    "|": lambda left, right: left | right,
+    "neg": lambda value: -value,
+    "hi": lambda value: (value >> 8) & 0xFF,
+    "lo": lambda value: value & 0xFF,
+}
+
+
+# Builds the tree of an operand expression: ints for literals, strs for
+# symbol and label names, and (operation, operand...) tuples. Operations on
+# literals alone are folded right away
+class ExpressionParser:
+    def __init__(self, text: str) -> None:
+        # Two Nones mark the end, so looking ahead never runs off the list
+        self.tokens = EXPRESSION_TOKEN.findall(text) + [None, None]
+        self.position = 0
+        # Names in the order they appear, as dict keys
+        self.names: dict[str, None] = {}
+
+    def take(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def parse(self):
+        # Most operands are a name or number, maybe with a byte selector, and
+        # need none of the binary operator levels
+        if len(self.tokens) <= 5:
+            tree = self.unary()
+            if self.tokens[self.position] == None:
+                return tree
+            self.position = 0
+        tree = self.binary(0)
+        if self.tokens[self.position] != None:
+            raise ExpressionError(f"Unexpected '{self.tokens[self.position]}' in expression")
+        return tree
+
+    def binary(self, level: int):
+        if level == len(BINARY_OPERATORS):
+            return self.unary()
+        tree = self.binary(level + 1)
+        while self.tokens[self.position] in BINARY_OPERATORS[level]:
+            operator = self.take()
+            tree = fold(operator, tree, self.binary(level + 1))
+        return tree
+
+    def unary(self):
+        if self.tokens[self.position] == "-":
+            self.position += 1
+            return fold("neg", self.unary())
+        tree = self.primary()
+        tokens = self.tokens
+        while tokens[self.position] == "|" and tokens[self.position + 1] in BYTE_SELECTORS:
+            tree = fold(BYTE_SELECTORS[tokens[self.position + 1]], tree)
+            self.position += 2
+        return tree
+
+    def primary(self):
+        token = self.take()
+        if token == None:
+            raise ExpressionError("Incomplete expression")
+        if token == "(":
+            tree = self.binary(0)
+            if self.take() != ")":
+                raise ExpressionError("Expected ')'")
+            return tree
+        if token in EXPRESSION_OPERATORS:
+            raise ExpressionError(f"Unexpected '{token}' in expression")
+        if token[0].isdigit():
+            value = parse_int_literal(token)
+            if value == None:
+                raise ExpressionError(f"Invalid number '{token}'")
+            return value
+        if self.tokens[self.position] == "(" and token.lower() in EXPRESSION_FUNCTIONS:
+            self.position += 1
+            tree = self.binary(0)
+            if self.take() != ")":
+                raise ExpressionError("Expected ')'")
+            return fold(token.lower(), tree)
+        self.names[token] = None
+        return token
+
+
+def fold(operation: str, *operands):
+    for operand in operands:
+        if not isinstance(operand, int):
+            return (operation, *operands)
+    return OPERATIONS[operation](*operands)
+
+
+# lookup returns the value of a name, or None to make the whole expression
+# None. Raises ExpressionError for arithmetic errors
+def evaluate(tree, lookup):
+    if isinstance(tree, int):
+        return tree
+    if isinstance(tree, str):
+        return lookup(tree)
+    operands = []
+    for operand in tree[1:]:
+        value = evaluate(operand, lookup)
+        if value == None:
+            return None
+        operands.append(value)
+    return OPERATIONS[tree[0]](*operands)
+
+
+# Operand in the Hackasm Linker Directive Language, parsed once at compile time
+# into a tree that is evaluated once labels are placed. names are the symbols
+# and labels it refers to; syntax errors are kept and reported by the linker
+# at the using line
+class OperandExpr:
+    __slots__ = ("text", "tree", "names", "error")
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.error = None
+        self.tree = 0
+        self.names = ()
+        parser = ExpressionParser(text)
+        try:
+            self.tree = parser.parse()
+        except ExpressionError as e:
+            self.error = str(e)
+            return
+        self.names = tuple(parser.names)
+
+    def evaluate(self, lookup):
+        return evaluate(self.tree, lookup)
+
+
+# Parses the values of .set symbols, which are expressions too
+@lru_cache(maxsize=4096)
+def symbol_expression(text: str):
+    return OperandExpr(text)
+
+
+# Wraps an operand in parentheses when a macro appends to it, unless it is a
+# single name or number
+def grouped(operand: str):
+    return operand if EXPRESSION_TOKEN.fullmatch(operand) and operand not in EXPRESSION_OPERATORS \
+        else f"({operand})"
+
+
+# cycles is what the instruction costs in static timing analysis (see
+# analyze.py). Every VM-O-MATIC instruction takes one step
+class VmInstructionInfo:
+    __slots__ = ("opcode", "hasarg", "argsize", "maxarg", "opcode_byte", "cycles")
+
+    def __init__(self, opcode: str, hasarg=True, argsize=1, maxarg=None, cycles=1) -> None:
+        self.opcode = opcode
+        self.hasarg = hasarg
+        self.argsize = argsize
+        self.maxarg = maxarg
+        self.cycles = cycles
+        if self.maxarg == None:
+            self.maxarg = int(math.pow(2, 8 * self.argsize))
+        self.opcode_byte = int(opcode, 16) if opcode != "" else None
+
+
+VM_INSTRUCTIONS = {
+    "CLD": VmInstructionInfo(opcode="40", hasarg=False, argsize=0),
+    "LDX": VmInstructionInfo(opcode="50", hasarg=True, argsize=1),
+    "LDY": VmInstructionInfo(opcode="51", hasarg=True, argsize=1),
+    "STRX": VmInstructionInfo(opcode="52", hasarg=True, argsize=2, maxarg=4096),
+    "STRY": VmInstructionInfo(opcode="53", hasarg=True, argsize=2, maxarg=4096),
+    "LDRX": VmInstructionInfo(opcode="54", hasarg=True, argsize=2, maxarg=4096),
+    "LDRY": VmInstructionInfo(opcode="55", hasarg=True, argsize=2, maxarg=4096),
+    "OUT": VmInstructionInfo(opcode="60", hasarg=False, argsize=0, maxarg=4096),
+    "IN": VmInstructionInfo(opcode="61", hasarg=False, argsize=0),
+    "CMPX": VmInstructionInfo(opcode="70", hasarg=True, argsize=1),
+    "CMPY": VmInstructionInfo(opcode="71", hasarg=True, argsize=1),
+    "JE": VmInstructionInfo(opcode="72", hasarg=True, argsize=2),
+    "JRE": VmInstructionInfo(opcode="73", hasarg=True, argsize=2, maxarg=4096),
+    "JL": VmInstructionInfo(opcode="74", hasarg=True, argsize=2, maxarg=4096),
+    "JRL": VmInstructionInfo(opcode="75", hasarg=True, argsize=2, maxarg=4096),
+    "JLE": VmInstructionInfo(opcode="76", hasarg=True, argsize=2, maxarg=4096),
+    "JRLE": VmInstructionInfo(opcode="77", hasarg=True, argsize=2, maxarg=4096),
+    "JG": VmInstructionInfo(opcode="78", hasarg=True, argsize=2, maxarg=4096),
+    "JRG": VmInstructionInfo(opcode="79", hasarg=True, argsize=2, maxarg=4096),
+    "JGE": VmInstructionInfo(opcode="7A", hasarg=True, argsize=2, maxarg=4096),
+    "JRGE": VmInstructionInfo(opcode="7B", hasarg=True, argsize=2, maxarg=4096),
+    "ADDX": VmInstructionInfo(opcode="A0", hasarg=True, argsize=1),
+    "ADDXY": VmInstructionInfo(opcode="A1", hasarg=False, argsize=0),
+    "DECX": VmInstructionInfo(opcode="A2", hasarg=True, argsize=1),
+    "DECXY": VmInstructionInfo(opcode="A3", hasarg=False, argsize=0),
+    "RORX": VmInstructionInfo(opcode="A4", hasarg=False, argsize=0),
+    "ROLX": VmInstructionInfo(opcode="A5", hasarg=False, argsize=0),
+    "XORX": VmInstructionInfo(opcode="A6", hasarg=False, argsize=0),
+    "PUSHX": VmInstructionInfo(opcode="B0", hasarg=False, argsize=0),
+    "POPX": VmInstructionInfo(opcode="B1", hasarg=False, argsize=0),
+    "PUSHY": VmInstructionInfo(opcode="B2", hasarg=False, argsize=0),
+    "POPY": VmInstructionInfo(opcode="B3", hasarg=False, argsize=0),
+    "RMEMX": VmInstructionInfo(opcode="C0", hasarg=False, argsize=0),
+    "WMEMX": VmInstructionInfo(opcode="C1", hasarg=False, argsize=0),
+    "RMEMY": VmInstructionInfo(opcode="C2", hasarg=False, argsize=0),
+    "WMEMY": VmInstructionInfo(opcode="C3", hasarg=False, argsize=0),
+    "NOP": VmInstructionInfo(opcode="90", hasarg=False, argsize=0),
+    "RET": VmInstructionInfo(opcode="91", hasarg=False, argsize=0)
+}
+
+
+# Pseudo-instructions for DATA section contents: raw bytes stored as a
+# latin-1 operand (one character per byte), single .word values resolved by
+# the linker, runs of zeros stored as their length, and byte ranges of
+# binary files stored as "<offset> <length> <path>". Zeros and binaries are
+# only expanded when the image is written
+VM_DATA = VmInstructionInfo(opcode="", hasarg=False, argsize=0, maxarg=0)
+VM_WORD = VmInstructionInfo(opcode="", hasarg=True, argsize=0, maxarg=int(math.pow(2, 64)))
+VM_ZERO = VmInstructionInfo(opcode="", hasarg=False, argsize=0, maxarg=0)
+VM_BINARY = VmInstructionInfo(opcode="", hasarg=False, argsize=0, maxarg=0)
+
+
+class VmInstructionNode:
+    __slots__ = ("instruction", "argument", "offset", "lineno")
+
+    def __init__(self, instruction: VmInstructionInfo, argument: str|None, offset: int, lineno: int) -> None:
+        self.instruction =instruction
+        self.argument = argument
+        self.offset = offset
+        self.lineno = lineno
+
+
+# Column-oriented node stream: instructions and operands are interned in side
+# tables and each node is a row across the parallel arrays. Iterating yields
+# VmInstructionNode views
+class VmCode:
+    __slots__ = ("instructions", "operands", "expressions", "inst", "offset", "lineno", "operand", "value",
+                 "_instruction_ids", "_operand_ids")
+
+    def __init__(self) -> None:
+        self.instructions: list[VmInstructionInfo] = []
+        self.operands: list[str] = [""]
+        self.expressions: list[OperandExpr|None] = [None]
+        self.inst = array("H")
+        self.offset = array("I")
+        self.lineno = array("I")
+        self.operand = array("I")
+        # Operand values patched in by the linker
+        self.value = array("Q")
+        self._instruction_ids: dict[VmInstructionInfo, int] = {}
+        self._operand_ids: dict[str, int] = {"": 0}
+
+    def __len__(self):
+        return len(self.inst)
+
+    def __getitem__(self, index: int):
+        return VmInstructionNode(self.instructions[self.inst[index]], self.operands[self.operand[index]],
+                                 self.offset[index], self.lineno[index])
+
+    def __iter__(self):
+        for index in range(len(self.inst)):
+            yield self[index]
+
+    def intern_instruction(self, instruction: VmInstructionInfo):
+        inst_id = self._instruction_ids.get(instruction)
+        if inst_id == None:
+            inst_id = len(self.instructions)
+            self.instructions.append(instruction)
+            self._instruction_ids[instruction] = inst_id
+        return inst_id
+
+    def intern_operand(self, argument: str, parse: bool):
+        operand_id = self._operand_ids.get(argument)
+        if operand_id == None:
+            operand_id = len(self.operands)
+            self.operands.append(argument)
+            self.expressions.append(None)
+            self._operand_ids[argument] = operand_id
+        if parse and self.expressions[operand_id] == None:
+            self.expressions[operand_id] = OperandExpr(argument)
+        return operand_id
+
+    def append(self, instruction: VmInstructionInfo, argument: str|None, offset: int, lineno: int):
+        self.inst.append(self.intern_instruction(instruction))
+        self.operand.append(self.intern_operand(argument or "", instruction.hasarg))
+        self.offset.append(offset)
+        self.lineno.append(lineno)
+        self.value.append(0)
+
+    def clear(self):
+        for column in (self.inst, self.offset, self.lineno, self.operand, self.value):
+            del column[:]
+
+    def truncate(self, length: int):
+        for column in (self.inst, self.offset, self.lineno, self.operand, self.value):
+            del column[length:]
+
+    # Moves the rows from tail to the end of the stream in place of rows
+    # start to end (tail >= end)
+    def splice(self, start: int, end: int, tail: int):
+        for name in ("inst", "offset", "lineno", "operand", "value"):
+            column = getattr(self, name)
+            rows = column[tail:]
+            del column[tail:]
+            column[start:end] = rows
+
+    # Keeps only the given rows, in the given order
+    def reorder(self, rows: list[int]):
+        for name in ("inst", "offset", "lineno", "operand", "value"):
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, (column[row] for row in rows)))
+
+    def delete(self, rows: set[int]):
+        for name in ("inst", "offset", "lineno", "operand", "value"):
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, (v for i, v in enumerate(column) if i not in rows)))
+
+
+# Optimization level -> strategy used to pick between alternative macro expansions
+EXPANSION_MODES = {"0": "default", "1": "default", "2": "speed", "s": "size"}
+
+
+class MacroStats:
+    __slots__ = ("uses", "nodes", "bytes", "cycles")
+
+    def __init__(self) -> None:
+        self.uses = 0
+        self.nodes = 0
+        self.bytes = 0
+        self.cycles = 0
+
+
+# line is the index of the offending line (None for errors not tied to one),
+# column and width the span of it that is underlined
+class AsmError(Exception):
+    def __init__(self, message: str, exit_code: int, line: int|None = None, column: int = 0, width: int = 0) -> None:
+        super().__init__(message)
+        self.exit_code = exit_code
+        self.line = line
+        self.column = column
+        self.width = width
+
+
+def map_file(path: str):
+    with open(path, "rb") as file:
+        try:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files and pipes cannot be mapped
+            return file.read()
+
+
+def split_segments(line: str):
+    return [segment for segment in line.split('#')[0].split(' ') if segment != '']
+
+
+# Macros handled by Compiler.process_macro, which .macro may not redefine
+BUILTIN_MACROS = frozenset({"SET", "LABEL", "ASCII", "SECTION", "ALLOC", "INCBIN", "PAD", "WORD", "PUSHSTR",
+                            "STRREGS", "LDREGS", "LD16", "PUSHREGS", "ADD16", "JUMP", "ZERO", "POPREGS", "RMREGS",
+                            "FETCHREGS", "FASTJUMP", "PUSH16", "STR16", "INCLUDE", "GLOBAL", "EXTERN", "INST",
+                            "MACRO", "ENDM", "BOUND"})
+# Instructions that set the comparison flags, and those that read them
+FLAG_SETTERS = frozenset({"CMPX", "CMPY", "CLD"})
+FLAG_READERS = frozenset({"JE", "JRE", "JL", "JRL", "JLE", "JRLE", "JG", "JRG", "JGE", "JRGE"})
+# User macros expanding user macros deeper than this are taken to recurse
+MAX_MACRO_DEPTH = 64
+# Distinct argument lists whose expansion is kept per macro
+MAX_MACRO_EXPANSIONS = 256
+
+
+# A .macro definition. The body is tokenized once, when it is read, and
+# compiled into a template when .endm closes it: every segment is kept as a
+# string, as a slot (an index into the parameters followed by the labels the
+# body defines) standing for the whole segment, or as a tuple of strings and
+# slots when a slot is part of an expression. Expanding only joins strings.
+# Arguments are substituted in parentheses inside expressions, so
+# "ldx value|1" with "buf+1" for value loads the low byte of buf+1
+class MacroTemplate:
+    __slots__ = ("name", "params", "locals", "lines", "start", "end", "depth", "expansions")
+
+    def __init__(self, name: str, params: list[str], start: int, depth: int) -> None:
+        self.name = name
+        self.params = params
+        # Labels defined in the body, renamed in every expansion
+        self.locals: list[str] = []
+        # Body segments until compile(), then the template
+        self.lines: list[list] = []
+        # Lines of the .macro and .endm, and the include depth it is defined at
+        self.start = start
+        self.end = None
+        self.depth = depth
+        # argument tuple -> lines with the arguments substituted
+        self.expansions: dict[tuple[str, ...], list[list]] = {}
+
+    def compile(self, end: int):
+        self.end = end
+        for segments in self.lines:
+            if len(segments) == 2 and segments[0].replace('.', '').upper() == "LABEL" \
+                    and segments[1] not in self.params and segments[1] not in self.locals:
+                self.locals.append(segments[1])
+        slots = {name: slot for slot, name in enumerate(self.params + self.locals)}
+        self.lines = [[self.slotted(segment, slots) for segment in segments] for segments in self.lines]
+
+    @staticmethod
+    def slotted(segment: str, slots: dict[str, int]):
+        if segment in slots:
+            return slots[segment]
+        # Names inside strings are left alone
+        if '"' in segment:
+            return segment
+        tokens = EXPRESSION_TOKEN.findall(segment)
+        if not any(token in slots for token in tokens):
+            return segment
+        return tuple(slots.get(token, token) for token in tokens)
+
+    # The body with the arguments in place. Segments naming local labels are
+    # left as slots for fill()
+    def instantiate(self, args: tuple[str, ...]):
+        lines = self.expansions.get(args)
+        if lines != None:
+            return lines
+        params = len(self.params)
+
+        def substitute(segment):
+            if isinstance(segment, str):
+                return segment
+            if isinstance(segment, int):
+                return args[segment] if segment < params else segment
+            parts = tuple(grouped(args[part]) if isinstance(part, int) and part < params else part
+                          for part in segment)
+            return "".join(parts) if all(isinstance(part, str) for part in parts) else parts
+
+        lines = [[substitute(segment) for segment in segments] for segments in self.lines]
+        if len(self.expansions) < MAX_MACRO_EXPANSIONS:
+            self.expansions[args] = lines
+        return lines
+
+    def fill(self, lines: list[list], labels: list[str]):
+        params = len(self.params)
+
+        def substitute(segment):
+            if isinstance(segment, str):
+                return segment
+            if isinstance(segment, int):
+                return labels[segment - params]
+            return "".join(part if isinstance(part, str) else labels[part - params] for part in segment)
+
+        return [[substitute(segment) for segment in segments] for segments in lines]
+
+
+# A source file mapped into memory (or source text already in memory).
+# Lines are decoded one at a time while compiling and only their offsets are
+# kept, so any line can be read again for a diagnostic without holding a
+# copy of it
+class SourceFile:
+    __slots__ = ("path", "data", "offsets")
+
+    def __init__(self, path: str|None, text: str|None = None) -> None:
+        self.path = path
+        self.offsets = array("Q")
+        if text != None:
+            self.data = text
+            return
+        self.data = map_file(path)
+
+    def decode(self, start: int, end: int):
+        line = self.data[start:end]
+        if not isinstance(line, str):
+            line = line.decode()
+        return line[:-1] if line.endswith("\r") else line
+
+    def __iter__(self):
+        data = self.data
+        offsets = self.offsets
+        newline = "\n" if isinstance(data, str) else b"\n"
+        start = 0
+        while True:
+            offsets.append(start)
+            end = data.find(newline, start)
+            if end == -1:
+                yield self.decode(start, len(data))
+                return
+            yield self.decode(start, end)
+            start = end + 1
+
+    def line(self, number: int):
+        start = self.offsets[number]
+        end = self.data.find("\n" if isinstance(self.data, str) else b"\n", start)
+        return self.decode(start, end if end != -1 else len(self.data))
+
+
+# The lines of a compilation unit, numbered in the order they are compiled:
+# the lines of an included file follow the .include line, and the including
+# file goes on after them. Only the line being compiled is held; earlier
+# lines are read back from their SourceFile, and lines streamed from other
+# iterables are kept only if the linker may still report errors on them
+class SourceLines:
+    __slots__ = ("count", "segments", "starts", "stack", "kept", "current_index", "current")
+
+    def __init__(self) -> None:
+        self.count = 0
+        # (first index, file or None, name shown in diagnostics, first line number)
+        self.segments: list[tuple[int, SourceFile|None, str|None, int]] = []
+        self.starts: list[int] = []
+        # [file, name, lines read, saved current index, saved current line] per open source
+        self.stack: list[list] = []
+        self.kept: dict[int, str] = {}
+        self.current_index = -1
+        self.current = ""
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index: int):
+        if index == self.current_index:
+            return self.current
+        if index in self.kept:
+            return self.kept[index]
+        start, file, name, first = self.segment(index)
+        if file == None:
+            return ""
+        return file.line(first + index - start)
+
+    def __setitem__(self, index: int, line: str):
+        self.kept[index] = line
+
+    def segment(self, index: int):
+        if not self.segments:
+            return (0, None, None, 0)
+        return self.segments[max(bisect_right(self.starts, index) - 1, 0)]
+
+    def open_segment(self):
+        file, name, number = self.stack[-1][:3]
+        if self.starts and self.starts[-1] == self.count:
+            self.segments.pop()
+            self.starts.pop()
+        self.segments.append((self.count, file, name, number))
+        self.starts.append(self.count)
+
+    def push(self, file: SourceFile|None, name: str|None):
+        self.stack.append([file, name, 0, self.current_index, self.current])
+        self.open_segment()
+
+    def pop(self):
+        self.current_index, self.current = self.stack.pop()[3:]
+        if self.stack:
+            self.open_segment()
+
+    def append(self, line: str):
+        self.current_index = self.count
+        self.current = line
+        self.count += 1
+        self.stack[-1][2] += 1
+        return self.current_index
+
+    def location(self, index: int):
+        start, file, name, first = self.segment(index)
+        number = first + index - start + 1
+        return f"{name}:{number}" if name != None else str(number)
+
+
+class AsmComponent:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.lines = SourceLines()
+
+    def source_location(self, line: int):
+        return self.lines.location(line)
+
+    def throw_error(self, line: int, segment: int|None, error: str):
+        message = f"{self.name} ERROR: {error}"
+        lines = self.lines
+        if line < 0 or line > len(lines) - 1:
+            raise AsmError(message, -4)
+        target_line: str = lines[line]
+        segments = target_line.split(' ')
+        target_segment: str = segments[segment] if segment != None else target_line
+        
+        segment_offset = 0
+        if segment != None:
+            for i in range(segment):
+                segment_offset += len(segments[i]) + 1
+
+        message += f"\n{self.source_location(line)}\t{target_line}"
+        message += '\n' + ' ' * len(str(line)) + '\t' + ' ' * segment_offset + '~' * len(target_segment)
+        raise AsmError(message, -3, line, segment_offset, len(target_segment))
+
+
+class Compiler(AsmComponent):
+    # Macros with alternative expansions: macro -> variant -> (emit method, cost method).
+    # The first variant is the canonical one used when not optimizing; cost
+    # methods return the (bytes, estimated cycles) of an expansion
+    MACRO_EXPANSIONS = {
+        "PUSHSTR": {
+            "unrolled": ("expand_pushstr_unrolled", "cost_pushstr_unrolled"),
+            "loop": ("expand_pushstr_loop", "cost_pushstr_loop"),
+        },
+        "ADD16": {
+            "inline": ("expand_add16_inline", "cost_add16_inline"),
+            "swap": ("expand_add16_swap", "cost_add16_swap"),
+        },
+        "JUMP": {
+            "safe": ("expand_jump_safe", "cost_jump_safe"),
+            "fast": ("expand_jump_fast", "cost_jump_fast"),
+        },
+    }
+
+    def __init__(self, expansion_mode: str = "default", source_path: str|None = None, entry: bool = True, instructions: dict[str, VmInstructionInfo]|None = None) -> None:
+        self.expansion_mode = expansion_mode
+        # Private copy of the instruction table, so .inst declarations stay
+        # local to this unit
+        self.instructions = dict(VM_INSTRUCTIONS if instructions == None else instructions)
+        self.source_path = source_path
+        self.include_stack = [os.path.abspath(source_path)] if source_path != None else []
+        self.included_files: list[str] = []
+        # (macro, variant) -> MacroStats for every top-level macro that emitted code
+        self.macro_stats: dict[tuple[str, str], MacroStats] = {}
+        self.macro_variant = None
+        self.macro_cycles = None
+        # Times the compilation phases when set (see stats.Profiler)
+        self.profiler = None
+        # Labels generated by macro expansions, left out of the link summary
+        self.local_labels = set()
+        self.local_label_count = 0
+        # User macros by upper case name, the one being defined and the
+        # (macro, body line) of every expansion in progress
+        self.macros: dict[str, MacroTemplate] = {}
+        self.definition: MacroTemplate|None = None
+        self.expansions: list[tuple[str, list[str]]] = []
+        # Loop header label -> most times the loop runs per entry, from .bound
+        self.loop_bounds: dict[str, int] = {}
+        self.symbols = {}
+        self.labels = {}
+        # Labels declared in OVERRIDE sections name fixed addresses
+        self.fixed_labels = set()
+        # Labels exported to and imported from other objects
+        self.globals = set()
+        self.externs = set()
+        self.strings = {}
+        self.binaries = {}
+        self.result = VmCode()
+        self.code_written = False
+        self.byte_offset = 0
+        self.padding_offset = 0
+        self.concrete_offset = 0
+        self.override_offset = 0
+        self.section = None
+        super().__init__("COMPILER")
+
+        # Objects linked into a larger program get their entry point from the linker
+        if not entry:
+            return
+        self.result.append(self.instructions["CMPX"], "0", self.byte_offset, 0)
+        self.byte_offset += 2
+        self.result.append(self.instructions["JE"], "_main", self.byte_offset, 0)
+        self.byte_offset += self.instructions["JE"].argsize + 1
+
+    # Errors in a user macro are reported at the line using it, naming the
+    # line of the macro they come from
+    def throw_error(self, line: int, segment: int|None, error: str):
+        if self.expansions:
+            macro, segments = self.expansions[-1]
+            super().throw_error(line, None, f"{error} (in macro {macro.lower()}: {' '.join(segments)})")
+        super().throw_error(line, segment, error)
+
+    def add_symbol(self, key: str, value: str):
+        self.symbols.__setitem__(key, value)
+
+    def get_symbol(self, key: str):
+        return self.symbols[key]
+
+    # Value of a .set symbol known before linking, or None if it is not a
+    # constant: undefined, depending on a label or defined in terms of itself.
+    # Raises ExpressionError for arithmetic errors
+    def symbol_value(self, name: str, pending: frozenset = frozenset()):
+        if name not in self.symbols or name in pending:
+            return None
+        expr = symbol_expression(self.symbols[name])
+        if expr.error != None:
+            return None
+        return expr.evaluate(lambda other: self.symbol_value(other, pending | {name}))
+
+    # Value of an expression of literals and symbols, or None
+    def constant(self, text: str):
+        expr = symbol_expression(text)
+        if expr.error != None:
+            return None
+        try:
+            return expr.evaluate(self.symbol_value)
+        except ExpressionError:
+            return None
+
+    # Labels and undefined names an expression depends on, looking through
+    # the symbols it uses
+    def referenced_names(self, expr: OperandExpr, seen: set[str]|None = None):
+        seen = set() if seen == None else seen
+        for name in expr.names:
+            if name in seen:
+                continue
+            seen.add(name)
+            if name in self.symbols:
+                yield from self.referenced_names(symbol_expression(self.symbols[name]), seen)
+            else:
+                yield name
+
+    def add_label(self, label: str, address: int):
+        self.labels.__setitem__(label, address)
+
+    def get_label(self, label: str):
+        return self.labels[label]
+
+    # Compiles lines from any iterable, one at a time. file is where they were
+    # read from, if anywhere, and name is how diagnostics refer to them
+    def compile_lines(self, lines: Iterable[str], file: SourceFile|None = None, name: str|None = None):
+        source = self.lines
+        code = self.result
+        profiler = self.profiler
+        source.push(file, name)
+        for line in lines:
+            if line.endswith("\n"):
+                line = line[:-1]
+            index = source.append(line)
+            if profiler != None:
+                profiler.begin("tokenize")
+            line_segments = split_segments(line)
+            if profiler != None:
+                profiler.end()
+            if len(line_segments) == 0:
+                continue
+            rows = len(code)
+            self.compile_line(index, line_segments)
+            if file == None and any(code.instructions[code.inst[row]].hasarg for row in range(rows, len(code))):
+                source[index] = line
+        if self.definition != None and self.definition.depth == len(self.include_stack):
+            self.throw_error(self.definition.start, None, "Expected .endm before the end of the file")
+        source.pop()
+
+    def include(self, index: int, path: str):
+        base = os.path.dirname(self.include_stack[-1]) if self.include_stack else os.getcwd()
+        path = os.path.abspath(os.path.join(base, path))
+        if path in self.include_stack:
+            self.throw_error(index, 1, "Recursive include")
+        try:
+            included = SourceFile(path)
+        except OSError as e:
+            self.throw_error(index, 1, f"Cannot include file: {e.strerror}")
+        self.included_files.append(path)
+        self.include_stack.append(path)
+        self.compile_lines(included, included, os.path.relpath(path))
+        self.include_stack.pop()
+
+    def include_binary(self, index: int, segments: list[str]):
+        # The path may contain spaces, the offset and length may not
+        text = ' '.join(segments)
+        end = text.find('"', 1)
+        if len(text) < 2 or text[0] != '"' or end == -1:
+            self.throw_error(index, None, "Expected quoted file path")
+        arguments = text[end + 1:].split()
+        if len(arguments) > 2:
+            self.throw_error(index, None, "Expected file path, offset and length")
+        numbers = []
+        for argument in arguments:
+            value = self.constant(argument)
+            if value == None or value < 0:
+                self.throw_error(index, 1 + len(segments) - len(arguments) + len(numbers),
+                                 "Expected number or macro symbol")
+            numbers.append(value)
+
+        base = os.path.dirname(self.include_stack[-1]) if self.include_stack else os.getcwd()
+        path = os.path.abspath(os.path.join(base, text[1:end]))
+        try:
+            data = self.binary(path)
+        except OSError as e:
+            self.throw_error(index, 1, f"Cannot include file: {e.strerror}")
+        if path not in self.included_files:
+            self.included_files.append(path)
+        offset = numbers[0] if len(numbers) > 0 else 0
+        length = numbers[1] if len(numbers) > 1 else len(data) - offset
+        if offset > len(data) or length < 0 or offset + length > len(data):
+            self.throw_error(index, None, f"Range exceeds the {len(data)} byte(s) of the file")
+        if length != 0:
+            self.result.append(VM_BINARY, f"{offset} {length} {path}", self.byte_offset, index)
+        self.byte_offset += length
+
+    # Binary files are mapped once and read again when the image is encoded
+    def binary(self, path: str):
+        if path not in self.binaries:
+            self.binaries[path] = map_file(path)
+        return self.binaries[path]
+
+    def compile_line(self, index: int, segments: list[str]):
+        line = self.lines[index]
+        if len(line.replace(" ", "").replace("\t", "")) == 0:
+            return
+        opcode = segments[0]
+        starting_sym = opcode[0]
+        profiler = self.profiler
+        if self.definition != None and opcode.replace('.', '').upper() not in ("MACRO", "ENDM"):
+            self.definition.lines.append(segments)
+            return
+        
+        match (starting_sym):
+            case '.':
+                if profiler != None:
+                    profiler.begin("expand")
+                start_offset = self.byte_offset
+                start_nodes = len(self.result)
+                self.macro_variant = self.macro_cycles = None
+                self.process_macro(index, opcode, segments[1:])
+                self.record_macro(opcode.replace('.', '').upper(), start_offset, start_nodes)
+
+            case '#':
+                return
+
+            case _:
+                if profiler != None:
+                    profiler.begin("instructions")
+                self.process_instruction(index, opcode, segments[1:])
+
+        if profiler != None:
+            profiler.end()
+
+    def record_macro(self, macro: str, start_offset: int, start_nodes: int):
+        nodes = len(self.result) - start_nodes
+        if nodes <= 0:
+            return
+        cycles = self.macro_cycles
+        if cycles == None:
+            instructions = self.result.instructions
+            cycles = sum(1 for i in range(start_nodes, len(self.result))
+                         if instructions[self.result.inst[i]].opcode_byte != None)
+        stats = self.macro_stats.setdefault((macro, self.macro_variant or ""), MacroStats())
+        stats.uses += 1
+        stats.nodes += nodes
+        stats.bytes += self.byte_offset - start_offset
+        stats.cycles += cycles
+
+    def instruction_bytes(self, *mnemonics: str):
+        return sum(1 + self.instructions[mnemonic].argsize for mnemonic in mnemonics)
+
+    def add_local_label(self, prefix: str):
+        label = f"__{prefix}{self.local_label_count}"
+        self.local_label_count += 1
+        self.local_labels.add(label)
+        return label
+
+    def expand(self, index: int, macro: str, segments: list[str], available=None):
+        variants = self.MACRO_EXPANSIONS[macro]
+        names = [name for name in variants if available == None or name in available]
+        chosen = names[0]
+        if self.expansion_mode != "default" and len(names) > 1:
+            costs = {name: getattr(self, variants[name][1])(index, segments) for name in names}
+            if self.expansion_mode == "size":
+                chosen = min(names, key=lambda name: costs[name])
+            else:
+                chosen = min(names, key=lambda name: (costs[name][1], costs[name][0]))
+        self.macro_variant = chosen
+        getattr(self, variants[chosen][0])(index, segments)
+
+    def pushstr_string(self, index: int, segments: list[str]):
+        target = segments[0]
+        if target in self.labels:
+            target = self.get_label(target)
+
+        changed, int_val, str_val = to_linked_repr(target)
+        if not changed and not isinstance(target, int):
+            self.throw_error(index, 1, "Invalid syntax")
+
+        address = int_val
+        if address not in self.strings:
+            self.throw_error(index, 1, f"No string at location {hex(address).upper()}")
+        return address, self.strings[address]
+
+    def expand_pushstr_unrolled(self, index: int, segments: list[str]):
+        address, string = self.pushstr_string(index, segments)
+        ldx_info = self.instructions["LDX"]
+        pushx_info = self.instructions["PUSHX"]
+        self.result.append(ldx_info, "0", self.byte_offset, index)
+        self.byte_offset += ldx_info.argsize + 1
+        self.result.append(pushx_info, "", self.byte_offset, index)
+        self.byte_offset += 1
+
+        for char in string:
+            self.result.append(ldx_info, str(ord(char)), self.byte_offset, index)
+            self.byte_offset += ldx_info.argsize + 1
+            self.result.append(pushx_info, "", self.byte_offset, index)
+            self.byte_offset += 1
+
+    def cost_pushstr_unrolled(self, index: int, segments: list[str]):
+        address, string = self.pushstr_string(index, segments)
+        pushes = 1 + len(string)
+        return pushes * self.instruction_bytes("LDX", "PUSHX"), pushes * 2
+
+    # Walks the string in memory with an LDRX whose operand is patched at run
+    # time, so the size does not depend on the string length
+    def expand_pushstr_loop(self, index: int, segments: list[str]):
+        self.pushstr_string(index, segments)
+        target = segments[0]
+        loop = self.add_local_label("pushstr")
+        end = self.add_local_label("pushstr")
+        self.process_instruction(index, "LDX", ["0"])
+        self.process_instruction(index, "PUSHX", [])
+        self.process_instruction(index, "LDX", [f"{grouped(target)}|1"])
+        self.process_instruction(index, "STRX", [f"{loop}+2"])
+        self.process_instruction(index, "LDX", [f"{grouped(target)}|0"])
+        self.process_instruction(index, "STRX", [f"{loop}+1"])
+        self.add_label(loop, self.byte_offset)
+        self.process_instruction(index, "LDRX", ["0"])
+        self.process_instruction(index, "PUSHX", [])
+        # the terminator has been pushed
+        self.process_instruction(index, "CMPX", ["0"])
+        self.process_instruction(index, "JE", [end])
+        # advance the pointer's lower byte
+        self.process_instruction(index, "LDRX", [f"{loop}+2"])
+        self.process_instruction(index, "ADDX", ["1"])
+        self.process_instruction(index, "STRX", [f"{loop}+2"])
+        self.process_instruction(index, "CMPX", ["0"])
+        self.process_instruction(index, "JG", [loop])
+        # carry into the higher byte, flags are still equal from the last compare
+        self.process_instruction(index, "LDRX", [f"{loop}+1"])
+        self.process_instruction(index, "ADDX", ["1"])
+        self.process_instruction(index, "STRX", [f"{loop}+1"])
+        self.process_instruction(index, "JE", [loop])
+        self.add_label(end, self.byte_offset)
+        self.macro_cycles = self.cost_pushstr_loop(index, segments)[1]
+
+    def cost_pushstr_loop(self, index: int, segments: list[str]):
+        address, string = self.pushstr_string(index, segments)
+        size = self.instruction_bytes("LDX", "PUSHX", "LDX", "STRX", "LDX", "STRX",
+                                      "LDRX", "PUSHX", "CMPX", "JE", "LDRX", "ADDX", "STRX", "CMPX", "JG",
+                                      "LDRX", "ADDX", "STRX", "JE")
+        length = len(string) - 1
+        carries = ((address & 0xFF) + length) // 256
+        return size, 6 + 9 * length + 4 + 4 * carries
+
+    def expand_add16_inline(self, index: int, segments: list[str]):
+        self.process_instruction(index, "POPX", [])
+        self.process_instruction(index, "ADDX", [segments[0]])
+        self.process_instruction(index, "CMPX", [segments[0]])
+        # skip first overflow step if not necessary
+        self.process_instruction(index, "JRGE", [str(self.instruction_bytes("JRGE", "POPY", "PUSHX", "PUSHY", "POPX", "ADDX",
+                                                                             "PUSHX", "POPY", "POPX", "JRL", "LDX", "PUSHY"))])
+        # first overflow step
+        self.process_instruction(index, "POPY", []) # get Y
+        self.process_instruction(index, "PUSHX", []) # save X
+        self.process_instruction(index, "PUSHY", []) # swap registers
+        self.process_instruction(index, "POPX", []) # continuation of swap registers
+        self.process_instruction(index, "ADDX", ["1"]) # add 1 to X
+        # set Y = X
+        self.process_instruction(index, "PUSHX", [])
+        self.process_instruction(index, "POPY", [])
+        self.process_instruction(index, "POPX", [])
+        # Skip overflow step if not necessary
+        self.process_instruction(index, "JRL", [str(self.instruction_bytes("JRL", "LDX"))])
+        # overflow step
+        self.process_instruction(index, "LDX", ["0"])
+        # restore registers
+        self.process_instruction(index, "PUSHY", [])
+        self.process_instruction(index, "PUSHX", [])
+        self.macro_cycles = self.cost_add16_inline(index, segments)[1]
+
+    def cost_add16_inline(self, index: int, segments: list[str]):
+        size = self.instruction_bytes("POPX", "ADDX", "CMPX", "JRGE", "POPY", "PUSHX", "PUSHY", "POPX",
+                                      "ADDX", "PUSHX", "POPY", "POPX", "JRL", "LDX", "PUSHY", "PUSHX")
+        # worst case: carry into the higher byte
+        return size, 15
+
+    # Carries through _swap instead of juggling both registers on the stack.
+    # Clobbers _swap like .rmregs does, and leaves Y untouched
+    def expand_add16_swap(self, index: int, segments: list[str]):
+        self.process_instruction(index, "POPX", [])
+        self.process_instruction(index, "ADDX", [segments[0]])
+        self.process_instruction(index, "CMPX", [segments[0]])
+        # skip the carry if not necessary
+        self.process_instruction(index, "JRGE", [str(self.instruction_bytes("JRGE", "STRX", "POPX", "ADDX", "PUSHX", "LDRX"))])
+        self.process_instruction(index, "STRX", ["_swap"])
+        self.process_instruction(index, "POPX", [])
+        self.process_instruction(index, "ADDX", ["1"])
+        self.process_instruction(index, "PUSHX", [])
+        self.process_instruction(index, "LDRX", ["_swap"])
+        self.process_instruction(index, "PUSHX", [])
+        self.macro_cycles = self.cost_add16_swap(index, segments)[1]
+
+    def cost_add16_swap(self, index: int, segments: list[str]):
+        size = self.instruction_bytes("POPX", "ADDX", "CMPX", "JRGE", "STRX", "POPX", "ADDX", "PUSHX", "LDRX", "PUSHX")
+        return size, 10
+
+    def expand_jump_safe(self, index: int, segments: list[str]):
+        self.process_instruction(index, "PUSHX", [])
+        self.process_instruction(index, "LDX", ["0"])
+        self.process_instruction(index, "CMPX", ["0"])
+        self.process_instruction(index, "POPX", [])
+        self.process_instruction(index, "JE", [segments[0]])
+
+    def cost_jump_safe(self, index: int, segments: list[str]):
+        return self.instruction_bytes("PUSHX", "LDX", "CMPX", "POPX", "JE"), 5
+
+    # Same as .fastjump: X is never below 0, so JGE always branches. Unlike
+    # the safe form it leaves the flags of comparing X with 0 instead of
+    # equal, so it is only picked for targets that compare first
+    def expand_jump_fast(self, index: int, segments: list[str]):
+        self.process_macro(index, "FASTJUMP", segments)
+
+    def cost_jump_fast(self, index: int, segments: list[str]):
+        return self.instruction_bytes("CMPX", "JGE"), 2
+
+    # Whether the code at label, which must already be compiled, sets the
+    # flags before anything reads them. Jumps to labels further down are
+    # not known yet and get False
+    def compares_first(self, label: str):
+        if label not in self.labels or label in self.fixed_labels:
+            return False
+        address = self.labels[label]
+        code = self.result
+        names = {info: mnemonic for mnemonic, info in self.instructions.items()}
+        start = len(code)
+        while start > 0 and code.offset[start - 1] >= address:
+            start -= 1
+        for row in range(start, len(code)):
+            info = code.instructions[code.inst[row]]
+            mnemonic = names.get(info)
+            if code.offset[row] != address or mnemonic not in VM_INSTRUCTIONS:
+                return False
+            if mnemonic in FLAG_SETTERS or mnemonic == "RET":
+                return True
+            if mnemonic in FLAG_READERS:
+                return False
+            address += 1 + info.argsize
+        return False
+
+    # Compiles the body of a user macro as if it were written at the line
+    # using it. Labels it defines get new names in every expansion
+    def expand_macro(self, index: int, template: MacroTemplate, segments: list[str]):
+        if len(segments) != len(template.params):
+            self.throw_error(index, None, f"Expected {len(template.params)} argument(s) for macro "
+                                          f"{template.name.lower()}")
+        if len(self.expansions) >= MAX_MACRO_DEPTH:
+            self.throw_error(index, 0, f"Macro expansion nested more than {MAX_MACRO_DEPTH} levels deep")
+        lines = template.instantiate(tuple(segments))
+        if template.locals:
+            lines = template.fill(lines, [self.add_local_label(f"{template.name.lower()}_{label}_")
+                                          for label in template.locals])
+        for line in lines:
+            self.expansions.append((template.name, line))
+            try:
+                if line[0][0] == '.':
+                    self.process_macro(index, line[0], line[1:])
+                else:
+                    self.process_instruction(index, line[0], line[1:])
+            finally:
+                self.expansions.pop()
+        # Counted from the nodes, whatever the macros in the body chose
+        self.macro_variant = self.macro_cycles = None
+
+    def process_macro(self, index: int, macro: str, segments: list[str]):
+        match (macro.replace('.', '').upper()):
+            case 'SET':
+                if len(segments) != 2:
+                    self.throw_error(index, None, "Expected 2 arguments for macro SET")
+                if segments[0] in self.labels or segments[0] in self.symbols:
+                    self.throw_error(index, 1, "Symbol already exists")
+                self.add_symbol(*segments)
+
+            case 'LABEL':
+                if len(segments) != 1:
+                    self.throw_error(index, None, "Expected 1 argument for macro LABEL")
+                if segments[0] in self.symbols or segments[0] in self.labels:
+                    self.throw_error(index, 1, "Symbol already exists")
+                if segments[0] in self.externs:
+                    self.throw_error(index, 1, "Label declared as external")
+                self.add_label(segments[0], self.byte_offset)
+                if self.section == 'OVERRIDE':
+                    self.fixed_labels.add(segments[0])
+                if segments[0] == "_main" and len(self.result) == 1:
+                    self.result.clear()
+                    self.byte_offset = 0
+
+            case 'ASCII':
+                if self.section != "DATA":
+                    self.throw_error(index, None, "ASCII String outside of DATA section")
+                if len(segments) == 0:
+                    self.throw_error(index, None, "Expected ASCII sequence")
+                ascii_sequence = ' '.join(segments)
+                if ascii_sequence[0] != '"':
+                    self.throw_error(index, 1, "Expected quotes")
+                ascii_end = ascii_sequence.find('"', 1)
+                ascii_string = ascii_sequence[1:ascii_end if ascii_end != -1 else len(ascii_sequence)]
+                if len(ascii_string) < len(ascii_sequence) - 2:
+                    self.throw_error(index, None, "Invalid syntax")
+                try:
+                    ascii_string.encode("latin-1")
+                except UnicodeEncodeError:
+                    self.throw_error(index, None, "Characters in ASCII strings must fit in one byte")
+                ascii_string += "\0"
+                self.result.append(VM_DATA, ascii_string, self.byte_offset, index)
+                self.strings.__setitem__(self.byte_offset, ascii_string)
+                self.byte_offset += len(ascii_string)
+
+            case 'SECTION':
+                if len(segments) != 1:
+                    self.throw_error(index, None, "Expected section")
+
+                if self.section == 'OVERRIDE':
+                    self.override_offset = self.byte_offset
+                    self.byte_offset = self.concrete_offset
+                
+                match (segments[0].upper()):
+                    case 'DATA':
+                        if self.section == "TEXT":
+                            self.result.append(self.instructions["RET"], "", self.byte_offset, index)
+                            self.byte_offset += 1
+                        self.section = "DATA"
+
+                    case 'TEXT':
+                        self.section = "TEXT"
+
+                    case 'OVERRIDE':
+                        self.section = 'OVERRIDE'
+                        self.concrete_offset = self.byte_offset
+                        self.byte_offset = self.override_offset
+
+                    case 'META':
+                        if self.section != None:
+                            self.throw_error(index, None, "META section expected to be the first in source file")
+                        self.section = "META"
+
+                    case _:
+                        self.throw_error(index, 1, "Unknown section")
+
+            case 'ALLOC':
+                if self.section != "DATA":
+                    self.throw_error(index, None, "Cannot allocate buffer outside of DATA section")
+                if len(segments) != 1:
+                    self.throw_error(index, None, "Expected buffer size")
+                size = self.constant(segments[0])
+                if size == None or size < 0:
+                    self.throw_error(index, 1, "Expected buffer size or macro symbol")
+                if size != 0:
+                    self.result.append(VM_ZERO, str(size), self.byte_offset, index)
+                self.byte_offset += size
+
+            case 'INCBIN':
+                if self.section != "DATA":
+                    self.throw_error(index, None, "Cannot include binary data outside of DATA section")
+                self.include_binary(index, segments)
+
+            case 'PAD':
+                if len(segments) != 1:
+                    self.throw_error(index, None, "Expected pad size")
+                size = self.constant(segments[0])
+                if size == None:
+                    self.throw_error(index, 1, "Expected buffer size or macro symbol")
+                self.byte_offset += size
+                if self.section != "OVERRIDE":
+                    self.padding_offset += size
+
+            case 'WORD':
+                if self.section != "DATA":
+                    self.throw_error(index, None, "Unexpected byte allocation outside of DATA section")
+                self.result.append(VM_WORD, segments[0], self.byte_offset, index)
+                self.byte_offset += 1
+
+            case 'PUSHSTR':
+                if len(segments) != 1:
+                    self.throw_error(index, None, "Expected address or label")
+                # The loop reads the string through its 16-bit address, which
+                # cannot carry offsets or byte selectors
+                available = None if '+' not in segments[0] and '|' not in segments[0] else ("unrolled",)
+                self.expand(index, "PUSHSTR", segments, available)
+
+            case 'STRREGS':
+                if len(segments) != 1:
+                    self.throw_error(index, None, "Expected address or label")
+                self.result.append(self.instructions["STRX"], segments[0], self.byte_offset, index)
+                self.byte_offset += 3
+                self.result.append(self.instructions["STRY"], f"{grouped(segments[0])}+1", self.byte_offset, index)
+                self.byte_offset += 3
+
+            case 'LDREGS':
+                if len(segments) != 1:
+                    self.throw_error(index, None, "Expected address or label")
+                self.result.append(self.instructions["LDRX"], segments[0], self.byte_offset, index)
+                self.byte_offset += 3
+                self.result.append(self.instructions["LDRY"], f"{grouped(segments[0])}+1", self.byte_offset, index)
+                self.byte_offset += 3
+
+            case 'LD16':
+                if len(segments) != 1:
+                    self.throw_error(index, None, "Expected value or symbol")
+                self.result.append(self.instructions["LDX"], f"{grouped(segments[0])}|1", self.byte_offset, index)
+                self.byte_offset += 2
+                self.result.append(self.instructions["LDY"], f"{grouped(segments[0])}|0", self.byte_offset, index)
+                self.byte_offset += 2
+
+            case 'PUSHREGS':
+                if len(segments) != 0:
+                    self.throw_error(index, None, "No argument expected")
+                self.result.append(self.instructions["PUSHY"], "", self.byte_offset, index)
+                self.byte_offset += 1 
+                self.result.append(self.instructions["PUSHX"], "", self.byte_offset, index)
+                self.byte_offset += 1
+
+            case 'ADD16':
+                if len(segments) != 1:
+                    self.throw_error(index, None, "Expected operand")
+                self.expand(index, "ADD16", segments)
+
+            case 'JUMP':
+                if len(segments) != 1:
+                    self.throw_error(index, None, "Expected address or label")
+                # Each form leaves different flags behind
+                available = None if self.expansion_mode == "default" or self.compares_first(segments[0]) \
+                    else ["safe"]
+                self.expand(index, "JUMP", segments, available)
+
+            case 'ZERO':
+                if len(segments) != 0:
+                    self.throw_error(index, None, "Expected no arguments")
+                self.process_instruction(index, "LDX", ["0"])
+                self.process_instruction(index, "LDY", ["0"])
+
+            case 'POPREGS':
+                if len(segments) != 0:
+                    self.throw_error(index, None, "Expected no arguments")
+                self.process_instruction(index, "POPX", [])
+                self.process_instruction(index, "POPY", [])
+
+            case 'RMREGS':
+                if len(segments) != 0:
+                    self.throw_error(index, None, "Expected no arguments")
+                self.process_macro(index, "STRREGS", ["_swap"])
+                self.process_macro(index, "POPREGS", [])
+                self.process_macro(index, "LDREGS", ["_swap"])
+
+            case 'FETCHREGS':
+                self.process_macro(index, "POPREGS", [])
+                self.process_macro(index, "PUSHREGS", [])
+
+            case 'FASTJUMP':
+                if len(segments) != 1:
+                    self.throw_error(index, None, "Expected address or label")
+                self.process_instruction(index, "CMPX", ["0"])
+                self.process_instruction(index, "JGE", [segments[0]])
+
+            case 'PUSH16':
+                if len(segments) != 1:
+                    self.throw_error(index, None, "Expected a 16-bit value")
+                self.process_instruction(index, "LDX", [f"{grouped(segments[0])}|0"])
+                self.process_instruction(index, "PUSHX", [])
+                self.process_instruction(index, "LDX", [f"{grouped(segments[0])}|1"])
+                self.process_instruction(index, "PUSHX", [])
+            
+            case 'STR16':
+                if len(segments) != 2:
+                    self.throw_error(index, None, "Expected value and destination")
+                self.process_instruction(index, "LDX", [f"{grouped(segments[0])}|1"])
+                self.process_instruction(index, "STRX", [segments[1]])
+                self.process_instruction(index, "LDX", [f"{grouped(segments[0])}|0"])
+                self.process_instruction(index, "STRX", [f"{grouped(segments[1])}+1"])
+
+            case 'INCLUDE':
+                path = ' '.join(segments)
+                if len(path) < 2 or path[0] != '"' or path[-1] != '"':
+                    self.throw_error(index, None, "Expected quoted file path")
+                self.include(index, path[1:-1])
+
+            case 'GLOBAL':
+                if len(segments) != 1:
+                    self.throw_error(index, None, "Expected 1 argument for macro GLOBAL")
+                self.globals.add(segments[0])
+
+            case 'EXTERN':
+                if len(segments) != 1:
+                    self.throw_error(index, None, "Expected 1 argument for macro EXTERN")
+                if segments[0] in self.labels or segments[0] in self.symbols:
+                    self.throw_error(index, 1, "Symbol already exists")
+                self.externs.add(segments[0])
+
+            case 'INST':
+                if self.section != "META":
+                    self.throw_error(index, None, "Unexpected VM instruction declaration outside META section")
+                if len(segments) not in (4, 5):
+                    self.throw_error(index, None, "Expected mnemonic, opcode, number of arguments, max argument and optionally cycles")
+                mnemonic = segments[0].upper()
+                opcode = segments[1].upper()
+                if not segments[2].isdecimal():
+                    self.throw_error(index, 2, "Expected decimal number")
+                argsize = int(segments[2])
+                maxarg = None
+                if segments[3] != "?":
+                    if not segments[3].isdecimal():
+                        self.throw_error(index, 3, "Invalid syntax")
+                    maxarg = int(segments[3])
+                cycles = 1
+                if len(segments) == 5:
+                    if not segments[4].isdecimal():
+                        self.throw_error(index, 5, "Expected decimal number")
+                    cycles = int(segments[4])
+                info = VmInstructionInfo(opcode, argsize != 0, argsize, maxarg, cycles)
+                self.instructions.__setitem__(mnemonic, info)
+                    
+            case 'BOUND':
+                if len(segments) != 2:
+                    self.throw_error(index, None, "Expected loop label and bound")
+                if segments[0] in self.loop_bounds:
+                    self.throw_error(index, 1, "Loop bound already declared")
+                bound = self.constant(segments[1])
+                if bound == None or bound < 1:
+                    self.throw_error(index, 2, "Expected a positive constant")
+                self.loop_bounds[segments[0]] = bound
+
+            case 'MACRO':
+                if self.definition != None:
+                    self.throw_error(index, 0, "Macro definitions cannot be nested")
+                if len(segments) == 0:
+                    self.throw_error(index, None, "Expected macro name and parameters")
+                name = segments[0].replace('.', '').upper()
+                if name == "" or name in BUILTIN_MACROS or name in self.macros:
+                    self.throw_error(index, 1, "Macro already exists")
+                for position, param in enumerate(segments[1:], 2):
+                    if not EXPRESSION_TOKEN.fullmatch(param) or param in EXPRESSION_OPERATORS or param[0].isdigit():
+                        self.throw_error(index, position, "Invalid parameter name")
+                    if param in segments[1:position - 1]:
+                        self.throw_error(index, position, "Duplicate parameter")
+                self.definition = MacroTemplate(name, segments[1:], index, len(self.include_stack))
+
+            case 'ENDM':
+                if self.definition == None:
+                    self.throw_error(index, 0, "Unexpected .endm outside of a macro definition")
+                if len(segments) != 0:
+                    self.throw_error(index, None, "Expected no arguments")
+                self.definition.compile(index)
+                self.macros[self.definition.name] = self.definition
+                self.definition = None
+
+            case name if name in self.macros:
+                self.expand_macro(index, self.macros[name], segments)
+
+            case _:
+                self.throw_error(index, None, f"Unknown macro '{macro}'")
+
+    def process_instruction(self, index: int, opcode: str, segments: list[str]):
+        if self.section != "TEXT":
+            self.throw_error(index, None, "Unexpected code outside of TEXT section")
+        line: str = self.lines[index]
+        if opcode.upper() not in self.instructions:
+            self.throw_error(index, 0, "Unrecognized Instruction")
+        instruction_info: VmInstructionInfo = self.instructions[opcode.upper()]
+        if instruction_info.hasarg and len(segments) == 0:
+            self.throw_error(index, None, "Expected instruction operand")
+        elif not instruction_info.hasarg and len(segments) != 0:
+            self.throw_error(index, None, "Unexpected instruction operand(s)")
+        if len(segments) > 1:
+            self.throw_error(index, 2, "VM Architecture only supports single-operand instructions")
+        self.result.append(instruction_info, segments[0] if len(segments) != 0 else "", self.byte_offset, index)
+        self.byte_offset += 1 + instruction_info.argsize
+        self.code_written = True
+
+
+
+
+def compile(code: str|Iterable[str], opt_level: str = "0", source_path: str|None = None, entry: bool = True,
+            instructions: dict[str, VmInstructionInfo]|None = None, profiler=None):
+    res = Compiler(EXPANSION_MODES[opt_level], source_path, entry, instructions)
+    res.profiler = profiler
+    if isinstance(code, str):
+        code = SourceFile(source_path, code)
+    if isinstance(code, SourceFile):
+        res.compile_lines(code, code)
+    else:
+        res.compile_lines(code)
+    if res.section == 'OVERRIDE':
+        res.byte_offset = res.concrete_offset
+    res.profiler = None
+    return res
+
+
+# Same as compile(), reading the source through an mmap of the file
+def compile_file(path: str, opt_level: str = "0", entry: bool = True,
+                 instructions: dict[str, VmInstructionInfo]|None = None, profiler=None):
+    return compile(SourceFile(path), opt_level, path, entry, instructions, profiler)
+
+
+# Every object is placed after the previous one and its labels are relocated
+# by its base address, except for those declared in OVERRIDE sections. Names
+# are looked up in the object first and then among the labels exported with
+# .global by any object; _main and _swap are always exported
+class Linker(AsmComponent):
+    IMPLICIT_GLOBALS = ("_main", "_swap")
+
+    def __init__(self, units: list[Compiler]) -> None:
+        super().__init__("LINKER")
+        self.units = units
+        self.bases: list[int] = []
+        self.globals: dict[str, int] = {}
+        self.byte_offset = 0
+        self.padding_offset = 0
+        self.profiler = None
+
+    def use_unit(self, unit: Compiler):
+        self.lines = unit.lines
+
+    def address(self, unit_index: int, label: str):
+        unit = self.units[unit_index]
+        address = unit.labels[label]
+        if label in unit.fixed_labels:
+            return address
+        return address + self.bases[unit_index]
+
+    def layout(self):
+        for unit_index, unit in enumerate(self.units):
+            self.bases.append(self.byte_offset)
+            self.byte_offset += unit.byte_offset
+            self.padding_offset += unit.padding_offset
+            self.use_unit(unit)
+            for label in unit.globals.union(self.IMPLICIT_GLOBALS):
+                if label not in unit.labels:
+                    if label in unit.globals:
+                        self.throw_error(-1, None, f"Global label '{label}' not defined")
+                    continue
+                if label in self.globals:
+                    self.throw_error(-1, None, f"Duplicate global label '{label}'")
+                self.globals[label] = self.address(unit_index, label)
+
+        if "_main" not in self.globals:
+            self.throw_error(-1, None, "_main label not found")
+        if "_swap" not in self.globals:
+            self.throw_error(-1, None, "_swap label not found")
+        for unit in self.units:
+            for label in unit.externs:
+                if label not in self.globals:
+                    self.use_unit(unit)
+                    self.throw_error(-1, None, f"External label '{label}' not defined")
+
+    def labels(self):
+        res = {}
+        for unit_index, unit in enumerate(self.units):
+            for label in unit.labels:
+                if label not in unit.local_labels:
+                    res.setdefault(label, self.address(unit_index, label))
+        return res
+
+    def resolve_operand(self, unit_index: int, expr: OperandExpr, lineno: int):
+        if expr.error != None:
+            self.throw_error(lineno, None, expr.error)
+        try:
+            return expr.evaluate(lambda name: self.name_value(unit_index, name, lineno))
+        except ExpressionError as e:
+            self.throw_error(lineno, 1, str(e))
+
+    # pending holds the symbols being evaluated, to catch definitions that
+    # refer back to themselves
+    def name_value(self, unit_index: int, name: str, lineno: int, pending: frozenset = frozenset()):
+        unit = self.units[unit_index]
+        if name in unit.symbols:
+            if name in pending:
+                self.throw_error(lineno, 1, f"Symbol '{name}' is defined in terms of itself")
+            expr = symbol_expression(unit.get_symbol(name))
+            if expr.error != None:
+                self.throw_error(lineno, 1, f"Invalid value of symbol '{name}': {expr.error}")
+            return expr.evaluate(lambda other: self.name_value(unit_index, other, lineno, pending | {name}))
+        if name in unit.labels:
+            return self.address(unit_index, name)
+        if name in self.globals:
+            return self.globals[name]
+        self.throw_error(lineno, 1, "Undefined symbol")
+
+    # Operand values are patched into the node stream in place. Identical
+    # operands share one expression, so each is only resolved once; callers
+    # relinking a changed unit may pass in the values of an earlier link
+    def resolve(self, unit_index: int, resolved: dict[OperandExpr, int]|None = None):
+        unit = self.units[unit_index]
+        self.use_unit(unit)
+        code = unit.result
+        instructions = code.instructions
+        expressions = code.expressions
+        values = code.value
+        if resolved == None:
+            resolved = {}
+        for index, (inst_id, operand_id) in enumerate(zip(code.inst, code.operand)):
+            inst_info = instructions[inst_id]
+            if not inst_info.hasarg:
+                continue
+            expr = expressions[operand_id]
+            value = resolved.get(expr)
+            if value == None:
+                value = resolved[expr] = self.resolve_operand(unit_index, expr, code.lineno[index])
+            if value < 0:
+                self.throw_error(code.lineno[index], 1, f"Value {value} is negative")
+            if value >= inst_info.maxarg or (inst_info.argsize != 0 and value >= 256 ** inst_info.argsize):
+                self.throw_error(code.lineno[index], 1, f"Value exceeds maximum of {inst_info.maxarg}")
+            values[index] = value
+
+    def link(self):
+        profiler = self.profiler
+        if profiler != None:
+            profiler.begin("resolve")
+        self.layout()
+        res = bytearray()
+        for unit_index, unit in enumerate(self.units):
+            self.resolve(unit_index)
+            if profiler != None:
+                profiler.begin("encode")
+            res += encode(unit)
+            if profiler != None:
+                profiler.end()
+        if profiler != None:
+            profiler.end()
+        return res
+
+
+def value_size(instruction: VmInstructionInfo, value: int):
+    if instruction.argsize != 0:
+        return instruction.argsize
+    # .word values take as many bytes as they need
+    return max(1, (value.bit_length() + 7) // 8)
+
+
+def link(compiler: Compiler, profiler=None):
+    linker = Linker([compiler])
+    linker.profiler = profiler
+    return linker.link()
+
+
+# Links objects compiled without an entry point, preceded by one that jumps to _main
+def link_objects(objects: list[Compiler]):
+    return Linker([Compiler()] + objects).link()
+
+
+def encode(compiler: Compiler):
+    code = compiler.result
+    instructions = code.instructions
+    operands = code.operands
+
+    # Padding is not emitted, so this is the exact image size unless a .word
+    # value spills over one byte
+    res = bytearray(compiler.byte_offset - compiler.padding_offset)
+    pos = 0
+    for inst_id, operand_id, value in zip(code.inst, code.operand, code.value):
+        inst_info = instructions[inst_id]
+        if inst_info.opcode_byte != None:
+            res[pos] = inst_info.opcode_byte
+            pos += 1
+
+        if inst_info is VM_DATA:
+            data = operands[operand_id].encode("latin-1")
+            res[pos:pos + len(data)] = data
+            pos += len(data)
+        elif inst_info is VM_ZERO:
+            # The image starts out zeroed
+            pos += int(operands[operand_id])
+        elif inst_info is VM_BINARY:
+            offset, length, path = operands[operand_id].split(" ", 2)
+            offset, length = int(offset), int(length)
+            try:
+                data = compiler.binary(path)
+            except OSError as e:
+                raise AsmError(f"LINKER ERROR: Cannot read {path}: {e.strerror}", -4)
+            if offset + length > len(data):
+                raise AsmError(f"LINKER ERROR: {path} is shorter than when it was compiled", -4)
+            with memoryview(data) as view:
+                res[pos:pos + length] = view[offset:offset + length]
+            pos += length
+        elif inst_info.hasarg:
+            size = value_size(inst_info, value)
+            if inst_info.argsize == 0 and size > 1:
+                res.extend(bytes(size - 1))
+            res[pos:pos + size] = value.to_bytes(size, byteorder='big')
+            pos += size
+
+    return res
+
+
+def assemble(code: str, opt_level: str = "0"):
+    compiler = compile(code, opt_level)
+    if opt_level != "0":
+        from .optimizer import optimize as peephole
+        peephole(compiler)
+    return bytes(link(compiler))
+
+
+def linked_code_to_hex_string(linked_code: bytes|bytearray):
+    return linked_code.hex().upper()
+
+
+# The output is written next to its destination and renamed over it, so
+# readers never see a partly written file
+def save(linked_code_repr: str, filepath: str = "vm_asm_out.txt"):
+    temp_path = f"{filepath}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "w") as outfile:
+            outfile.write(linked_code_repr)
+        os.replace(temp_path, filepath)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
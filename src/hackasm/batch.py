@@ -0,0 +1,86 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from .assembler import VM_INSTRUCTIONS, AsmError, VmInstructionInfo, compile_file, link, linked_code_to_hex_string, save
+from .cache import BuildCache
+from .optimizer import optimize
+
+
+class BuildResult:
+    __slots__ = ("source", "output", "size", "compile_time", "link_time", "cache_hit", "error", "exit_code",
+                 "dependencies")
+
+    def __init__(self, source: str, output: str) -> None:
+        self.source = source
+        self.output = output
+        self.size = 0
+        self.compile_time = 0.0
+        self.link_time = 0.0
+        self.cache_hit = False
+        self.error = None
+        self.exit_code = 0
+        # Files the output was built from: the source and everything it includes
+        self.dependencies = [os.path.abspath(source)]
+
+
+def output_paths(sources: list[str], directory: str):
+    outputs = {}
+    claimed = {}
+    for source in sources:
+        output = os.path.join(directory, os.path.splitext(os.path.basename(source))[0] + ".txt")
+        if output in claimed:
+            raise ValueError(f"'{claimed[output]}' and '{source}' would both be written to {output}")
+        claimed[output] = source
+        outputs[source] = output
+    return outputs
+
+
+# Assembles one source file into its own hex output. Runs in a worker process,
+# so everything it needs is passed in, including the instruction table the
+# unit starts from: each job compiles against its own copy and .inst
+# declarations never reach other files
+def build_file(source: str, output: str, opt_level: str, use_cache: bool,
+               instructions: dict[str, VmInstructionInfo]):
+    result = BuildResult(source, output)
+    cache = BuildCache() if use_cache else None
+    try:
+        start = time.perf_counter()
+        if cache == None:
+            compiler = compile_file(source, opt_level, True, instructions)
+        else:
+            compiler = cache.compile_file(source, opt_level, True, instructions)
+            result.cache_hit = cache.hits != 0
+        result.dependencies += compiler.included_files
+        if opt_level != "0":
+            optimize(compiler)
+        result.compile_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        linked_code = link(compiler)
+        save(linked_code_to_hex_string(linked_code), output)
+        result.link_time = time.perf_counter() - start
+        result.size = len(linked_code)
+    except AsmError as e:
+        result.error = str(e)
+        result.exit_code = e.exit_code
+    except OSError as e:
+        result.error = f"ERROR: {e}"
+        result.exit_code = -2
+    return result
+
+
+# Builds every source into <directory>/<name>.txt, using up to jobs worker
+# processes. Results are returned in the order of sources
+def build(sources: list[str], directory: str, opt_level: str = "0", jobs: int|None = None,
+          use_cache: bool = True, instructions: dict[str, VmInstructionInfo]|None = None):
+    outputs = output_paths(sources, directory)
+    os.makedirs(directory, exist_ok=True)
+    instructions = dict(VM_INSTRUCTIONS if instructions == None else instructions)
+    jobs = min(jobs or os.cpu_count() or 1, len(sources))
+    arguments = [(source, outputs[source], opt_level, use_cache, instructions) for source in sources]
+    if jobs <= 1:
+        return [build_file(*job) for job in arguments]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(build_file, *job) for job in arguments]
+        return [future.result() for future in futures]
@@ -0,0 +1,130 @@
+import os
+import json
+import hashlib
+import tempfile
+from typing import Iterable
+
+from .assembler import ASSEMBLER_VERSION, EXPANSION_MODES, VM_INSTRUCTIONS, SourceFile, VmInstructionInfo, compile
+from .objfile import OBJECT_VERSION, ObjectFormatError, dump_object, load_object_data
+
+
+DEFAULT_CACHE_DIR = ".hackasm_cache"
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+
+def file_digest(path: str):
+    try:
+        with open(path, "rb") as file:
+            return hashlib.sha256(file.read()).hexdigest()
+    except OSError:
+        return None
+
+
+# On-disk cache of compile() results, stored in the object file format.
+# Entries are keyed by the source text and the path it was read from, the
+# instruction table the unit starts from, the assembler version and the
+# compile options; the files a unit includes are recorded with their hashes
+# and checked on every hit. Recency is tracked through the entries'
+# modification times, and the least recently used ones are evicted once the
+# directory grows over max_size bytes
+class BuildCache:
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, max_size: int = DEFAULT_CACHE_SIZE) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, code: str|SourceFile, opt_level: str, source_path: str|None, entry: bool,
+            instructions: dict[str, VmInstructionInfo] = VM_INSTRUCTIONS):
+        digest = hashlib.sha256()
+        digest.update(f"{ASSEMBLER_VERSION}\0{OBJECT_VERSION}\0{opt_level}\0{entry}\0".encode())
+        # Entries record the name of their source file, and includes are
+        # resolved relative to it
+        path = os.path.abspath(source_path) if source_path != None else os.getcwd()
+        digest.update(path.encode() + b"\0")
+        for mnemonic, info in sorted(instructions.items()):
+            digest.update(f"{mnemonic}:{info.opcode}:{info.argsize}:{info.maxarg}:{info.cycles}\0".encode())
+        data = code.data if isinstance(code, SourceFile) else code
+        digest.update(data.encode() if isinstance(data, str) else data)
+        return digest.hexdigest()
+
+    def entry_path(self, key: str):
+        return os.path.join(self.directory, key + ".json")
+
+    def load(self, key: str, instructions: dict[str, VmInstructionInfo]|None = None):
+        path = self.entry_path(key)
+        try:
+            with open(path, "r") as file:
+                entry = json.load(file)
+            for dependency, digest in entry["dependencies"].items():
+                if file_digest(dependency) != digest:
+                    return None
+            compiler = load_object_data(entry["object"], instructions)
+            compiler.included_files = list(entry["dependencies"])
+            os.utime(path)
+        except (OSError, ValueError, KeyError, ObjectFormatError):
+            return None
+        return compiler
+
+    def store(self, key: str, compiler):
+        entry = {
+            "dependencies": {path: file_digest(path) for path in compiler.included_files},
+            "object": dump_object(compiler),
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        # Written to a temporary file first so concurrent builds never see half an entry
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as file:
+            json.dump(entry, file, separators=(",", ":"))
+        os.replace(temp_path, self.entry_path(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+        entries.sort()
+        while total > self.max_size and len(entries) > 1:
+            mtime, size, name = entries.pop(0)
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+
+    # Sources are hashed whole, so code given as an iterable of lines is
+    # compiled without using the cache
+    def compile(self, code: str|Iterable[str], opt_level: str = "0", source_path: str|None = None,
+                entry: bool = True, instructions: dict[str, VmInstructionInfo]|None = None, profiler=None):
+        if not isinstance(code, (str, SourceFile)):
+            return compile(code, opt_level, source_path, entry, instructions, profiler)
+        instructions = VM_INSTRUCTIONS if instructions == None else instructions
+        key = self.key(code, opt_level, source_path, entry, instructions)
+        compiler = self.load(key, instructions)
+        if compiler != None:
+            self.hits += 1
+            compiler.expansion_mode = EXPANSION_MODES[opt_level]
+            return compiler
+
+        self.misses += 1
+        compiler = compile(code, opt_level, source_path, entry, instructions, profiler)
+        try:
+            self.store(key, compiler)
+        except OSError:
+            # A read-only or full disk only costs the next build its cache hit
+            pass
+        return compiler
+
+    def compile_file(self, path: str, opt_level: str = "0", entry: bool = True,
+                     instructions: dict[str, VmInstructionInfo]|None = None, profiler=None):
+        return self.compile(SourceFile(path), opt_level, path, entry, instructions, profiler)
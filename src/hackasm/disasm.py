@@ -0,0 +1,207 @@
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+
+from .assembler import VM_INSTRUCTIONS, VmInstructionInfo
+from .vm import RELATIVE_JUMPS
+
+
+# Undecodable bytes shown per line. Runs of them are split at multiples of
+# this, so where a line starts depends only on the address decoding reached
+DATA_BYTES = 4
+# Images smaller than this per process are disassembled in one go
+MIN_CHUNK = 256 * 1024
+# Shows the printable ASCII characters of data as themselves, others as .
+PRINTABLE = bytes(byte if 32 <= byte < 127 else ord(".") for byte in range(256))
+
+
+# opcode byte -> (mnemonic, argument size, relative jump), None for bytes that
+# are not an instruction. Opcodes declared more than once keep the last one
+def decoding_table(instructions: dict[str, VmInstructionInfo] = VM_INSTRUCTIONS):
+    table: list[tuple[str, int, bool]|None] = [None] * 256
+    for mnemonic, info in instructions.items():
+        if info.opcode_byte != None and info.opcode_byte < 256:
+            table[info.opcode_byte] = (mnemonic.lower(), info.argsize, mnemonic in RELATIVE_JUMPS)
+    return table
+
+
+def load_image(path: str, binary: bool = False):
+    if binary:
+        with open(path, "rb") as file:
+            return file.read()
+    with open(path, "r") as file:
+        return bytes.fromhex(file.read())
+
+
+# A symbol map has one "<address> <label>" pair per line, as written by
+# hackasm --map
+def save_symbol_map(labels: dict[str, int], path: str):
+    with open(path, "w") as file:
+        for label, address in sorted(labels.items(), key=lambda item: (item[1], item[0])):
+            file.write(f"{address:#06x} {label}\n")
+
+
+def load_symbol_map(path: str):
+    labels: dict[str, int] = {}
+    with open(path, "r") as file:
+        for number, line in enumerate(file, 1):
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            try:
+                if len(fields) != 2:
+                    raise ValueError
+                labels[fields[1]] = int(fields[0], 0)
+            except ValueError:
+                raise ValueError(f"{path}:{number}: expected '<address> <label>'") from None
+    return labels
+
+
+# Decodes linked images linearly, in the manner of objdump. With labels,
+# each label address is taken to start an instruction: an instruction that
+# would run over one is shown as data instead, so decoding falls back into
+# step with the code after a string or buffer
+class Disassembler:
+    def __init__(self, instructions: dict[str, VmInstructionInfo] = VM_INSTRUCTIONS,
+                 labels: dict[str, int]|None = None) -> None:
+        self.table = decoding_table(instructions)
+        # address -> labels there, in the order they were defined
+        self.names: dict[int, list[str]] = {}
+        for label, address in (labels or {}).items():
+            self.names.setdefault(address, []).append(label)
+        self.boundaries = sorted(self.names)
+
+    # Names an address as <label> or <label+offset> after the closest label
+    # at or before it
+    def symbol(self, address: int):
+        index = bisect_right(self.boundaries, address) - 1
+        if index < 0:
+            return ""
+        start = self.boundaries[index]
+        label = self.names[start][-1]
+        return f" <{label}>" if start == address else f" <{label}+{address - start}>"
+
+    # Decodes from address start until reaching end. data holds the image
+    # from address base on, and may be a memoryview of a larger buffer.
+    # Returns the address each line starts at, the lines (label headings
+    # included) and the address decoding stopped at, which is past end if
+    # the last instruction straddles it
+    def decode(self, data: bytes|memoryview, base: int, start: int, end: int):
+        data = memoryview(data)
+        table = self.table
+        names = self.names
+        boundaries = self.boundaries
+        symbol = self.symbol
+        limit = base + len(data)
+        end = min(end, limit)
+        starts = array("Q")
+        lines: list[str] = []
+        add_start = starts.append
+        add_line = lines.append
+
+        index = bisect_right(boundaries, start)
+        boundary = boundaries[index] if index < len(boundaries) else limit
+        address = start
+        while address < end:
+            if address >= boundary:
+                index = bisect_right(boundaries, address)
+                boundary = boundaries[index] if index < len(boundaries) else limit
+            add_start(address)
+            # Label headings go in front of the line, one line per start
+            heading = "".join(f"\n{address:04x} <{label}>:\n" for label in names[address]) \
+                if address in names else ""
+
+            entry = table[data[address - base]]
+            if entry != None and address + 1 + entry[1] <= boundary:
+                mnemonic, argsize, relative = entry
+                nxt = address + 1 + argsize
+                encoded = data[address - base:nxt - base]
+                if argsize == 0:
+                    add_line(f"{heading}{address:04x}:  {encoded.hex(' '):<11} {mnemonic}")
+                    address = nxt
+                    continue
+                arg = int.from_bytes(encoded[1:], byteorder="big")
+                if relative:
+                    # Signed and measured from the jump itself
+                    if arg >= 0x8000:
+                        arg -= 0x10000
+                    target = address + arg
+                    add_line(f"{heading}{address:04x}:  {encoded.hex(' '):<11} {mnemonic} {arg}  "
+                             f"# -> {target:#06x}{symbol(target)}")
+                elif argsize >= 2:
+                    # Wide enough to be an address
+                    name = symbol(arg)
+                    comment = f"  #{name}" if name != "" else ""
+                    add_line(f"{heading}{address:04x}:  {encoded.hex(' '):<11} {mnemonic} {arg:#06x}{comment}")
+                else:
+                    add_line(f"{heading}{address:04x}:  {encoded.hex(' '):<11} {mnemonic} {arg:#04x}")
+                address = nxt
+                continue
+
+            # Not an instruction: gather bytes up to the next one that could be
+            nxt = min(address - address % DATA_BYTES + DATA_BYTES, boundary)
+            stop = address + 1
+            while stop < nxt and table[data[stop - base]] == None:
+                stop += 1
+            encoded = data[address - base:stop - base]
+            text = encoded.tobytes().translate(PRINTABLE).decode("ascii")
+            add_line(f"{heading}{address:04x}:  {encoded.hex(' '):<11} .byte  # {text}")
+            address = stop
+        return starts, lines, address
+
+    # Returns the listing of data as one string. With several jobs, the
+    # image is split into chunks disassembled by separate processes
+    def disassemble(self, data: bytes|memoryview, jobs: int|None = 1):
+        data = memoryview(data)
+        jobs = min(jobs or os.cpu_count() or 1, len(data) // MIN_CHUNK)
+        if jobs <= 1:
+            lines = self.decode(data, 0, 0, len(data))[1]
+            return "\n".join(lines) + "\n" if lines else ""
+
+        # Chunks start at label addresses where there are any, since those
+        # are known to be instruction boundaries
+        cuts = [0]
+        for chunk in range(1, jobs):
+            cut = len(data) * chunk // jobs
+            index = bisect_left(self.boundaries, cut)
+            if index < len(self.boundaries) and self.boundaries[index] < len(data) * (chunk + 1) // jobs:
+                cut = self.boundaries[index]
+            cuts.append(cut)
+        cuts.append(len(data))
+        # A chunk carries the bytes of an instruction or data line straddling
+        # its end
+        overlap = max(DATA_BYTES, 1 + max((entry[1] for entry in self.table if entry != None), default=0))
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(decode_chunk, self, bytes(data[start:end + overlap]), start, end)
+                       for start, end in zip(cuts, cuts[1:])]
+            chunks = [future.result() for future in futures]
+
+        # A chunk that did not start where the previous one stopped decodes
+        # misaligned until both sweeps reach the same instruction; from
+        # there on they agree. Until then the lines are decoded here again
+        _, _, text, stop = chunks[0]
+        parts = [text]
+        for (starts, positions, text, chunk_stop), end in zip(chunks[1:], cuts[2:]):
+            while stop < end:
+                index = bisect_left(starts, stop)
+                if index < len(starts) and starts[index] == stop:
+                    parts.append(text[positions[index]:])
+                    stop = chunk_stop
+                    break
+                _, lines, stop = self.decode(data, 0, stop, stop + 1)
+                parts.append("".join(line + "\n" for line in lines))
+        return "".join(parts)
+
+
+# Runs in a worker process. Returns the listing of a chunk as one string,
+# which is much cheaper to send back than the lines, with where each line
+# starts in it
+def decode_chunk(disassembler: Disassembler, data: bytes, start: int, end: int):
+    starts, lines, stop = disassembler.decode(data, start, start, end)
+    positions = array("Q")
+    position = 0
+    for line in lines:
+        positions.append(position)
+        position += len(line) + 1
+    return starts, positions, "\n".join(lines) + "\n" if lines else "", stop
@@ -0,0 +1,315 @@
+from array import array
+from bisect import bisect_left
+from itertools import islice
+
+from .assembler import (EXPANSION_MODES, AsmError, Compiler, Linker, MacroTemplate, OperandExpr, VmInstructionInfo,
+                        encode, split_segments)
+
+
+# Macros whose effect reaches past their own line: they change the state
+# later lines are compiled in, or read at compile time what other lines define
+STRUCTURAL_MACROS = {"SECTION", "SET", "INST", "GLOBAL", "EXTERN", "PAD", "ASCII", "PUSHSTR", "MACRO", "ENDM", "BOUND"}
+
+
+# Lines of text, without the "\r" of CRLF line endings, as SourceFile reads
+# them for a full compilation
+def split_lines(text: str):
+    return [line[:-1] if line.endswith("\r") else line for line in text.split("\n")]
+
+
+class LineResult:
+    __slots__ = ("size", "labels", "macro", "error")
+
+    def __init__(self) -> None:
+        self.size = 0
+        # Labels the line defined, local ones included
+        self.labels: tuple[str, ...] = ()
+        # ((macro, variant), uses, nodes, bytes, cycles) added to Compiler.macro_stats
+        self.macro = None
+        self.error: AsmError|None = None
+
+
+# The document as seen by Compiler.throw_error
+class DocumentLines:
+    def __init__(self, lines: list[str]) -> None:
+        self.lines = lines
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, index: int):
+        return self.lines[index]
+
+    def location(self, index: int):
+        return str(index + 1)
+
+
+# Keeps a compiled document up to date as it is edited. Every line is
+# compiled on its own, so a line with an error is reported and skipped
+# instead of stopping the compilation. Edits to lines that only emit code or
+# data and define labels are recompiled alone: their nodes are spliced into
+# the node stream and everything after them is shifted in place. Anything
+# else (sections, symbols, strings, OVERRIDE sections...) recompiles
+# the whole document. Linking reuses the operand values of the previous link
+# except for operands that name a label that was moved, added or removed
+class IncrementalAssembler:
+    def __init__(self, text: str = "", opt_level: str = "0", source_path: str|None = None,
+                 instructions: dict[str, VmInstructionInfo]|None = None) -> None:
+        self.expansion_mode = EXPANSION_MODES[opt_level]
+        self.source_path = source_path
+        self.instructions = instructions
+        self.lines: list[str] = []
+        self.results: list[LineResult] = []
+        # Byte offset and section each line starts at
+        self.starts = array("I")
+        self.sections: list[str|None] = []
+        self.errors = 0
+        self.incremental = False
+        self.resolved: dict[OperandExpr, int] = {}
+        self.label_expressions: dict[str, set[OperandExpr]] = {}
+        self.indexed = 0
+        self.changed_labels: set[str] = set()
+        self.rebuilds = 0
+        self.updates = 0
+        self.set_text(text)
+
+    def set_text(self, text: str):
+        self.lines[:] = split_lines(text)
+        self.rebuild()
+
+    def rebuild(self):
+        compiler = self.compiler = Compiler(self.expansion_mode, self.source_path, True, self.instructions)
+        compiler.lines = DocumentLines(self.lines)
+        self.prologue = len(compiler.result)
+        self.results = []
+        self.starts = array("I")
+        self.sections = []
+        for index, line in enumerate(self.lines):
+            self.starts.append(compiler.byte_offset)
+            self.sections.append(compiler.section)
+            self.results.append(self.compile_line(index, line))
+        if compiler.definition != None:
+            # Its body swallowed the rest of the document
+            try:
+                compiler.throw_error(compiler.definition.start, None, "Expected .endm before the end of the file")
+            except AsmError as e:
+                self.results[compiler.definition.start].error = e
+        self.errors = sum(1 for result in self.results if result.error != None)
+        self.incremental = "OVERRIDE" not in self.sections and compiler.section != "OVERRIDE" \
+            and compiler.definition == None
+        if compiler.section == 'OVERRIDE':
+            compiler.byte_offset = compiler.concrete_offset
+        self.resolved = {}
+        self.label_expressions = {}
+        self.indexed = 0
+        self.changed_labels = set()
+        self.rebuilds += 1
+
+    def compile_line(self, index: int, line: str):
+        compiler = self.compiler
+        code = compiler.result
+        result = LineResult()
+        segments = split_segments(line)
+        if len(segments) == 0:
+            return result
+
+        rows = len(code)
+        labels = len(compiler.labels)
+        state = (compiler.byte_offset, compiler.padding_offset, compiler.concrete_offset, compiler.override_offset,
+                 compiler.section)
+        macro = segments[0].replace('.', '').upper() if segments[0][0] == '.' else None
+        stats = {key: (value.uses, value.nodes, value.bytes, value.cycles)
+                 for key, value in compiler.macro_stats.items() if key[0] == macro}
+        try:
+            if macro == "INCLUDE":
+                # Included lines would need line numbers of their own
+                compiler.throw_error(index, 0, "Includes are not supported while editing")
+            compiler.compile_line(index, segments)
+        except AsmError as e:
+            # Leave nothing of the line behind
+            code.truncate(rows)
+            for label in list(islice(reversed(compiler.labels), len(compiler.labels) - labels)):
+                del compiler.labels[label]
+                compiler.local_labels.discard(label)
+                compiler.fixed_labels.discard(label)
+            (compiler.byte_offset, compiler.padding_offset, compiler.concrete_offset, compiler.override_offset,
+             compiler.section) = state
+            result.error = e
+            return result
+
+        result.size = compiler.byte_offset - state[0]
+        if len(compiler.labels) != labels:
+            result.labels = tuple(islice(reversed(compiler.labels), len(compiler.labels) - labels))
+        if macro != None:
+            key = (macro, compiler.macro_variant or "")
+            if key in compiler.macro_stats:
+                after = compiler.macro_stats[key]
+                uses, nodes, size, cycles = stats.get(key, (0, 0, 0, 0))
+                if after.uses != uses:
+                    result.macro = (key, after.uses - uses, after.nodes - nodes, after.bytes - size,
+                                    after.cycles - cycles)
+        return result
+
+    def structural(self, line: str):
+        # -O2 and -Os pick the form of .jump from the code at its target,
+        # which any line may be part of, and only when the target comes
+        # first in the document. User macros may hold .jumps too
+        if self.expansion_mode != "default" and (self.compiler.macros or
+                                                 any(key[0] == "JUMP" for key in self.compiler.macro_stats)):
+            return True
+        segments = split_segments(line)
+        if len(segments) == 0 or segments[0][0] != '.':
+            return False
+        macro = segments[0].replace('.', '').upper()
+        if macro in STRUCTURAL_MACROS or macro == "JUMP" and self.expansion_mode != "default":
+            return True
+        if macro in self.compiler.macros:
+            return self.structural_macro(self.compiler.macros[macro], set())
+        if macro == "LABEL":
+            compiler = self.compiler
+            # The entry point, names clashing with other symbols, and labels
+            # .pushstr may have looked up. With errors elsewhere, a label may
+            # be what another line is failing on
+            return len(segments) != 2 or segments[1] == "_main" or segments[1] in compiler.symbols \
+                or segments[1] in compiler.externs or self.errors != 0 \
+                or any(key[0] == "PUSHSTR" for key in compiler.macro_stats)
+        return False
+
+    # Whether expanding a user macro may use a structural macro
+    def structural_macro(self, template: MacroTemplate, seen: set[str]):
+        seen.add(template.name)
+        for segments in template.lines:
+            opcode = segments[0]
+            if not isinstance(opcode, str):
+                return True
+            macro = opcode.replace('.', '').upper() if opcode[0] == '.' else None
+            if macro in STRUCTURAL_MACROS:
+                return True
+            if macro in self.compiler.macros and macro not in seen \
+                    and self.structural_macro(self.compiler.macros[macro], seen):
+                return True
+        return False
+
+    # Whether lines start to end overlap a macro definition
+    def in_definition(self, start: int, end: int):
+        return any(end > template.start and start <= template.end for template in self.compiler.macros.values())
+
+    def row(self, line: int):
+        return max(bisect_left(self.compiler.result.lineno, line), self.prologue)
+
+    # Replaces lines start to end with new_lines
+    def update(self, start: int, end: int, new_lines: list[str]):
+        old_lines = self.lines[start:end]
+        self.lines[start:end] = new_lines
+        if not self.incremental or self.in_definition(start, end) \
+                or any(self.structural(line) for line in old_lines) or any(self.structural(line) for line in new_lines):
+            self.rebuild()
+            return
+
+        compiler = self.compiler
+        code = compiler.result
+        removed = {label for result in self.results[start:end] for label in result.labels}
+        defined = [segments[1] for segments in map(split_segments, new_lines)
+                   if len(segments) == 2 and segments[0].replace('.', '').upper() == "LABEL"]
+        if len(set(defined)) != len(defined) or any(label in compiler.labels and label not in removed
+                                                     for label in defined):
+            # Let the full compilation decide which definition is the duplicate
+            self.rebuild()
+            return
+        self.updates += 1
+
+        first_row = self.row(start)
+        last_row = self.row(end)
+        for result in self.results[start:end]:
+            for label in result.labels:
+                del compiler.labels[label]
+                compiler.local_labels.discard(label)
+            if result.macro != None:
+                key, uses, nodes, size, cycles = result.macro
+                stats = compiler.macro_stats[key]
+                stats.uses -= uses
+                stats.nodes -= nodes
+                stats.bytes -= size
+                stats.cycles -= cycles
+        self.changed_labels.update(removed)
+
+        end_offset = compiler.byte_offset
+        end_section = compiler.section
+        old_end = self.starts[end] if end < len(self.starts) else end_offset
+        section = self.sections[start] if start < len(self.sections) else end_section
+        compiler.byte_offset = self.starts[start] if start < len(self.starts) else end_offset
+        compiler.section = section
+        tail = len(code)
+        results = []
+        starts = array("I")
+        for index, line in enumerate(new_lines, start):
+            starts.append(compiler.byte_offset)
+            results.append(self.compile_line(index, line))
+            self.changed_labels.update(results[-1].labels)
+        shift = compiler.byte_offset - old_end
+        line_shift = len(new_lines) - (end - start)
+        self.errors += sum(1 for result in results if result.error != None) \
+            - sum(1 for result in self.results[start:end] if result.error != None)
+
+        downstream = first_row + len(code) - tail
+        code.splice(first_row, last_row, tail)
+        if shift != 0 or line_shift != 0:
+            offsets = code.offset
+            linenos = code.lineno
+            for row in range(downstream, len(code)):
+                offsets[row] += shift
+                linenos[row] += line_shift
+        if shift != 0:
+            for result in self.results[end:]:
+                for label in result.labels:
+                    compiler.labels[label] += shift
+                    self.changed_labels.add(label)
+            compiler.strings = {address + shift if address >= old_end else address: string
+                                for address, string in compiler.strings.items()}
+            for index in range(end, len(self.starts)):
+                self.starts[index] += shift
+
+        self.starts[start:end] = starts
+        self.sections[start:end] = [section] * len(new_lines)
+        self.results[start:end] = results
+        compiler.byte_offset = end_offset + shift
+        compiler.section = end_section
+
+    # Entries are indexed in the order they were resolved in
+    def index_resolved(self):
+        for expr in islice(self.resolved, self.indexed, None):
+            for name in self.compiler.referenced_names(expr):
+                self.label_expressions.setdefault(name, set()).add(expr)
+        self.indexed = len(self.resolved)
+
+    def invalidate(self):
+        self.index_resolved()
+        for label in self.changed_labels:
+            for expr in self.label_expressions.pop(label, ()):
+                if self.resolved.pop(expr, None) != None:
+                    self.indexed -= 1
+        self.changed_labels.clear()
+
+    def link(self):
+        linker = Linker([self.compiler])
+        linker.layout()
+        self.invalidate()
+        try:
+            linker.resolve(0, self.resolved)
+        finally:
+            self.index_resolved()
+        return bytes(encode(self.compiler))
+
+    # Errors of every line, or the link error if all lines compiled
+    def diagnostics(self):
+        errors = [result.error for result in self.results if result.error != None]
+        if errors:
+            return errors
+        try:
+            self.link()
+        except AsmError as e:
+            return [e]
+        return []
+
+    def label_lines(self):
+        return {label: index for index, result in enumerate(self.results) for label in result.labels}
@@ -0,0 +1,491 @@
+from bisect import bisect_right
+
+from .assembler import VM_ZERO, Compiler, symbol_expression
+from .optimizer import KNOWN, WRITES_FLAGS
+from .prune import RELATIVE_JUMPS, Block, Pruner, node_size
+from .vm import MEMORY_SIZE
+
+
+ABSOLUTE_JUMPS = {"JE", "JL", "JLE", "JG", "JGE"}
+# Rows of the unconditional jumps: the safe .jump and .fastjump (and the fast
+# .jump). X is never below 0, so CMPX 0 makes JGE always branch
+SAFE_JUMP = ["PUSHX", "LDX", "CMPX", "POPX", "JE"]
+FAST_JUMP = ["CMPX", "JGE"]
+# Address expressions are followed through at most this many symbols
+MAX_SYMBOL_DEPTH = 16
+
+
+class LayoutReport:
+    __slots__ = ("moved_chunks", "removed_jumps", "fast_jumps", "trimmed_bytes", "saved_bytes", "skipped")
+
+    def __init__(self) -> None:
+        self.moved_chunks = 0
+        self.removed_jumps = 0
+        self.fast_jumps = 0
+        self.trimmed_bytes = 0
+        self.saved_bytes = 0
+        self.skipped = None
+
+
+# A routine or data block placed as a whole: a labelled block and the blocks
+# control falls into from it, plus any blocks an operand reaches into by an
+# offset from one of its labels. jump is the unconditional jump it ends with
+# ("safe", "fast" or "entry" for the jump to _main in front of a program),
+# with its rows, and target the chunk it jumps to. first and last chunks stay
+# at the start and end of their unit; closing ones fall off the end of the
+# image and get a RET if anything is placed after them
+class Chunk:
+    __slots__ = ("index", "blocks", "start", "end", "jump", "rows", "target", "first", "last", "closing",
+                 "prev", "next")
+
+    def __init__(self, index: int, blocks: list[Block]) -> None:
+        self.index = index
+        self.blocks = blocks
+        self.start = blocks[0].start
+        self.end = blocks[-1].end
+        self.jump = None
+        self.rows: list[int] = []
+        self.target: Chunk|None = None
+        self.first = False
+        self.last = False
+        self.closing = False
+        self.prev: Chunk|None = None
+        self.next: Chunk|None = None
+
+    def head(self):
+        chunk = self
+        while chunk.prev != None:
+            chunk = chunk.prev
+        return chunk
+
+    def tail(self):
+        chunk = self
+        while chunk.next != None:
+            chunk = chunk.next
+        return chunk
+
+
+# Rearranges the routines and data blocks of each unit before linking.
+# Placement otherwise follows the source: the planner puts every routine right
+# after the routine ending in a jump to it, so the jump can go (routines
+# branched to most often are placed first), turns the remaining safe .jumps
+# into the cheaper .fastjump form and moves zero-filled buffers past the end
+# of the image of the last unit, where they take up addresses but no bytes.
+# The jump to _main in front of a program goes the same way when _main can
+# come first. A .pad reserves addresses without bytes, leaving a gap that
+# parts the addresses of what follows from its place in the image; in the
+# last unit the blocks after a gap are placed into it and the reserved
+# addresses follow the zero-filled buffers. Units are otherwise planned only
+# up to the first address that is not where its bytes are: everything after
+# it keeps its place (shifted by what the planner saved before it), as do the
+# addresses OVERRIDE sections fix. Jumps to code that reads the flags before
+# comparing are left alone
+class LayoutPlanner:
+    def __init__(self, units: list[Compiler]) -> None:
+        self.units = units
+        # Splits units into blocks the same way pruning does
+        self.pruner = Pruner(units)
+
+    def mnemonic(self, unit: int, row: int):
+        return self.pruner.mnemonic(unit, row)
+
+    def operand(self, unit: int, row: int):
+        return self.pruner.operand(unit, row)
+
+    # The prologue compiled in front of a program: CMPX 0, JE _main
+    def is_entry(self, unit_index: int, block: Block):
+        code = self.units[unit_index].result
+        return block.rows == [0, 1] and code.offset[0] == 0 and code.lineno[0] == 0 and code.lineno[1] == 0 \
+            and [self.mnemonic(unit_index, row) for row in block.rows] == ["CMPX", "JE"] \
+            and self.operand(unit_index, 0) == 0 and code.operands[code.operand[1]] == "_main"
+
+    # (label, offset) for operands such as buf+3 or msg|1, which point into
+    # the chunk of a label
+    def address_form(self, unit: Compiler, tree, depth: int = 0):
+        if isinstance(tree, str):
+            if tree in unit.symbols and depth < MAX_SYMBOL_DEPTH:
+                return self.address_form(unit, symbol_expression(unit.symbols[tree]).tree, depth + 1)
+            return (tree, 0) if tree in unit.labels and tree not in unit.fixed_labels else None
+        if not isinstance(tree, tuple):
+            return None
+        if tree[0] in ("hi", "lo"):
+            return self.address_form(unit, tree[1], depth)
+        if tree[0] == "+" and isinstance(tree[1], int):
+            form = self.address_form(unit, tree[2], depth)
+        elif tree[0] in ("+", "-") and isinstance(tree[2], int):
+            form = self.address_form(unit, tree[1], depth)
+        else:
+            return None
+        if form == None:
+            return None
+        offset = tree[1] if isinstance(tree[1], int) else tree[2] if tree[0] == "+" else -tree[2]
+        return (form[0], form[1] + offset)
+
+    def chunks(self, unit_index: int, blocks: list[Block]):
+        chunks: list[Chunk] = []
+        entry = False
+        for block in blocks:
+            previous = chunks[-1].blocks[-1] if chunks else None
+            # Gaps are chunks of their own
+            if previous == None or not block.rows or not previous.rows \
+                    or block.labels and (entry or not previous.code or not self.pruner.falls_through(previous)):
+                chunks.append(Chunk(len(chunks), [block]))
+            else:
+                chunks[-1].blocks.append(block)
+            entry = len(chunks) == 1 and len(chunks[0].blocks) == 1 and self.is_entry(unit_index, block)
+        return chunks
+
+    # Operands reaching from a label into other chunks (buf+4 past the end of
+    # buf, msg_end-msg) keep those chunks together and in order
+    def glue(self, unit_index: int, chunks: list[Chunk], end: int):
+        unit = self.units[unit_index]
+        code = unit.result
+        starts = [chunk.start for chunk in chunks]
+
+        def chunk_at(address: int):
+            if address < 0 or address > end:
+                return None
+            return min(max(bisect_right(starts, address) - 1, 0), len(chunks) - 1)
+
+        reach = list(range(len(chunks)))
+        for row in range(len(code)):
+            if not code.instructions[code.inst[row]].hasarg or self.mnemonic(unit_index, row) in RELATIVE_JUMPS:
+                continue
+            expr = code.expressions[code.operand[row]]
+            indices = {chunk_at(unit.labels[name]) for name in unit.referenced_names(expr)
+                       if name in unit.labels and name not in unit.fixed_labels}
+            form = self.address_form(unit, expr.tree)
+            if form != None and form[1] != 0:
+                owner = chunk_at(unit.labels[form[0]])
+                target = unit.labels[form[0]] + form[1]
+                if owner != None and not chunks[owner].start <= target <= chunks[owner].end:
+                    indices.add(chunk_at(target) if target <= end else len(chunks) - 1)
+            indices.discard(None)
+            if len(indices) > 1:
+                reach[min(indices)] = max(reach[min(indices)], max(indices))
+
+        merged: list[Chunk] = []
+        furthest = -1
+        for index, chunk in enumerate(chunks):
+            if index <= furthest:
+                merged[-1].blocks += chunk.blocks
+                merged[-1].end = chunk.end
+            else:
+                chunk.index = len(merged)
+                merged.append(chunk)
+            furthest = max(furthest, reach[index])
+        return merged
+
+    def find_jump(self, unit_index: int, chunk: Chunk, starts: dict[int, Chunk]):
+        unit = self.units[unit_index]
+        code = unit.result
+        block = chunk.blocks[-1]
+        if not block.code:
+            return
+        rows = block.rows[-5:]
+        mnemonics = [self.mnemonic(unit_index, row) for row in rows]
+        if chunk.index == 0 and len(chunk.blocks) == 1 and self.is_entry(unit_index, block):
+            chunk.jump, chunk.rows = "entry", rows[-2:]
+        elif mnemonics == SAFE_JUMP and self.operand(unit_index, rows[1]) == 0 \
+                and self.operand(unit_index, rows[2]) == 0:
+            chunk.jump, chunk.rows = "safe", rows
+        elif mnemonics[-2:] == FAST_JUMP and self.operand(unit_index, rows[-2]) == 0:
+            chunk.jump, chunk.rows = "fast", rows[-2:]
+        else:
+            return
+        label = code.expressions[code.operand[chunk.rows[-1]]].tree
+        if isinstance(label, str) and label in unit.labels and label not in unit.fixed_labels \
+                and label not in unit.symbols:
+            target = starts.get(unit.labels[label])
+            if target != None and target is not chunk and not target.first \
+                    and self.sets_flags(unit_index, target):
+                chunk.target = target
+
+    # Whether the code at the start of chunk compares before anything reads
+    # the flags. Only then may the jump to it go or change form, since each
+    # form leaves different flags behind
+    def sets_flags(self, unit_index: int, chunk: Chunk):
+        for block in chunk.blocks:
+            if not block.code:
+                return False
+            for row in block.rows:
+                mnemonic = self.mnemonic(unit_index, row)
+                if mnemonic in WRITES_FLAGS:
+                    return True
+                if mnemonic not in KNOWN or mnemonic in ABSOLUTE_JUMPS or mnemonic in RELATIVE_JUMPS \
+                        or mnemonic == "RET":
+                    return False
+        return False
+
+    # Branches to the start of every chunk
+    def branches(self, unit_index: int, chunks: list[Chunk], starts: dict[int, Chunk]):
+        unit = self.units[unit_index]
+        code = unit.result
+        counts: dict[Chunk, int] = {}
+        for chunk in chunks:
+            for block in chunk.blocks:
+                for row in block.rows:
+                    mnemonic = self.mnemonic(unit_index, row)
+                    if mnemonic in RELATIVE_JUMPS:
+                        address = code.offset[row] + self.operand(unit_index, row)
+                    elif mnemonic in ABSOLUTE_JUMPS:
+                        label = code.expressions[code.operand[row]].tree
+                        if not isinstance(label, str) or label not in unit.labels or label in unit.fixed_labels:
+                            continue
+                        address = unit.labels[label]
+                    else:
+                        continue
+                    if address in starts:
+                        counts[starts[address]] = counts.get(starts[address], 0) + 1
+        return counts
+
+    # Links each chunk ending in a jump to the chunk it jumps to, most
+    # branched-to targets first, without closing a loop or putting anything
+    # before a first chunk or after a last one
+    def chain(self, chunks: list[Chunk], counts: dict[Chunk, int]):
+        sources = sorted((chunk for chunk in chunks if chunk.target != None),
+                         key=lambda chunk: (-counts.get(chunk.target, 0), chunk.index))
+        for chunk in sources:
+            target = chunk.target
+            if chunk.next != None or target.prev != None or chunk.last:
+                continue
+            head = chunk.head()
+            tail = target.tail()
+            if head is target or head.first and tail.last:
+                continue
+            chunk.next = target
+            target.prev = chunk
+
+    # The addresses a .pad reserves from start to end, as a block without rows
+    def gap(self, unit_index: int, start: int, end: int):
+        unit = self.units[unit_index]
+        labels = [label for label, address in unit.labels.items()
+                  if start <= address < end and label not in unit.fixed_labels]
+        block = Block(unit_index, -1, start, labels, False)
+        block.end = end
+        return block
+
+    # The blocks of a unit that can be placed, the blocks after them that keep
+    # their place, and the address where the former end. The region ends
+    # where addresses and image positions part ways or, when gaps are taken
+    # in, only at padding inside a block
+    def region(self, unit_index: int, gaps: bool):
+        unit = self.units[unit_index]
+        blocks = self.pruner.blocks[unit_index]
+        region: list[Block] = []
+        end = 0
+        for index, block in enumerate(blocks):
+            if block.start < end or block.start > end and not gaps \
+                    or sum(node_size(unit, row) for row in block.rows) != block.end - block.start:
+                return region, blocks[index:], end
+            if block.start > end:
+                region.append(self.gap(unit_index, end, block.start))
+            region.append(block)
+            end = block.end
+        if gaps and unit.byte_offset > end:
+            region.append(self.gap(unit_index, end, unit.byte_offset))
+            end = unit.byte_offset
+        return region, [], end
+
+    # Gaps can only move past the end of the image, after the first chunk,
+    # and without code running into them
+    def gaps_movable(self, region: list[Block], chunks: list[Chunk], tail: list[Block], at_end: bool):
+        if tail or at_end or not region[0].rows:
+            return False
+        for previous, block in zip(region, region[1:]):
+            if not block.rows and previous.code and self.pruner.falls_through(previous):
+                return False
+        return all(len(chunk.blocks) == 1 for chunk in chunks if not all(block.rows for block in chunk.blocks))
+
+    def plan(self, unit_index: int, last_unit: bool, report: LayoutReport):
+        unit = self.units[unit_index]
+        code = unit.result
+        instructions = code.instructions
+
+        for gaps in ((True, False) if last_unit else (False,)):
+            region, tail, end = self.region(unit_index, gaps)
+            if not region:
+                return
+            chunks = self.glue(unit_index, self.chunks(unit_index, region), end)
+            at_end = any(address == end for label, address in unit.labels.items()
+                         if label not in unit.fixed_labels)
+            if all(block.rows for block in region) or self.gaps_movable(region, chunks, tail, at_end):
+                break
+
+        chunks[0].first = True
+        final = chunks[-1]
+        if final.blocks[-1].code and self.pruner.falls_through(final.blocks[-1]) and final.jump == None:
+            if last_unit and not tail and not at_end:
+                final.closing = True
+            else:
+                final.last = True
+        elif at_end and not tail:
+            final.last = True
+
+        starts = {chunk.start: chunk for chunk in chunks}
+        for chunk in chunks:
+            self.find_jump(unit_index, chunk, starts)
+        self.chain(chunks, self.branches(unit_index, chunks, starts))
+
+        # Zero-filled buffers at the very end of the image need no bytes in
+        # it, and neither do gaps (which have no rows)
+        trim = last_unit and not tail and not at_end
+        zeros = [chunk for chunk in chunks if trim and chunk.prev == None and chunk.next == None
+                 and not chunk.first and not chunk.last and not chunk.blocks[0].code
+                 and all(instructions[code.inst[row]] is VM_ZERO for block in chunk.blocks for row in block.rows)]
+        heads = [chunk for chunk in chunks if chunk.prev == None and chunk not in zeros]
+        heads.sort(key=lambda chunk: (not chunk.first, chunk.tail().last, chunk.index))
+        placed: list[Chunk] = []
+        for head in heads + zeros:
+            chunk = head
+            while chunk != None:
+                placed.append(chunk)
+                chunk = chunk.next
+        self.apply(unit_index, placed, zeros, end, tail, report)
+
+    def apply(self, unit_index: int, placed: list[Chunk], zeros: list[Chunk], end: int, tail: list[Block],
+              report: LayoutReport):
+        unit = self.units[unit_index]
+        code = unit.result
+        old_offsets = code.offset[:]
+        # old address -> new address of every row in the region, removed ones
+        # included (they are where the code after them now is)
+        addresses: dict[int, int] = {}
+        rows: list[int] = []
+        trimmed = 0
+        address = 0
+        for position, chunk in enumerate(placed):
+            following = placed[position + 1] if position + 1 < len(placed) else None
+            dropped = set()
+            if chunk.target != None and chunk.target is following:
+                dropped = set(chunk.rows)
+                report.removed_jumps += 1
+            elif chunk.jump == "safe" and chunk.target != None:
+                # PUSHX, LDX 0, CMPX 0, POPX, JE -> CMPX 0, JGE
+                dropped = {chunk.rows[0], chunk.rows[1], chunk.rows[3]}
+                code.inst[chunk.rows[4]] = code.intern_instruction(unit.instructions["JGE"])
+                report.fast_jumps += 1
+            if position == 0 and chunk.index != 0 or position > 0 and placed[position - 1].index != chunk.index - 1:
+                report.moved_chunks += 1
+
+            for block in chunk.blocks:
+                if not block.rows:
+                    addresses.setdefault(block.start, address)
+                    address += block.end - block.start
+                for row in block.rows:
+                    addresses.setdefault(old_offsets[row], address)
+                    if row in dropped:
+                        continue
+                    code.offset[row] = address
+                    address += node_size(unit, row)
+                    if chunk in zeros:
+                        trimmed += node_size(unit, row)
+                    else:
+                        rows.append(row)
+            if chunk.closing and following != None and following not in zeros:
+                last = chunk.blocks[-1].rows[-1]
+                code.append(unit.instructions["RET"], "", address, code.lineno[last])
+                rows.append(len(code) - 1)
+                address += 1
+        shift = address - end
+
+        def new_address(old: int):
+            if old in addresses:
+                return addresses[old]
+            if old >= end:
+                return old + shift
+            # Inside a row, such as a relative jump into an instruction
+            row_starts = sorted(addresses)
+            start = row_starts[max(bisect_right(row_starts, old) - 1, 0)]
+            return addresses[start] + old - start
+
+        for block in tail:
+            for row in block.rows:
+                code.offset[row] = old_offsets[row] + shift
+                rows.append(row)
+        for row in rows:
+            if row < len(old_offsets) and self.mnemonic(unit_index, row) in RELATIVE_JUMPS:
+                target = old_offsets[row] + self.operand(unit_index, row)
+                distance = new_address(target) - new_address(old_offsets[row])
+                code.operand[row] = code.intern_operand(str(distance), True)
+        code.reorder(rows)
+
+        for label, address in unit.labels.items():
+            if label not in unit.fixed_labels:
+                unit.labels[label] = new_address(address)
+        unit.strings = {new_address(address): string for address, string in unit.strings.items()}
+        unit.byte_offset = new_address(unit.byte_offset)
+        unit.concrete_offset = new_address(unit.concrete_offset)
+        unit.padding_offset += trimmed
+        report.trimmed_bytes += trimmed
+
+    def run(self):
+        report = LayoutReport()
+        report.skipped = self.pruner.check()
+        if report.skipped != None:
+            return report
+        size = sum(unit.byte_offset - unit.padding_offset for unit in self.units)
+        for unit_index in range(len(self.units)):
+            self.pruner.split(unit_index)
+        for unit_index in range(len(self.units)):
+            self.plan(unit_index, unit_index == len(self.units) - 1, report)
+        report.saved_bytes = size - sum(unit.byte_offset - unit.padding_offset for unit in self.units)
+        return report
+
+
+def plan_layout(units: list[Compiler]):
+    return LayoutPlanner(units).run()
+
+
+# What every address of the linked program holds, as (start, end, kind,
+# labels) regions: "code", "data" and "zero" bytes of the image, "padding"
+# (addresses reserved past or between the bytes of the image) and "fixed"
+# addresses named by OVERRIDE sections, which may fall inside the image.
+# bases are where the linker placed each unit
+def memory_map(units: list[Compiler], bases: list[int]|None = None):
+    regions: list[tuple[int, int, str, list[str]]] = []
+    fixed: list[tuple[int, int, str, list[str]]] = []
+    bases = bases if bases != None else [0] * len(units)
+    for unit, base in zip(units, bases):
+        code = unit.result
+        names: dict[int, list[str]] = {}
+        for label, address in unit.labels.items():
+            if label in unit.local_labels:
+                continue
+            if label in unit.fixed_labels:
+                fixed.append((address, address, "fixed", [label]))
+            else:
+                names.setdefault(address, []).append(label)
+
+        region = None
+        end = 0
+        for row in range(len(code)):
+            offset = code.offset[row]
+            info = code.instructions[code.inst[row]]
+            kind = "code" if info.opcode_byte != None else "zero" if info is VM_ZERO else "data"
+            if offset > end:
+                region = None
+                regions.append((base + end, base + offset, "padding", []))
+            if region == None or offset in names or kind != region[2]:
+                region = [base + offset, base + offset, kind, names.get(offset, [])]
+                regions.append(region)
+            end = offset + node_size(unit, row)
+            region[1] = base + end
+        if unit.byte_offset > end:
+            inside = [label for address, labels in sorted(names.items()) if end <= address < unit.byte_offset
+                      for label in labels]
+            regions.append((base + end, base + unit.byte_offset, "padding", inside))
+    return [tuple(region) for region in regions] + sorted(fixed)
+
+
+def format_memory_map(regions: list[tuple[int, int, str, list[str]]], image_size: int):
+    lines = ["Memory map:"]
+    for start, end, kind, labels in regions:
+        span = f"{start:#06x}-{end - 1:#06x}" if end > start else f"{start:#06x}       "
+        size = f"{end - start:>5}" if end > start else "    -"
+        names = ", ".join(labels) or ("(entry)" if start == 0 and kind == "code" else "")
+        note = " (inside the image)" if kind == "fixed" and start < image_size else ""
+        lines.append(f"  {span} {size}  {kind:<8} {names}{note}".rstrip())
+    top = max((end for _, end, kind, _ in regions if kind != "fixed"), default=0)
+    lines.append(f"  {max(MEMORY_SIZE - top, 0)} of {MEMORY_SIZE} byte(s) free above {top:#06x}")
+    return "\n".join(lines)
@@ -0,0 +1,222 @@
+import re
+import json
+from typing import BinaryIO
+from urllib.parse import unquote, urlparse
+
+from .assembler import ASSEMBLER_VERSION, split_segments
+from .incremental import IncrementalAssembler, split_lines
+
+
+# LSP symbol kinds
+SYMBOL_FUNCTION = 12
+SYMBOL_VARIABLE = 13
+SYMBOL_CONSTANT = 14
+SEVERITY_ERROR = 1
+# Text documents are synced by sending only the changed ranges
+SYNC_INCREMENTAL = 2
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+
+WORD = re.compile(r"[A-Za-z0-9_]+")
+
+
+def uri_path(uri: str):
+    parsed = urlparse(uri)
+    return unquote(parsed.path) if parsed.scheme == "file" else None
+
+
+def line_range(line: int, column: int, width: int):
+    return {"start": {"line": line, "character": column}, "end": {"line": line, "character": column + width}}
+
+
+# Language server speaking JSON-RPC over a pair of binary streams (stdin and
+# stdout when started with `hackasm lsp`). Every open document is kept in an
+# IncrementalAssembler, which is updated with the ranges the editor sends and
+# publishes its diagnostics after each change. Positions are taken to count
+# characters, which matches the editor's UTF-16 units for the ASCII text
+# Hackasm sources are made of
+class LanguageServer:
+    def __init__(self, input: BinaryIO, output: BinaryIO, opt_level: str = "0") -> None:
+        self.input = input
+        self.output = output
+        self.opt_level = opt_level
+        self.documents: dict[str, IncrementalAssembler] = {}
+        self.shutdown_requested = False
+        self.handlers = {
+            "initialize": self.initialize,
+            "shutdown": self.shutdown,
+            "textDocument/didOpen": self.did_open,
+            "textDocument/didChange": self.did_change,
+            "textDocument/didClose": self.did_close,
+            "textDocument/hover": self.hover,
+            "textDocument/documentSymbol": self.document_symbol,
+        }
+
+    def read_message(self):
+        length = None
+        while True:
+            header = self.input.readline()
+            if not header:
+                return None
+            header = header.decode("ascii").strip()
+            if header == "":
+                break
+            name, _, value = header.partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value)
+        if length == None:
+            return None
+        return json.loads(self.input.read(length))
+
+    def send(self, message: dict):
+        body = json.dumps(message).encode()
+        self.output.write(f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        self.output.flush()
+
+    def notify(self, method: str, params):
+        self.send({"jsonrpc": "2.0", "method": method, "params": params})
+
+    def error(self, id, code: int, message: str):
+        self.send({"jsonrpc": "2.0", "id": id, "error": {"code": code, "message": message}})
+
+    # Serves requests until the client exits. Returns the process exit code
+    def run(self):
+        while True:
+            message = self.read_message()
+            if message == None:
+                return 1
+            method = message.get("method")
+            if method == "exit":
+                return 0 if self.shutdown_requested else 1
+
+            handler = self.handlers.get(method)
+            request = "id" in message
+            if handler == None:
+                if request:
+                    self.error(message["id"], METHOD_NOT_FOUND, f"Unknown method {method}")
+                continue
+            try:
+                result = handler(message.get("params"))
+            except (KeyError, IndexError, TypeError) as e:
+                if request:
+                    self.error(message["id"], INVALID_PARAMS, f"Invalid parameters for {method}: {e!r}")
+                continue
+            if request:
+                self.send({"jsonrpc": "2.0", "id": message["id"], "result": result})
+
+    def initialize(self, params):
+        return {
+            "capabilities": {
+                "textDocumentSync": {"openClose": True, "change": SYNC_INCREMENTAL},
+                "hoverProvider": True,
+                "documentSymbolProvider": True,
+            },
+            "serverInfo": {"name": "hackasm", "version": ASSEMBLER_VERSION},
+        }
+
+    def shutdown(self, params):
+        self.shutdown_requested = True
+        return None
+
+    def did_open(self, params):
+        document = params["textDocument"]
+        self.documents[document["uri"]] = IncrementalAssembler(document["text"], self.opt_level,
+                                                               uri_path(document["uri"]))
+        self.publish(document["uri"])
+
+    def did_change(self, params):
+        uri = params["textDocument"]["uri"]
+        assembler = self.documents[uri]
+        for change in params["contentChanges"]:
+            if "range" not in change:
+                assembler.set_text(change["text"])
+                continue
+            start = change["range"]["start"]
+            end = change["range"]["end"]
+            lines = assembler.lines
+            last = min(end["line"], len(lines) - 1)
+            before = lines[start["line"]][:start["character"]] if start["line"] < len(lines) else ""
+            after = lines[last][end["character"]:] if end["line"] < len(lines) else ""
+            assembler.update(start["line"], last + 1, split_lines(before + change["text"] + after))
+        self.publish(uri)
+
+    def did_close(self, params):
+        uri = params["textDocument"]["uri"]
+        self.documents.pop(uri, None)
+        self.notify("textDocument/publishDiagnostics", {"uri": uri, "diagnostics": []})
+
+    def publish(self, uri: str):
+        diagnostics = []
+        assembler = self.documents[uri]
+        for error in assembler.diagnostics():
+            line = error.line if error.line != None else 0
+            column, width = error.column, error.width
+            if width == 0 and line < len(assembler.lines):
+                # Underline the whole statement
+                text = assembler.lines[line].split('#')[0]
+                column = len(text) - len(text.lstrip())
+                width = len(text.strip())
+            diagnostics.append({
+                "range": line_range(line, column, width),
+                "severity": SEVERITY_ERROR,
+                "source": "hackasm",
+                "message": str(error).split("\n")[0],
+            })
+        self.notify("textDocument/publishDiagnostics", {"uri": uri, "diagnostics": diagnostics})
+
+    def hover(self, params):
+        assembler = self.documents.get(params["textDocument"]["uri"])
+        position = params["position"]
+        if assembler == None or position["line"] >= len(assembler.lines):
+            return None
+        line = assembler.lines[position["line"]].split('#')[0]
+        for match in WORD.finditer(line):
+            if match.start() <= position["character"] <= match.end():
+                break
+        else:
+            return None
+
+        name = match.group()
+        compiler = assembler.compiler
+        if name in compiler.labels:
+            text = f"{name}: {hex(compiler.labels[name])}"
+        elif name in compiler.symbols:
+            text = f"{name} = {compiler.symbols[name]}"
+            value = compiler.constant(name)
+            if value != None and str(value) != compiler.symbols[name]:
+                text += f" = {value}"
+        else:
+            return None
+        return {"contents": {"kind": "plaintext", "value": text},
+                "range": line_range(position["line"], match.start(), len(name))}
+
+    def document_symbol(self, params):
+        assembler = self.documents.get(params["textDocument"]["uri"])
+        if assembler == None:
+            return []
+        compiler = assembler.compiler
+        symbols = []
+        for label, index in assembler.label_lines().items():
+            if label in compiler.local_labels:
+                continue
+            column = max(assembler.lines[index].find(label), 0)
+            location = line_range(index, column, len(label))
+            symbols.append({
+                "name": label,
+                "detail": hex(compiler.labels[label]),
+                "kind": SYMBOL_FUNCTION if assembler.sections[index] == "TEXT" else SYMBOL_VARIABLE,
+                "range": location,
+                "selectionRange": location,
+            })
+        for index, line in enumerate(assembler.lines):
+            segments = split_segments(line)
+            if len(segments) == 3 and segments[0].upper() == ".SET" and segments[1] in compiler.symbols:
+                location = line_range(index, line.find(segments[1]), len(segments[1]))
+                symbols.append({"name": segments[1], "detail": segments[2], "kind": SYMBOL_CONSTANT,
+                                "range": location, "selectionRange": location})
+        symbols.sort(key=lambda symbol: symbol["range"]["start"]["line"])
+        return symbols
+
+
+def serve(input: BinaryIO, output: BinaryIO, opt_level: str = "0"):
+    return LanguageServer(input, output, opt_level).run()
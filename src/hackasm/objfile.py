@@ -0,0 +1,160 @@
+import sys
+import json
+import base64
+from array import array
+
+from .assembler import VM_BINARY, VM_DATA, VM_WORD, VM_ZERO, Compiler, MacroStats, VmCode, VmInstructionInfo
+
+
+# Hackasm object files are JSON documents holding a compiled (unlinked) node
+# stream. Operands are kept as text, so every label reference is an
+# unresolved relocation until the objects are linked. Labels are relative to
+# the start of the object, and only the source lines the linker can report
+# errors on are kept
+OBJECT_FORMAT = "hackasm-object"
+OBJECT_VERSION = 6
+COLUMNS = ("inst", "offset", "lineno", "operand")
+
+
+class ObjectFormatError(Exception):
+    pass
+
+
+def encode_column(column: array):
+    if sys.byteorder != "little":
+        column = array(column.typecode, column)
+        column.byteswap()
+    return base64.b64encode(column.tobytes()).decode("ascii")
+
+
+def decode_column(typecode: str, data: str):
+    column = array(typecode)
+    column.frombytes(base64.b64decode(data))
+    if sys.byteorder != "little":
+        column.byteswap()
+    return column
+
+
+def encode_instruction(info: VmInstructionInfo, mnemonics: dict[VmInstructionInfo, str]):
+    if info is VM_DATA:
+        return {"kind": "data"}
+    if info is VM_WORD:
+        return {"kind": "word"}
+    if info is VM_ZERO:
+        return {"kind": "zero"}
+    if info is VM_BINARY:
+        return {"kind": "binary"}
+    return {"mnemonic": mnemonics[info], "opcode": info.opcode, "argsize": info.argsize, "maxarg": info.maxarg,
+            "cycles": info.cycles}
+
+
+def decode_instruction(entry: dict, instructions: dict[str, VmInstructionInfo]):
+    if entry.get("kind") == "data":
+        return VM_DATA
+    if entry.get("kind") == "word":
+        return VM_WORD
+    if entry.get("kind") == "zero":
+        return VM_ZERO
+    if entry.get("kind") == "binary":
+        return VM_BINARY
+    mnemonic = entry["mnemonic"]
+    info = instructions.get(mnemonic)
+    if info == None or (info.opcode, info.argsize, info.maxarg, info.cycles) != \
+            (entry["opcode"], entry["argsize"], entry["maxarg"], entry["cycles"]):
+        # Declared with .inst in the object's META section
+        info = VmInstructionInfo(entry["opcode"], entry["argsize"] != 0, entry["argsize"], entry["maxarg"],
+                                 entry["cycles"])
+        instructions.__setitem__(mnemonic, info)
+    return info
+
+
+def dump_object(compiler: Compiler):
+    code = compiler.result
+    mnemonics = {info: mnemonic for mnemonic, info in compiler.instructions.items()}
+    lines = {}
+    for inst_id, lineno in zip(code.inst, code.lineno):
+        if code.instructions[inst_id].hasarg and lineno not in lines:
+            lines[lineno] = compiler.lines[lineno]
+
+    return {
+        "format": OBJECT_FORMAT,
+        "version": OBJECT_VERSION,
+        "source": compiler.source_path,
+        "byte_offset": compiler.byte_offset,
+        "padding_offset": compiler.padding_offset,
+        "instructions": [encode_instruction(info, mnemonics) for info in code.instructions],
+        "operands": code.operands,
+        "columns": {name: encode_column(getattr(code, name)) for name in COLUMNS},
+        "labels": compiler.labels,
+        "fixed_labels": sorted(compiler.fixed_labels),
+        "local_labels": sorted(compiler.local_labels),
+        "globals": sorted(compiler.globals),
+        "externs": sorted(compiler.externs),
+        "symbols": compiler.symbols,
+        "loop_bounds": compiler.loop_bounds,
+        # Strings are the operands of their .ascii nodes
+        "strings": {str(address): code.intern_operand(string, False) for address, string in compiler.strings.items()},
+        "lines": {str(lineno): text for lineno, text in lines.items()},
+        "line_count": len(compiler.lines),
+        "segments": [[start, name, first] for start, file, name, first in compiler.lines.segments],
+        "macro_stats": [[macro, variant, stats.uses, stats.nodes, stats.bytes, stats.cycles]
+                        for (macro, variant), stats in compiler.macro_stats.items()],
+    }
+
+
+def load_object_data(data: dict, instructions: dict[str, VmInstructionInfo]|None = None):
+    if data.get("format") != OBJECT_FORMAT:
+        raise ObjectFormatError("Not a Hackasm object file")
+    if data.get("version") != OBJECT_VERSION:
+        raise ObjectFormatError(f"Unsupported object file version {data.get('version')}")
+
+    compiler = Compiler(source_path=data["source"], entry=False, instructions=instructions)
+    compiler.byte_offset = data["byte_offset"]
+    compiler.padding_offset = data["padding_offset"]
+    compiler.labels = data["labels"]
+    compiler.fixed_labels = set(data["fixed_labels"])
+    compiler.local_labels = set(data["local_labels"])
+    compiler.globals = set(data["globals"])
+    compiler.externs = set(data["externs"])
+    compiler.symbols = data["symbols"]
+    compiler.loop_bounds = data["loop_bounds"]
+    compiler.lines.count = data["line_count"]
+    for start, name, first in data["segments"]:
+        compiler.lines.segments.append((start, None, name, first))
+        compiler.lines.starts.append(start)
+    for lineno, text in data["lines"].items():
+        compiler.lines[int(lineno)] = text
+    for macro, variant, uses, nodes, size, cycles in data["macro_stats"]:
+        stats = compiler.macro_stats[(macro, variant)] = MacroStats()
+        stats.uses, stats.nodes, stats.bytes, stats.cycles = uses, nodes, size, cycles
+
+    code = VmCode()
+    for entry in data["instructions"]:
+        code.intern_instruction(decode_instruction(entry, compiler.instructions))
+    for operand in data["operands"]:
+        code.intern_operand(operand, False)
+    code.inst = decode_column("H", data["columns"]["inst"])
+    code.offset = decode_column("I", data["columns"]["offset"])
+    code.lineno = decode_column("I", data["columns"]["lineno"])
+    code.operand = decode_column("I", data["columns"]["operand"])
+    code.value = array("Q", bytes(8 * len(code.inst)))
+    for inst_id, operand_id in zip(code.inst, code.operand):
+        if code.instructions[inst_id].hasarg:
+            code.intern_operand(code.operands[operand_id], True)
+    compiler.result = code
+    compiler.strings = {int(address): code.operands[operand_id] for address, operand_id in data["strings"].items()}
+    return compiler
+
+
+def save_object(compiler: Compiler, filepath: str):
+    with open(filepath, "w") as outfile:
+        json.dump(dump_object(compiler), outfile, separators=(",", ":"))
+
+
+def load_object(filepath: str):
+    try:
+        with open(filepath, "r") as file:
+            data = json.load(file)
+    except json.JSONDecodeError:
+        raise ObjectFormatError("Not a Hackasm object file")
+    return load_object_data(data)
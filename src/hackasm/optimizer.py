@@ -0,0 +1,307 @@
+from bisect import bisect_left, bisect_right
+
+from .assembler import Compiler, ExpressionError, OperandExpr, VmInstructionInfo
+
+
+READS_X = {"STRX", "OUT", "CMPX", "ADDX", "ADDXY", "DECX", "DECXY", "RORX", "ROLX", "XORX", "PUSHX", "WMEMX"}
+READS_Y = {"STRY", "CMPY", "ADDXY", "DECXY", "XORX", "PUSHY", "WMEMY"}
+WRITES_X = {"LDX", "LDRX", "POPX", "ADDX", "ADDXY", "DECX", "DECXY", "RORX", "ROLX", "XORX", "RMEMX", "IN"}
+WRITES_Y = {"LDY", "LDRY", "POPY", "RMEMY"}
+# Instructions that overwrite a register without reading it first
+LOADS_X = {"LDX", "LDRX", "POPX", "RMEMX", "IN"}
+LOADS_Y = {"LDY", "LDRY", "POPY", "RMEMY"}
+WRITES_FLAGS = {"CMPX", "CMPY", "CLD"}
+USES_STACK = {"PUSHX", "POPX", "PUSHY", "POPY", "RMEMX", "WMEMX", "RMEMY", "WMEMY"}
+ABSOLUTE_JUMPS = {"JE", "JL", "JLE", "JG", "JGE"}
+ADDRESS_OPERANDS = {"STRX", "STRY", "LDRX", "LDRY"} | ABSOLUTE_JUMPS
+RELATIVE_JUMPS = {"JRE", "JRL", "JRLE", "JRG", "JRGE"}
+# Jump mnemonic -> (equal, less, greater) flags under which it is taken
+JUMP_CONDITIONS = {
+    "JE": lambda eq, lt, gt: eq,
+    "JL": lambda eq, lt, gt: lt,
+    "JLE": lambda eq, lt, gt: lt or eq,
+    "JG": lambda eq, lt, gt: gt,
+    "JGE": lambda eq, lt, gt: gt or eq,
+}
+for _jump in list(JUMP_CONDITIONS):
+    JUMP_CONDITIONS["JR" + _jump[1:]] = JUMP_CONDITIONS[_jump]
+
+KNOWN = READS_X | READS_Y | WRITES_X | WRITES_Y | WRITES_FLAGS | USES_STACK | ABSOLUTE_JUMPS | RELATIVE_JUMPS \
+    | {"NOP", "RET"}
+
+
+class OptimizationReport:
+    __slots__ = ("removed_instructions", "removed_bytes", "skipped")
+
+    def __init__(self) -> None:
+        self.removed_instructions = 0
+        self.removed_bytes = 0
+        self.skipped = None
+
+
+def constant_value(compiler: Compiler, expr: OperandExpr|None):
+    if expr == None or expr.error != None:
+        return None
+    try:
+        return expr.evaluate(compiler.symbol_value)
+    except ExpressionError:
+        return None
+
+
+class Peephole:
+    def __init__(self, compiler: Compiler) -> None:
+        self.compiler = compiler
+        self.code = compiler.result
+        names = {info: mnemonic for mnemonic, info in compiler.instructions.items()}
+        self.mnemonics = [names.get(info) for info in self.code.instructions]
+        self.sizes = [self.node_size(info) for info in self.code.instructions]
+
+    def node_size(self, info: VmInstructionInfo):
+        if info.opcode_byte == None:
+            return None
+        return 1 + info.argsize
+
+    def mnemonic(self, row: int):
+        return self.mnemonics[self.code.inst[row]]
+
+    def operand(self, row: int):
+        return constant_value(self.compiler, self.code.expressions[self.code.operand[row]])
+
+    # Literal addresses into the unit would no longer point at the same code
+    # or data once anything moves
+    def check(self):
+        code = self.code
+        for row in range(len(code)):
+            mnemonic = self.mnemonic(row)
+            if mnemonic not in ADDRESS_OPERANDS:
+                continue
+            expr = code.expressions[code.operand[row]]
+            if any(name in self.compiler.labels or name in self.compiler.externs
+                   for name in self.compiler.referenced_names(expr)):
+                # Only a bare label name is known to be where a jump lands
+                if mnemonic in ABSOLUTE_JUMPS and expr.tree not in self.compiler.labels \
+                        and expr.tree not in self.compiler.externs:
+                    return "jump with a computed target"
+                continue
+            address = self.operand(row)
+            if address == None:
+                return "computed address"
+            if address < self.compiler.byte_offset:
+                return f"literal address {hex(address)}"
+        return None
+
+    # Offsets control can enter at from somewhere other than the previous
+    # instruction. Returns None if a jump target cannot be determined, in
+    # which case no code may move
+    def entry_points(self):
+        code = self.code
+        targets = {address for label, address in self.compiler.labels.items()
+                   if label not in self.compiler.fixed_labels}
+        for row in range(len(code)):
+            if self.mnemonic(row) in RELATIVE_JUMPS:
+                distance = self.operand(row)
+                if distance == None:
+                    return None
+                targets.add(code.offset[row] + distance)
+        return targets
+
+    # Rows no pass may touch: those between the labels an operand combines,
+    # such as both ends of a label difference or the instruction .pushstr
+    # rewrites through loop+2, which must keep their size and contents, and
+    # those an operand reads or writes as data
+    def pinned(self):
+        code = self.code
+        compiler = self.compiler
+        spans = []
+        for row in range(len(code)):
+            if not code.instructions[code.inst[row]].hasarg:
+                continue
+            mnemonic = self.mnemonic(row)
+            if mnemonic in RELATIVE_JUMPS:
+                continue
+            expr = code.expressions[code.operand[row]]
+            addresses = [compiler.labels[name] for name in compiler.referenced_names(expr)
+                         if name in compiler.labels and name not in compiler.fixed_labels]
+            if not addresses or mnemonic in ABSOLUTE_JUMPS:
+                continue
+            if mnemonic in ADDRESS_OPERANDS:
+                value = self.operand(row)
+                addresses.append(value if value != None else max(addresses))
+                spans.append((min(addresses), max(addresses) + 1))
+            elif len(addresses) >= 2:
+                spans.append((min(addresses), max(addresses)))
+        merged: list[list[int]] = []
+        for start, end in sorted(spans):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            elif start < end:
+                merged.append([start, end])
+        starts = [start for start, end in merged]
+        pinned = set()
+        for row in range(len(code)):
+            index = bisect_right(starts, code.offset[row]) - 1
+            if index >= 0 and code.offset[row] < merged[index][1]:
+                pinned.add(row)
+        return pinned
+
+    def blocks(self, deleted: set[int], entries: set[int], pinned: set[int]):
+        code = self.code
+        block = []
+        for row in range(len(code)):
+            # An entry point ends the block even when the row there is
+            # already deleted, as control still arrives at its offset
+            if code.offset[row] in entries:
+                if block:
+                    yield block
+                block = []
+            if row in deleted:
+                continue
+            mnemonic = self.mnemonic(row)
+            if mnemonic not in KNOWN or row in pinned:
+                if block:
+                    yield block
+                block = []
+                continue
+            block.append(row)
+            if mnemonic in ABSOLUTE_JUMPS or mnemonic in RELATIVE_JUMPS or mnemonic == "RET":
+                yield block
+                block = []
+        if block:
+            yield block
+
+    # Constant propagation of X, Y and the comparison flags through a block:
+    # drops loads of values already in a register, repeated comparisons and
+    # conditional jumps known not to be taken
+    def fold_constants(self, block: list[int], deleted: set[int]):
+        x = y = flags = None
+        for row in block:
+            mnemonic = self.mnemonic(row)
+            value = self.operand(row)
+            if mnemonic in ("LDX", "LDY"):
+                if value != None and value == (x if mnemonic == "LDX" else y):
+                    deleted.add(row)
+                    continue
+            elif mnemonic in ("CMPX", "CMPY"):
+                register = x if mnemonic == "CMPX" else y
+                if register == None or value == None:
+                    flags = None
+                    continue
+                new_flags = (register == value, register < value, register > value)
+                if new_flags == flags:
+                    deleted.add(row)
+                flags = new_flags
+                continue
+            elif mnemonic in JUMP_CONDITIONS:
+                if flags != None and not JUMP_CONDITIONS[mnemonic](*flags):
+                    deleted.add(row)
+                continue
+            elif mnemonic == "CLD":
+                flags = (False, False, False)
+                continue
+
+            if mnemonic in WRITES_X:
+                if mnemonic == "LDX":
+                    x = value
+                elif mnemonic in ("ADDX", "DECX") and x != None and value != None:
+                    x = (x + value if mnemonic == "ADDX" else x - value) & 0xFF
+                else:
+                    x = None
+            if mnemonic in WRITES_Y:
+                y = value if mnemonic == "LDY" else None
+
+    # Removes PUSHX ... POPX (and PUSHY ... POPY) pairs whose inner
+    # instructions leave the stack and the saved register alone
+    def drop_stack_pairs(self, block: list[int], deleted: set[int]):
+        for start, row in enumerate(block):
+            mnemonic = self.mnemonic(row)
+            if row in deleted or mnemonic not in ("PUSHX", "PUSHY"):
+                continue
+            pop = "POPX" if mnemonic == "PUSHX" else "POPY"
+            writes = WRITES_X if mnemonic == "PUSHX" else WRITES_Y
+            for inner in block[start + 1:]:
+                if inner in deleted:
+                    continue
+                inner_mnemonic = self.mnemonic(inner)
+                if inner_mnemonic == pop:
+                    deleted.add(row)
+                    deleted.add(inner)
+                    break
+                if inner_mnemonic in USES_STACK or inner_mnemonic in writes:
+                    break
+
+    # Removes register loads that are overwritten before being read
+    def drop_dead_loads(self, block: list[int], deleted: set[int]):
+        for start, row in enumerate(block):
+            mnemonic = self.mnemonic(row)
+            if row in deleted or mnemonic not in ("LDX", "LDY"):
+                continue
+            reads, loads = (READS_X, LOADS_X) if mnemonic == "LDX" else (READS_Y, LOADS_Y)
+            for inner in block[start + 1:]:
+                if inner in deleted:
+                    continue
+                inner_mnemonic = self.mnemonic(inner)
+                if inner_mnemonic in reads:
+                    break
+                if inner_mnemonic in loads:
+                    deleted.add(row)
+                    break
+
+    def run(self):
+        report = OptimizationReport()
+        report.skipped = self.check()
+        if report.skipped != None:
+            return report
+        entries = self.entry_points()
+        if entries == None:
+            report.skipped = "jump with a computed target"
+            return report
+
+        pinned = self.pinned()
+        deleted: set[int] = set()
+        while True:
+            before = len(deleted)
+            for block in list(self.blocks(deleted, entries, pinned)):
+                self.fold_constants(block, deleted)
+                self.drop_stack_pairs(block, deleted)
+                self.drop_dead_loads(block, deleted)
+            if len(deleted) == before:
+                break
+
+        if deleted:
+            self.relocate(deleted, report)
+        return report
+
+    def relocate(self, deleted: set[int], report: OptimizationReport):
+        compiler = self.compiler
+        code = self.code
+        removed_at = sorted(code.offset[row] for row in deleted)
+        removed_sizes = [0]
+        for row in sorted(deleted, key=lambda row: code.offset[row]):
+            removed_sizes.append(removed_sizes[-1] + self.sizes[code.inst[row]])
+
+        def new_address(address: int):
+            return address - removed_sizes[bisect_left(removed_at, address)]
+
+        for row in range(len(code)):
+            if row in deleted or self.mnemonic(row) not in RELATIVE_JUMPS:
+                continue
+            target = code.offset[row] + self.operand(row)
+            distance = new_address(target) - new_address(code.offset[row])
+            code.operand[row] = code.intern_operand(str(distance), True)
+
+        for row in range(len(code)):
+            code.offset[row] = new_address(code.offset[row])
+        for label, address in compiler.labels.items():
+            if label not in compiler.fixed_labels:
+                compiler.labels[label] = new_address(address)
+        compiler.strings = {new_address(address): string for address, string in compiler.strings.items()}
+        compiler.byte_offset = new_address(compiler.byte_offset)
+        compiler.concrete_offset = new_address(compiler.concrete_offset)
+
+        code.delete(deleted)
+        report.removed_instructions = len(deleted)
+        report.removed_bytes = removed_sizes[-1]
+
+
+def optimize(compiler: Compiler):
+    return Peephole(compiler).run()
@@ -0,0 +1,295 @@
+from bisect import bisect_left, bisect_right
+
+from .assembler import VM_BINARY, VM_DATA, VM_WORD, VM_ZERO, Compiler, Linker
+from .optimizer import ADDRESS_OPERANDS, constant_value
+
+
+RELATIVE_JUMPS = {"JRE", "JRL", "JRLE", "JRG", "JRGE"}
+STORES = {"STRX", "STRY"}
+
+
+class PruneReport:
+    __slots__ = ("removed_blocks", "merged_strings", "removed_bytes", "skipped")
+
+    def __init__(self) -> None:
+        self.removed_blocks = 0
+        self.merged_strings = 0
+        self.removed_bytes = 0
+        self.skipped = None
+
+
+# A run of nodes from one label (or from a switch between code and data) to
+# the next. Blocks are kept or dropped whole
+class Block:
+    __slots__ = ("unit", "index", "start", "end", "rows", "labels", "code", "live")
+
+    def __init__(self, unit: int, index: int, start: int, labels: list[str], code: bool) -> None:
+        self.unit = unit
+        self.index = index
+        self.start = start
+        self.end = start
+        self.rows: list[int] = []
+        self.labels = labels
+        self.code = code
+        self.live = False
+
+
+def node_size(compiler: Compiler, row: int):
+    code = compiler.result
+    info = code.instructions[code.inst[row]]
+    if info is VM_DATA:
+        return len(code.operands[code.operand[row]])
+    if info is VM_ZERO:
+        return int(code.operands[code.operand[row]])
+    if info is VM_BINARY:
+        return int(code.operands[code.operand[row]].split(" ", 2)[1])
+    if info is VM_WORD:
+        return 1
+    return 1 + info.argsize
+
+
+# Drops DATA blocks and TEXT routines that no operand refers to and merges
+# identical and suffix-shared .ascii strings, across all the units that are
+# about to be linked together. Control falls from one code block into the
+# next unless the block ends in RET or an unconditional .jump/.fastjump, so
+# such successors are kept along with their predecessor
+class Pruner:
+    def __init__(self, units: list[Compiler]) -> None:
+        self.units = units
+        self.mnemonics = [{info: mnemonic for mnemonic, info in unit.instructions.items()} for unit in units]
+        self.blocks: list[list[Block]] = []
+        self.starts: list[list[int]] = []
+        # Exported label -> unit defining it
+        self.globals: dict[str, int] = {}
+        for unit_index, unit in enumerate(units):
+            for label in unit.globals.union(Linker.IMPLICIT_GLOBALS):
+                if label in unit.labels:
+                    self.globals.setdefault(label, unit_index)
+        # Blocks written to with STRX/STRY, which must not share their bytes
+        self.written: set[Block] = set()
+        # Blocks between labels an operand combines, such as both ends of a
+        # label difference, which must keep their size
+        self.spanned: set[Block] = set()
+
+    def mnemonic(self, unit: int, row: int):
+        code = self.units[unit].result
+        return self.mnemonics[unit].get(code.instructions[code.inst[row]])
+
+    def operand(self, unit: int, row: int):
+        code = self.units[unit].result
+        return constant_value(self.units[unit], code.expressions[code.operand[row]])
+
+    # Literal addresses into the image would no longer point at the same
+    # data once anything moves
+    def check(self):
+        size = sum(unit.byte_offset for unit in self.units)
+        for unit_index, unit in enumerate(self.units):
+            code = unit.result
+            for row in range(len(code)):
+                mnemonic = self.mnemonic(unit_index, row)
+                if mnemonic in RELATIVE_JUMPS and self.operand(unit_index, row) == None:
+                    return "relative jump with a computed distance"
+                if mnemonic in ADDRESS_OPERANDS:
+                    address = self.operand(unit_index, row)
+                    if address != None and address < size:
+                        return f"literal address {hex(address)}"
+        return None
+
+    def split(self, unit_index: int):
+        unit = self.units[unit_index]
+        code = unit.result
+        starts: dict[int, list[str]] = {}
+        for label, address in unit.labels.items():
+            if label not in unit.fixed_labels:
+                starts.setdefault(address, []).append(label)
+
+        blocks: list[Block] = []
+        block = None
+        for row in range(len(code)):
+            offset = code.offset[row]
+            is_code = code.instructions[code.inst[row]].opcode_byte != None
+            if block == None or offset in starts or is_code != block.code:
+                block = Block(unit_index, len(blocks), offset, starts.get(offset, []), is_code)
+                blocks.append(block)
+            block.rows.append(row)
+            block.end = offset + node_size(unit, row)
+
+        for block in blocks:
+            # Padding inside a block makes its size unknown, and blocks
+            # without labels can only be reached by falling into them
+            size = sum(node_size(unit, row) for row in block.rows)
+            if size != block.end - block.start or not block.labels:
+                block.live = True
+        self.blocks.append(blocks)
+        self.starts.append([block.start for block in blocks])
+
+    def block_at(self, unit: int, address: int):
+        index = bisect_right(self.starts[unit], address) - 1
+        if index < 0:
+            return None
+        block = self.blocks[unit][index]
+        return block if address < block.end else None
+
+    def label_block(self, unit: int, label: str):
+        compiler = self.units[unit]
+        if label in compiler.fixed_labels or label not in compiler.labels:
+            return None
+        return self.block_at(unit, compiler.labels[label])
+
+    def falls_through(self, block: Block):
+        if not block.code:
+            return False
+        unit = block.unit
+        rows = block.rows[-4:]
+        mnemonics = [self.mnemonic(unit, row) for row in rows]
+        if mnemonics[-1:] == ["RET"]:
+            return False
+        # .fastjump and the fast .jump: X is never below 0
+        if mnemonics[-2:] == ["CMPX", "JGE"] and self.operand(unit, rows[-2]) == 0:
+            return False
+        # The safe .jump compares 0 with 0 before jumping if equal
+        if mnemonics == ["LDX", "CMPX", "POPX", "JE"] and self.operand(unit, rows[0]) == 0 \
+                and self.operand(unit, rows[1]) == 0:
+            return False
+        return True
+
+    def references(self, block: Block):
+        unit = self.units[block.unit]
+        code = unit.result
+        for row in block.rows:
+            if not code.instructions[code.inst[row]].hasarg:
+                continue
+            mnemonic = self.mnemonic(block.unit, row)
+            if mnemonic in RELATIVE_JUMPS:
+                target = self.block_at(block.unit, code.offset[row] + self.operand(block.unit, row))
+                if target != None:
+                    yield target
+                continue
+            local = []
+            for name in unit.referenced_names(code.expressions[code.operand[row]]):
+                owner = block.unit if name in unit.labels else self.globals.get(name)
+                target = self.label_block(owner, name) if owner != None else None
+                if target != None:
+                    if mnemonic in STORES:
+                        self.written.add(target)
+                    if owner == block.unit:
+                        local.append(target.index)
+                    yield target
+            if len(local) >= 2:
+                for target in self.blocks[block.unit][min(local):max(local) + 1]:
+                    self.spanned.add(target)
+                    yield target
+
+    def mark(self):
+        work = [block for blocks in self.blocks for block in blocks if block.live]
+        # The entry point, the scratch area and anything another object
+        # declares it uses
+        roots = set(Linker.IMPLICIT_GLOBALS).union(*(unit.externs for unit in self.units))
+        for label in roots:
+            if label in self.globals:
+                block = self.label_block(self.globals[label], label)
+                if block != None:
+                    work.append(block)
+
+        while work:
+            block = work.pop()
+            block.live = True
+            successors = list(self.references(block))
+            blocks = self.blocks[block.unit]
+            if self.falls_through(block) and block.index + 1 < len(blocks) and blocks[block.index + 1].code:
+                successors.append(blocks[block.index + 1])
+            for successor in successors:
+                if not successor.live:
+                    successor.live = True
+                    work.append(successor)
+
+    # Live blocks holding nothing but one .ascii string are merged into the
+    # longest string they are a suffix of. Sorting the reversed strings puts
+    # each string right before the strings ending with it. Returns
+    # {merged string address: address of its copy}
+    def merge_strings(self, unit_index: int, report: PruneReport):
+        unit = self.units[unit_index]
+        code = unit.result
+        candidates = []
+        for block in self.blocks[unit_index]:
+            if block.live and block not in self.written and block not in self.spanned and len(block.rows) == 1 \
+                    and block.start in unit.strings and code.instructions[code.inst[block.rows[0]]] is VM_DATA:
+                candidates.append((unit.strings[block.start][::-1], -block.start, block))
+        candidates.sort(key=lambda candidate: candidate[:2])
+
+        aliases = {}
+        owner = None
+        for reversed_string, _, block in reversed(candidates):
+            if owner != None and owner[0].startswith(reversed_string):
+                aliases[block.start] = owner[1] + len(owner[0]) - len(reversed_string)
+                block.live = False
+                report.merged_strings += 1
+            else:
+                owner = (reversed_string, block.start)
+        return aliases
+
+    def compact(self, unit_index: int, aliases: dict[int, int], report: PruneReport):
+        unit = self.units[unit_index]
+        code = unit.result
+        dropped = [block for block in self.blocks[unit_index] if not block.live]
+        if not dropped:
+            return
+        removed_at = [block.start for block in dropped]
+        removed_sizes = [0]
+        for block in dropped:
+            removed_sizes.append(removed_sizes[-1] + block.end - block.start)
+
+        def new_address(address: int):
+            return address - removed_sizes[bisect_left(removed_at, address)]
+
+        def is_dropped(address: int):
+            index = bisect_right(removed_at, address) - 1
+            return index >= 0 and address < dropped[index].end
+
+        deleted = {row for block in dropped for row in block.rows}
+        for row in range(len(code)):
+            if row in deleted or self.mnemonic(unit_index, row) not in RELATIVE_JUMPS:
+                continue
+            target = code.offset[row] + self.operand(unit_index, row)
+            distance = new_address(target) - new_address(code.offset[row])
+            code.operand[row] = code.intern_operand(str(distance), True)
+
+        # Deleted rows go below, and their new addresses may be negative
+        for row in range(len(code)):
+            if row not in deleted:
+                code.offset[row] = new_address(code.offset[row])
+        for label, address in list(unit.labels.items()):
+            if label in unit.fixed_labels:
+                continue
+            if address in aliases:
+                unit.labels[label] = new_address(aliases[address])
+            elif is_dropped(address):
+                del unit.labels[label]
+                unit.local_labels.discard(label)
+                unit.globals.discard(label)
+            else:
+                unit.labels[label] = new_address(address)
+        unit.strings = {new_address(address): string for address, string in unit.strings.items()
+                        if not is_dropped(address)}
+        unit.byte_offset = new_address(unit.byte_offset)
+        unit.concrete_offset = new_address(unit.concrete_offset)
+
+        code.delete(deleted)
+        report.removed_blocks += len(dropped) - len(aliases)
+        report.removed_bytes += removed_sizes[-1]
+
+    def run(self):
+        report = PruneReport()
+        report.skipped = self.check()
+        if report.skipped != None:
+            return report
+        for unit_index in range(len(self.units)):
+            self.split(unit_index)
+        self.mark()
+        for unit_index in range(len(self.units)):
+            self.compact(unit_index, self.merge_strings(unit_index, report), report)
+        return report
+
+
+def prune(units: list[Compiler]):
+    return Pruner(units).run()
@@ -0,0 +1,197 @@
+import sys
+import json
+import time
+import tracemalloc
+
+from .assembler import VM_BINARY, VM_DATA, VM_WORD, VM_ZERO, Compiler
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak memory is then only known when traced
+    resource = None
+
+
+# Phases in the order they run. tokenize, expand and instructions are the
+# parts of compile() spent splitting lines, expanding macros and encoding
+# plain instructions; resolve and encode are the two halves of link()
+PHASES = ("tokenize", "expand", "instructions", "optimize", "prune", "layout", "resolve", "encode", "hex", "write")
+
+# Names shown for the pseudo-instructions holding data
+DATA_NODES = {VM_DATA: ".ascii", VM_WORD: ".word", VM_ZERO: ".alloc", VM_BINARY: ".incbin"}
+
+
+# Receives the profiler's measurements as they are taken. Subclass it and
+# override what you need
+class StatsHook:
+    def phase_begin(self, phase: str):
+        pass
+
+    # seconds is the time spent in this run of the phase, not counting the
+    # phases nested inside it
+    def phase_end(self, phase: str, seconds: float):
+        pass
+
+    def report(self, stats: dict):
+        pass
+
+
+# Times nested phases. Time is charged to the innermost running phase only,
+# so an .include inside a macro counts as tokenizing and compiling the
+# included lines rather than as expanding the macro. With trace_memory the
+# peak of Python allocations is measured with tracemalloc, which slows the
+# build down several times; otherwise the peak resident size of the process
+# is reported
+class Profiler:
+    def __init__(self, hooks: list[StatsHook]|None = None, trace_memory: bool = False) -> None:
+        self.hooks = hooks or []
+        self.times: dict[str, float] = {}
+        # [phase, time charged to this run of it]
+        self.stack: list[list] = []
+        self.started = 0.0
+        # Nodes emitted by the compiler, before optimizing or pruning
+        self.compiled_nodes = None
+        self.trace_memory = trace_memory
+        if trace_memory:
+            tracemalloc.start()
+
+    def charge(self, now: float):
+        if self.stack:
+            entry = self.stack[-1]
+            elapsed = now - self.started
+            entry[1] += elapsed
+            self.times[entry[0]] = self.times.get(entry[0], 0.0) + elapsed
+        self.started = now
+
+    def begin(self, phase: str):
+        self.charge(time.perf_counter())
+        self.stack.append([phase, 0.0])
+        for hook in self.hooks:
+            hook.phase_begin(phase)
+
+    def end(self):
+        self.charge(time.perf_counter())
+        phase, seconds = self.stack.pop()
+        for hook in self.hooks:
+            hook.phase_end(phase, seconds)
+
+    def compiled(self, compiler: Compiler):
+        self.compiled_nodes = len(compiler.result)
+
+    # Times a block: with profiler.phase("optimize"): ...
+    def phase(self, phase: str):
+        return ProfiledPhase(self, phase)
+
+    def peak_memory(self):
+        if self.trace_memory:
+            return tracemalloc.get_traced_memory()[1]
+        if resource == None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Reported in KiB on Linux and in bytes on macOS
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    def report(self, compiler: Compiler, image_size: int|None = None):
+        stats = collect(self, compiler, image_size)
+        if self.trace_memory:
+            tracemalloc.stop()
+            self.trace_memory = False
+        for hook in self.hooks:
+            hook.report(stats)
+        return stats
+
+
+class ProfiledPhase:
+    def __init__(self, profiler: Profiler, phase: str) -> None:
+        self.profiler = profiler
+        self.phase = phase
+
+    def __enter__(self):
+        self.profiler.begin(self.phase)
+
+    def __exit__(self, *exc):
+        self.profiler.end()
+
+
+def collect(profiler: Profiler, compiler: Compiler, image_size: int|None = None):
+    code = compiler.result
+    mnemonics = {info: mnemonic for mnemonic, info in compiler.instructions.items()}
+    mnemonics.update(DATA_NODES)
+    by_instruction: dict[str, int] = {}
+    counts: dict[int, int] = {}
+    for inst_id in code.inst:
+        counts[inst_id] = counts.get(inst_id, 0) + 1
+    for inst_id, count in counts.items():
+        name = mnemonics.get(code.instructions[inst_id], "?")
+        by_instruction[name] = by_instruction.get(name, 0) + count
+
+    # Expansion ratio: what one source line using the macro turns into
+    macros = {}
+    macro_nodes = 0
+    for (macro, variant), stats in compiler.macro_stats.items():
+        if stats.uses == 0:
+            continue
+        name = f".{macro.lower()}" + (f" ({variant})" if variant != "" else "")
+        macros[name] = {
+            "uses": stats.uses,
+            "nodes": stats.nodes,
+            "bytes": stats.bytes,
+            "nodes_per_use": stats.nodes / stats.uses,
+            "bytes_per_use": stats.bytes / stats.uses,
+        }
+        macro_nodes += stats.nodes
+
+    compiled_nodes = len(code) if profiler.compiled_nodes == None else profiler.compiled_nodes
+    size = compiler.byte_offset - compiler.padding_offset if image_size == None else image_size
+    lines = len(compiler.lines)
+    return {
+        "phases_ms": {phase: profiler.times[phase] * 1000 for phase in PHASES if phase in profiler.times},
+        "total_ms": sum(profiler.times.values()) * 1000,
+        "source_lines": lines,
+        "image_bytes": size,
+        "bytes_per_line": size / lines if lines != 0 else 0.0,
+        "nodes": len(code),
+        "nodes_by_instruction": dict(sorted(by_instruction.items(), key=lambda item: (-item[1], item[0]))),
+        # As compiled. Nodes not emitted by a macro come from plain
+        # instructions and the entry point
+        "nodes_by_origin": {"instructions": compiled_nodes - macro_nodes, "macros": macro_nodes},
+        "macros": dict(sorted(macros.items(), key=lambda item: -item[1]["nodes"])),
+        "symbol_tables": {
+            "labels": len(compiler.labels) - len(compiler.local_labels),
+            "local_labels": len(compiler.local_labels),
+            "symbols": len(compiler.symbols),
+            "globals": len(compiler.globals),
+            "externs": len(compiler.externs),
+            "strings": len(compiler.strings),
+            "operands": len(code.operands),
+        },
+        "peak_memory_bytes": profiler.peak_memory(),
+        "peak_memory_traced": profiler.trace_memory,
+    }
+
+
+def format_stats(stats: dict, format: str = "text"):
+    if format == "json":
+        return json.dumps(stats, indent=2)
+
+    lines = [f"Build statistics: {stats['source_lines']} line(s) -> {stats['image_bytes']} byte(s) "
+             f"({stats['bytes_per_line']:.2f} byte(s)/line), {stats['nodes']} node(s)"]
+    lines.append(f"  Phases ({stats['total_ms']:.1f} ms):")
+    for phase, ms in stats["phases_ms"].items():
+        lines.append(f"    - {phase}: {ms:.1f} ms")
+    origin = stats["nodes_by_origin"]
+    lines.append(f"  Nodes by origin: {origin['instructions']} from instructions, {origin['macros']} from macros")
+    lines.append("  Nodes by instruction:")
+    for name, count in stats["nodes_by_instruction"].items():
+        lines.append(f"    - {name}: {count}")
+    if stats["macros"]:
+        lines.append("  Macros:")
+        for name, macro in stats["macros"].items():
+            lines.append(f"    - {name}: {macro['uses']} use(s), {macro['nodes']} node(s), {macro['bytes']} byte(s), "
+                         f"{macro['bytes_per_use']:.1f} byte(s)/use")
+    tables = ", ".join(f"{count} {name.replace('_', ' ')}" for name, count in stats["symbol_tables"].items())
+    lines.append(f"  Symbol tables: {tables}")
+    if stats["peak_memory_bytes"] != None:
+        kind = "traced" if stats["peak_memory_traced"] else "resident"
+        lines.append(f"  Peak memory ({kind}): {stats['peak_memory_bytes'] / 2 ** 20:.1f} MiB")
+    return "\n".join(lines)
@@ -0,0 +1,350 @@
+import sys
+from typing import BinaryIO, Callable
+
+from .assembler import VM_INSTRUCTIONS, VmInstructionInfo
+
+
+MEMORY_SIZE = 4096
+HALT = -1
+
+
+class VmError(Exception):
+    pass
+
+
+# Handlers take the machine, the predecoded operand and the address of the
+# next instruction, and return the address to continue from (HALT to stop).
+# Relative jump operands are turned into absolute targets when decoding, so
+# no handler needs the address of its own instruction
+def _cld(vm, arg, nxt):
+    vm.equal = vm.less = vm.greater = False
+    return nxt
+
+def _ldx(vm, arg, nxt):
+    vm.x = arg
+    return nxt
+
+def _ldy(vm, arg, nxt):
+    vm.y = arg
+    return nxt
+
+def _strx(vm, arg, nxt):
+    vm.store(arg, vm.x)
+    return nxt
+
+def _stry(vm, arg, nxt):
+    vm.store(arg, vm.y)
+    return nxt
+
+def _ldrx(vm, arg, nxt):
+    vm.x = vm.memory[arg]
+    return nxt
+
+def _ldry(vm, arg, nxt):
+    vm.y = vm.memory[arg]
+    return nxt
+
+def _out(vm, arg, nxt):
+    vm.write(bytes((vm.x,)))
+    return nxt
+
+def _in(vm, arg, nxt):
+    data = vm.read(1)
+    vm.x = data[0] if data else 0
+    return nxt
+
+def _cmpx(vm, arg, nxt):
+    x = vm.x
+    vm.equal = x == arg
+    vm.less = x < arg
+    vm.greater = x > arg
+    return nxt
+
+def _cmpy(vm, arg, nxt):
+    y = vm.y
+    vm.equal = y == arg
+    vm.less = y < arg
+    vm.greater = y > arg
+    return nxt
+
+def _je(vm, arg, nxt):
+    return arg if vm.equal else nxt
+
+def _jl(vm, arg, nxt):
+    return arg if vm.less else nxt
+
+def _jle(vm, arg, nxt):
+    return arg if vm.less or vm.equal else nxt
+
+def _jg(vm, arg, nxt):
+    return arg if vm.greater else nxt
+
+def _jge(vm, arg, nxt):
+    return arg if vm.greater or vm.equal else nxt
+
+def _addx(vm, arg, nxt):
+    vm.x = (vm.x + arg) & 0xFF
+    return nxt
+
+def _addxy(vm, arg, nxt):
+    vm.x = (vm.x + vm.y) & 0xFF
+    return nxt
+
+def _decx(vm, arg, nxt):
+    vm.x = (vm.x - arg) & 0xFF
+    return nxt
+
+def _decxy(vm, arg, nxt):
+    vm.x = (vm.x - vm.y) & 0xFF
+    return nxt
+
+def _rorx(vm, arg, nxt):
+    x = vm.x
+    vm.x = ((x >> 1) | (x << 7)) & 0xFF
+    return nxt
+
+def _rolx(vm, arg, nxt):
+    x = vm.x
+    vm.x = ((x << 1) | (x >> 7)) & 0xFF
+    return nxt
+
+def _xorx(vm, arg, nxt):
+    vm.x ^= vm.y
+    return nxt
+
+def _pushx(vm, arg, nxt):
+    vm.stack.append(vm.x)
+    return nxt
+
+def _pushy(vm, arg, nxt):
+    vm.stack.append(vm.y)
+    return nxt
+
+def _popx(vm, arg, nxt):
+    if not vm.stack:
+        raise VmError("Stack underflow")
+    vm.x = vm.stack.pop()
+    return nxt
+
+def _popy(vm, arg, nxt):
+    if not vm.stack:
+        raise VmError("Stack underflow")
+    vm.y = vm.stack.pop()
+    return nxt
+
+# Indirect memory access goes through the 16-bit pointer on top of the stack,
+# laid out the way .pushregs and .add16 leave it (high byte below low byte)
+def _rmemx(vm, arg, nxt):
+    vm.x = vm.memory[vm.pointer()]
+    return nxt
+
+def _wmemx(vm, arg, nxt):
+    vm.store(vm.pointer(), vm.x)
+    return nxt
+
+def _rmemy(vm, arg, nxt):
+    vm.y = vm.memory[vm.pointer()]
+    return nxt
+
+def _wmemy(vm, arg, nxt):
+    vm.store(vm.pointer(), vm.y)
+    return nxt
+
+def _nop(vm, arg, nxt):
+    return nxt
+
+def _ret(vm, arg, nxt):
+    return HALT
+
+
+VM_HANDLERS: dict[str, Callable] = {
+    "CLD": _cld,
+    "LDX": _ldx,
+    "LDY": _ldy,
+    "STRX": _strx,
+    "STRY": _stry,
+    "LDRX": _ldrx,
+    "LDRY": _ldry,
+    "OUT": _out,
+    "IN": _in,
+    "CMPX": _cmpx,
+    "CMPY": _cmpy,
+    "JE": _je,
+    "JRE": _je,
+    "JL": _jl,
+    "JRL": _jl,
+    "JLE": _jle,
+    "JRLE": _jle,
+    "JG": _jg,
+    "JRG": _jg,
+    "JGE": _jge,
+    "JRGE": _jge,
+    "ADDX": _addx,
+    "ADDXY": _addxy,
+    "DECX": _decx,
+    "DECXY": _decxy,
+    "RORX": _rorx,
+    "ROLX": _rolx,
+    "XORX": _xorx,
+    "PUSHX": _pushx,
+    "POPX": _popx,
+    "PUSHY": _pushy,
+    "POPY": _popy,
+    "RMEMX": _rmemx,
+    "WMEMX": _wmemx,
+    "RMEMY": _rmemy,
+    "WMEMY": _wmemy,
+    "NOP": _nop,
+    "RET": _ret,
+}
+
+RELATIVE_JUMPS = {"JRE", "JRL", "JRLE", "JRG", "JRGE"}
+
+
+def _halted(vm, arg, nxt):
+    return HALT
+
+
+class Vm:
+    __slots__ = ("memory", "image_size", "x", "y", "stack", "equal", "less", "greater", "pc", "steps",
+                 "read", "write", "table", "opcodes", "max_argsize")
+
+    def __init__(self, image: bytes, instructions: dict[str, VmInstructionInfo] = VM_INSTRUCTIONS,
+                 input: BinaryIO|None = None, output: BinaryIO|None = None,
+                 handlers: dict[str, Callable]|None = None) -> None:
+        if len(image) > MEMORY_SIZE:
+            raise VmError(f"Image of {len(image)} byte(s) does not fit in {MEMORY_SIZE} bytes of memory")
+        self.memory = bytearray(MEMORY_SIZE)
+        self.memory[:len(image)] = image
+        self.image_size = len(image)
+        self.x = 0
+        self.y = 0
+        self.stack: list[int] = []
+        self.equal = self.less = self.greater = False
+        self.pc = 0
+        self.steps = 0
+        self.read = (input or sys.stdin.buffer).read
+        self.write = (output or sys.stdout.buffer).write
+
+        all_handlers = VM_HANDLERS if handlers == None else {**VM_HANDLERS, **handlers}
+        # opcode byte -> (handler, argument size, relative jump)
+        self.opcodes: dict[int, tuple[Callable|None, int, bool]] = {}
+        for mnemonic, info in instructions.items():
+            if info.opcode_byte == None:
+                continue
+            self.opcodes[info.opcode_byte] = (all_handlers.get(mnemonic), info.argsize, mnemonic in RELATIVE_JUMPS)
+        self.max_argsize = max((argsize for _, argsize, _ in self.opcodes.values()), default=0)
+
+        self.table: list[tuple[Callable, int, int]|None] = [None] * MEMORY_SIZE
+        self.predecode()
+
+    def decode(self, address: int):
+        if address >= self.image_size:
+            # Running off the end of the loaded image stops the program
+            entry = (_halted, 0, HALT)
+            self.table[address] = entry
+            return entry
+        opcode = self.memory[address]
+        if opcode not in self.opcodes:
+            raise VmError(f"Invalid opcode {opcode:02X} at address {hex(address)}")
+        handler, argsize, relative = self.opcodes[opcode]
+        if handler == None:
+            raise VmError(f"No handler for opcode {opcode:02X} at address {hex(address)}")
+        nxt = address + 1 + argsize
+        if nxt > MEMORY_SIZE:
+            raise VmError(f"Truncated instruction at address {hex(address)}")
+        arg = int.from_bytes(self.memory[address + 1:nxt], byteorder='big')
+        if relative:
+            # Relative jumps are signed and measured from the jump itself
+            if arg >= 0x8000:
+                arg -= 0x10000
+            arg = (address + arg) % MEMORY_SIZE
+        entry = (handler, arg, nxt)
+        self.table[address] = entry
+        return entry
+
+    # Decodes the image linearly, stepping over bytes that are not valid
+    # instructions. Entries are keyed by address, so decoding through data
+    # only produces entries that are never executed; anything missed here
+    # (misaligned jump targets, code written at run time) is decoded lazily
+    def predecode(self):
+        address = 0
+        while address < self.image_size:
+            opcode = self.memory[address]
+            if opcode not in self.opcodes or self.opcodes[opcode][0] == None:
+                address += 1
+                continue
+            if address + 1 + self.opcodes[opcode][1] > MEMORY_SIZE:
+                break
+            address = self.decode(address)[2]
+
+    def store(self, address: int, value: int):
+        self.memory[address] = value
+        if address < self.image_size:
+            # Self-modifying code: drop decodings that covered this byte
+            table = self.table
+            for start in range(max(0, address - self.max_argsize), address + 1):
+                table[start] = None
+
+    def pointer(self):
+        stack = self.stack
+        if len(stack) < 2:
+            raise VmError("Stack underflow")
+        return ((stack[-2] << 8) | stack[-1]) % MEMORY_SIZE
+
+    def step(self):
+        if self.pc == HALT:
+            return False
+        entry = self.table[self.pc]
+        if entry == None:
+            entry = self.decode(self.pc)
+        self.pc = entry[0](self, entry[1], entry[2])
+        self.steps += 1
+        return self.pc != HALT
+
+    def run(self, max_steps: int|None = None):
+        table = self.table
+        decode = self.decode
+        pc = self.pc
+        steps = 0
+        limit = max_steps if max_steps != None else 1 << 62
+        try:
+            while pc != HALT and steps < limit:
+                entry = table[pc]
+                if entry is None:
+                    entry = decode(pc)
+                pc = entry[0](self, entry[1], entry[2])
+                steps += 1
+        except IndexError:
+            raise VmError(f"Address out of range while executing at {hex(pc)}")
+        finally:
+            self.pc = pc
+            self.steps += steps
+        return pc == HALT
+
+    # Same as run(), also adding one to counts[address] for every
+    # instruction executed at that address
+    def run_counted(self, counts, max_steps: int|None = None):
+        table = self.table
+        decode = self.decode
+        pc = self.pc
+        steps = 0
+        limit = max_steps if max_steps != None else 1 << 62
+        try:
+            while pc != HALT and steps < limit:
+                entry = table[pc]
+                if entry is None:
+                    entry = decode(pc)
+                counts[pc] += 1
+                pc = entry[0](self, entry[1], entry[2])
+                steps += 1
+        except IndexError:
+            raise VmError(f"Address out of range while executing at {hex(pc)}")
+        finally:
+            self.pc = pc
+            self.steps += steps
+        return pc == HALT
+
+    @property
+    def halted(self):
+        return self.pc == HALT
@@ -0,0 +1,212 @@
+import json
+import random
+from array import array
+from bisect import bisect_right
+
+from .assembler import Compiler
+from .vm import MEMORY_SIZE, Vm
+
+
+DEFAULT_TOP = 20
+# Frame for the jump to _main the compiler puts in front of a program
+ENTRY_FRAME = "(entry)"
+
+
+# Counts how often each instruction of a compiled program runs on the VM and
+# maps the counts back to the source: address -> node -> source line, the
+# label whose code the address falls in and the macro the line expands.
+# Every instruction takes one step, so counts are cycles. The compiler must
+# be the one the image was linked from, after optimizing and pruning
+class ExecutionProfile:
+    def __init__(self, compiler: Compiler) -> None:
+        self.compiler = compiler
+        self.counts = array("Q", bytes(8 * MEMORY_SIZE))
+        self.steps = 0
+        self.samples = 0
+        self.interval = 1
+
+        code = compiler.result
+        instructions = code.instructions
+        # address -> source line of the instruction starting there, -1 if none
+        self.address_lines = array("i", [-1]) * MEMORY_SIZE
+        self.entry_addresses = set()
+        # source line -> address of its first instruction
+        self.line_addresses: dict[int, int] = {}
+        entry_rows = 0
+        if len(code) >= 2 and code.lineno[0] == 0 and code.lineno[1] == 0 and \
+                code.operands[code.operand[1]] == "_main":
+            entry_rows = 2
+        for row in range(len(code)):
+            offset = code.offset[row]
+            if instructions[code.inst[row]].opcode_byte == None or offset >= MEMORY_SIZE:
+                continue
+            self.address_lines[offset] = code.lineno[row]
+            if row < entry_rows:
+                self.entry_addresses.add(offset)
+            elif code.lineno[row] not in self.line_addresses:
+                self.line_addresses[code.lineno[row]] = offset
+
+        # Labels as the starts of address ranges. Local labels stay inside
+        # the range of the label they belong to, and of several labels at one
+        # address the last one defined wins, as it is the one next to the code
+        starts: dict[int, str] = {}
+        for label, address in compiler.labels.items():
+            if label not in compiler.local_labels:
+                starts[address] = label
+        self.label_starts = sorted(starts)
+        self.label_names = [starts[address] for address in self.label_starts]
+
+    def label(self, address: int):
+        if address in self.entry_addresses:
+            return ENTRY_FRAME
+        index = bisect_right(self.label_starts, address) - 1
+        return self.label_names[index] if index >= 0 else ENTRY_FRAME
+
+    def source(self, line: int):
+        return self.compiler.lines[line].strip()
+
+    # The macro a line expands, as written (.add16), or None for plain
+    # instructions
+    def macro(self, line: int):
+        segments = self.source(line).split()
+        if segments and segments[0].startswith("."):
+            return segments[0].lower()
+        return None
+
+    # Runs vm counting every instruction. With interval, the VM instead runs
+    # at full speed in bursts of about interval steps and the instruction it
+    # stopped at is charged for the whole burst. Burst lengths are jittered
+    # so that loops whose length divides the interval are not always caught
+    # at the same instruction. Returns whether the program halted
+    def run(self, vm: Vm, max_steps: int|None = None, interval: int|None = None):
+        start = vm.steps
+        try:
+            if interval == None:
+                halted = vm.run_counted(self.counts, max_steps)
+                self.samples += vm.steps - start
+            else:
+                halted = self.sample(vm, max_steps, interval)
+        finally:
+            self.steps += vm.steps - start
+        return halted
+
+    def sample(self, vm: Vm, max_steps: int|None, interval: int):
+        self.interval = interval
+        counts = self.counts
+        rng = random.Random(0)
+        remaining = max_steps
+        while remaining == None or remaining > 0:
+            burst = rng.randint(max(1, interval // 2), interval + interval // 2)
+            if remaining != None:
+                burst = min(burst, remaining)
+                remaining -= burst
+            if vm.run(burst):
+                return True
+            counts[vm.pc] += burst
+            self.samples += 1
+        return False
+
+    def lines(self):
+        lines: dict[int, int] = {}
+        unmapped = 0
+        address_lines = self.address_lines
+        for address, count in enumerate(self.counts):
+            if count == 0:
+                continue
+            line = address_lines[address]
+            if line < 0:
+                unmapped += count
+            elif address not in self.entry_addresses:
+                lines[line] = lines.get(line, 0) + count
+        return lines, unmapped
+
+    def labels(self):
+        labels: dict[str, int] = {}
+        for address, count in enumerate(self.counts):
+            if count != 0:
+                label = self.label(address)
+                labels[label] = labels.get(label, 0) + count
+        return labels
+
+    def report(self, top: int = DEFAULT_TOP):
+        lines, unmapped = self.lines()
+        total = sum(self.counts)
+        percent = (lambda count: count * 100 / total) if total != 0 else (lambda count: 0.0)
+
+        macros: dict[str, dict] = {}
+        for line, count in lines.items():
+            macro = self.macro(line)
+            if macro == None:
+                continue
+            entry = macros.setdefault(macro, {"cycles": 0, "lines": 0})
+            entry["cycles"] += count
+            entry["lines"] += 1
+        for entry in macros.values():
+            entry["percent"] = percent(entry["cycles"])
+
+        hottest = sorted(lines.items(), key=lambda item: (-item[1], item[0]))[:top]
+        return {
+            "steps": self.steps,
+            "samples": self.samples,
+            "sample_interval": self.interval,
+            "cycles": total,
+            "lines": [{
+                "location": self.compiler.source_location(line),
+                "line": line,
+                "source": self.source(line),
+                "label": self.label(self.line_addresses[line]),
+                "cycles": count,
+                "percent": percent(count),
+            } for line, count in hottest],
+            "labels": {label: {"cycles": count, "percent": percent(count)}
+                       for label, count in sorted(self.labels().items(), key=lambda item: (-item[1], item[0]))},
+            "macros": dict(sorted(macros.items(), key=lambda item: (-item[1]["cycles"], item[0]))),
+            # Cycles spent at addresses no instruction was assembled at, such
+            # as code written at run time
+            "unmapped_cycles": unmapped,
+        }
+
+    # One "label;.macro;location source count" line per executed source line,
+    # the folded format read by flamegraph.pl, speedscope and inferno. The
+    # macro frame is left out for plain instructions
+    def collapsed(self):
+        frames: dict[str, int] = {}
+        address_lines = self.address_lines
+        for address, count in enumerate(self.counts):
+            if count == 0:
+                continue
+            label = self.label(address)
+            line = address_lines[address]
+            if address in self.entry_addresses:
+                stack = ENTRY_FRAME
+            elif line < 0:
+                stack = f"{label};{hex(address)}"
+            else:
+                macro = self.macro(line)
+                # ; separates frames
+                frame = f"{self.compiler.source_location(line)} {self.source(line)}".replace(";", ",")
+                stack = f"{label};{macro};{frame}" if macro != None else f"{label};{frame}"
+            frames[stack] = frames.get(stack, 0) + count
+        return [f"{stack} {count}" for stack, count in frames.items()]
+
+
+def format_profile(profile: dict, format: str = "text"):
+    if format == "json":
+        return json.dumps(profile, indent=2)
+
+    sampled = f", {profile['samples']} sample(s) every ~{profile['sample_interval']} step(s)" \
+        if profile["sample_interval"] != 1 else ""
+    lines = [f"Execution profile: {profile['steps']} step(s){sampled}"]
+    lines.append("  Hottest lines:")
+    for line in profile["lines"]:
+        lines.append(f"    {line['cycles']:>10} {line['percent']:5.1f}%  {line['location']}\t{line['source']}")
+    lines.append("  Labels (inclusive):")
+    for label, entry in profile["labels"].items():
+        lines.append(f"    {entry['cycles']:>10} {entry['percent']:5.1f}%  {label}")
+    if profile["macros"]:
+        lines.append("  Macros:")
+        for macro, entry in profile["macros"].items():
+            lines.append(f"    {entry['cycles']:>10} {entry['percent']:5.1f}%  {macro} ({entry['lines']} line(s))")
+    if profile["unmapped_cycles"] != 0:
+        lines.append(f"  {profile['unmapped_cycles']} cycle(s) at addresses without assembled instructions")
+    return "\n".join(lines)
@@ -0,0 +1,260 @@
+import os
+import json
+import time
+import socket
+import selectors
+
+from .assembler import EXPANSION_MODES, VM_INSTRUCTIONS, VmInstructionInfo
+from .batch import BuildResult, build_file, output_paths
+
+
+DEFAULT_INTERVAL = 0.25
+# How long a client may take to send its request
+REQUEST_TIMEOUT = 5.0
+# Longest request line accepted, in bytes
+MAX_REQUEST_SIZE = 64 * 1024
+
+
+def file_stamp(path: str):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class Target:
+    __slots__ = ("source", "output", "opt_level", "stamps", "result")
+
+    def __init__(self, source: str, output: str, opt_level: str) -> None:
+        self.source = source
+        self.output = output
+        self.opt_level = opt_level
+        # Dependency -> (mtime, size) when the output was last built
+        self.stamps: dict[str, tuple[int, int]|None] = {}
+        self.result: BuildResult|None = None
+
+
+# Stays resident and keeps every output it built up to date. Outputs are
+# rebuilt only when one of the files they were built from (the source and
+# the files it includes) changes size or modification time, which is checked
+# by polling. The interpreter, the instruction table and the build cache stay
+# warm between builds, and outputs are replaced atomically
+class Watcher:
+    def __init__(self, opt_level: str = "0", use_cache: bool = True,
+                 instructions: dict[str, VmInstructionInfo]|None = None) -> None:
+        self.opt_level = opt_level
+        self.use_cache = use_cache
+        self.instructions = dict(VM_INSTRUCTIONS if instructions == None else instructions)
+        self.targets: dict[tuple[str, str, str], Target] = {}
+        # Targets rebuilt by poll(); others are only rebuilt on request
+        self.watched: list[Target] = []
+
+    def target(self, source: str, output: str, opt_level: str|None = None):
+        opt_level = self.opt_level if opt_level == None else opt_level
+        if opt_level not in EXPANSION_MODES:
+            raise ValueError(f"Unknown optimization level '{opt_level}'")
+        key = (os.path.abspath(source), os.path.abspath(output), opt_level)
+        if key not in self.targets:
+            self.targets[key] = Target(*key)
+        return self.targets[key]
+
+    def watch(self, sources: list[str], directory: str):
+        os.makedirs(directory, exist_ok=True)
+        for source, output in output_paths(sources, directory).items():
+            self.watched.append(self.target(source, output))
+
+    def changed(self, target: Target):
+        if target.result == None or (target.result.error == None and not os.path.exists(target.output)):
+            return True
+        return any(file_stamp(path) != stamp for path, stamp in target.stamps.items())
+
+    def build(self, target: Target):
+        # A file saved while it is being built is picked up by the next poll
+        stamps = {path: file_stamp(path) for path in target.stamps}
+        stamps[target.source] = file_stamp(target.source)
+        result = build_file(target.source, target.output, target.opt_level, self.use_cache, self.instructions)
+        for path in result.dependencies:
+            if path not in stamps:
+                stamps[path] = file_stamp(path)
+        # A failed build may not have reached all of its includes, so the
+        # ones it had before are still watched
+        target.stamps = stamps if result.error != None else {path: stamps[path] for path in result.dependencies}
+        target.result = result
+        return result
+
+    # Builds target unless it is up to date. Returns the result and whether
+    # it was rebuilt
+    def assemble(self, target: Target):
+        if self.changed(target):
+            return self.build(target), True
+        return target.result, False
+
+    def poll(self):
+        return [self.build(target) for target in self.watched if self.changed(target)]
+
+
+def result_message(result: BuildResult, rebuilt: bool):
+    return {
+        "source": result.source,
+        "output": result.output,
+        "size": result.size,
+        "compile_ms": result.compile_time * 1000,
+        "link_ms": result.link_time * 1000,
+        "cache_hit": result.cache_hit,
+        "up_to_date": not rebuilt,
+        "error": result.error,
+        "exit_code": result.exit_code,
+    }
+
+
+# A connection to the daemon whose request line has not fully arrived yet
+class Client:
+    __slots__ = ("connection", "buffer", "deadline")
+
+    def __init__(self, connection: socket.socket) -> None:
+        self.connection = connection
+        self.buffer = b""
+        self.deadline = time.monotonic() + REQUEST_TIMEOUT
+
+
+# Serves build requests on a Unix socket while polling the watched files.
+# Each connection sends one JSON object on a line, {"source": ...,
+# "output": ..., "opt_level": ...} with paths relative to the daemon's working
+# directory (output and opt_level are optional), and gets the result back as
+# one JSON line. on_build is called with the result of every build.
+# Requests are read from all connections at once through the selector, so a
+# slow or idle client does not hold up the others, but builds run one after
+# another on the daemon's thread as they share the watcher and its cache
+class Daemon:
+    def __init__(self, watcher: Watcher, socket_path: str|None = None, directory: str = ".",
+                 interval: float = DEFAULT_INTERVAL, on_build=None) -> None:
+        self.watcher = watcher
+        self.socket_path = socket_path
+        self.directory = directory
+        self.interval = interval
+        self.on_build = on_build or (lambda result: None)
+        self.selector = selectors.DefaultSelector()
+        self.server = None
+
+    def listen(self):
+        if os.path.exists(self.socket_path):
+            # Left behind by a daemon that is no longer running
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except ConnectionRefusedError:
+                os.remove(self.socket_path)
+            else:
+                raise OSError(f"A daemon is already listening on {self.socket_path}")
+            finally:
+                probe.close()
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        self.server.listen()
+        self.server.setblocking(False)
+        self.selector.register(self.server, selectors.EVENT_READ)
+
+    def close(self):
+        for key in list(self.selector.get_map().values()):
+            if key.data != None:
+                self.drop(key.data)
+        if self.server != None:
+            self.selector.unregister(self.server)
+            self.server.close()
+            self.server = None
+            os.remove(self.socket_path)
+
+    def accept(self):
+        try:
+            connection, _ = self.server.accept()
+        except BlockingIOError:
+            return
+        connection.setblocking(False)
+        self.selector.register(connection, selectors.EVENT_READ, Client(connection))
+
+    def drop(self, client: Client):
+        self.selector.unregister(client.connection)
+        client.connection.close()
+
+    def handle(self, line: bytes):
+        try:
+            request = json.loads(line)
+            source = request["source"]
+            output = request.get("output") or output_paths([source], self.directory)[source]
+            target = self.watcher.target(source, output, request.get("opt_level"))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            return {"error": f"ERROR: Invalid request: {e}", "exit_code": -2}
+        result, rebuilt = self.watcher.assemble(target)
+        if rebuilt:
+            self.on_build(result)
+        return result_message(result, rebuilt)
+
+    def respond(self, client: Client, response: dict):
+        self.selector.unregister(client.connection)
+        # Responses are small, so this only blocks on a client that stopped
+        # reading, and then no longer than the request timeout
+        client.connection.settimeout(REQUEST_TIMEOUT)
+        with client.connection:
+            try:
+                client.connection.sendall(json.dumps(response).encode() + b"\n")
+            except OSError:
+                pass
+
+    def receive(self, client: Client):
+        try:
+            data = client.connection.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.drop(client)
+            return
+        client.buffer += data
+        # A client that closes its end without a newline sent its whole request
+        if data and b"\n" not in client.buffer:
+            if len(client.buffer) > MAX_REQUEST_SIZE:
+                self.respond(client, {"error": f"ERROR: Invalid request: longer than {MAX_REQUEST_SIZE} bytes",
+                                      "exit_code": -2})
+            return
+        self.respond(client, self.handle(client.buffer.partition(b"\n")[0]))
+
+    def expire(self):
+        now = time.monotonic()
+        for key in list(self.selector.get_map().values()):
+            if key.data != None and key.data.deadline <= now:
+                self.respond(key.data, {"error": "ERROR: Invalid request: timed out", "exit_code": -2})
+
+    def serve_forever(self):
+        if self.socket_path != None:
+            self.listen()
+        try:
+            while True:
+                for result in self.watcher.poll():
+                    self.on_build(result)
+                if self.server == None:
+                    time.sleep(self.interval)
+                    continue
+                for key, events in self.selector.select(self.interval):
+                    if key.data == None:
+                        self.accept()
+                    else:
+                        self.receive(key.data)
+                self.expire()
+        finally:
+            self.close()
+
+
+# Asks the daemon listening on socket_path to build source, and returns its
+# response
+def request(socket_path: str, source: str, output: str|None = None, opt_level: str|None = None):
+    message = {"source": os.path.abspath(source)}
+    if output != None:
+        message["output"] = os.path.abspath(output)
+    if opt_level != None:
+        message["opt_level"] = opt_level
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        with connection.makefile("rwb") as stream:
+            stream.write(json.dumps(message).encode() + b"\n")
+            stream.flush()
+            return json.loads(stream.readline())